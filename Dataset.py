@@ -1,11 +1,15 @@
 import torch
+import json
 from tokenlizer import smi_tokenizer
-from utils.graph_utils import smiles2graph
+from data_utils import StringColumn
+from utils.graph_utils import cached_smiles2graph
 import numpy as np
 from typing import Any, Dict, List, Tuple, Optional, Union
 from torch_geometric.data import Data as GData
 from utils.chemistry_parse import find_all_amap, remove_am_wo_cano
 import random
+import itertools
+import csv
 from rdkit import Chem
 
 
@@ -52,46 +56,137 @@ class TransDataset(torch.utils.data.Dataset):
         ret.extend(smi_tokenizer(out_smi))
         ret.append('<END>')
 
-        return smiles2graph(out_smi, with_amap=False), ret
+        return cached_smiles2graph(out_smi, with_amap=False), ret
+
+
+def collate_graphs(graphs, rxns=None):
+    """
+    Merge featurized graphs into one batch, the sizes are computed first
+    and every field is built by a single vectorized operation
+    :input: list of graphs from smiles2graph, optional list of classes
+    :return: dict of the fields of GData
+    """
+    node_per_graph = np.array(
+        [x['num_nodes'] for x in graphs], dtype=np.int64
+    )
+    edge_per_graph = np.array(
+        [x['edge_index'].shape[1] for x in graphs], dtype=np.int64
+    )
+    result = batch_index(node_per_graph)
+    ptr = result['ptr']
+
+    # np.concatenate sizes its output once, the offsets of edge_index
+    # are added inplace instead of shifting every graph separately
+    x = np.concatenate([g['node_feat'] for g in graphs], axis=0)
+    edge_attr = np.concatenate([g['edge_feat'] for g in graphs], axis=0)
+    edge_index = np.concatenate([g['edge_index'] for g in graphs], axis=1)
+    edge_index += np.repeat(ptr[:-1], edge_per_graph).astype(edge_index.dtype)
+    result.update({'edge_index': edge_index, 'edge_attr': edge_attr, 'x': x})
+
+    if rxns is not None:
+        # one class per graph, the encoder broadcasts it by batch
+        result['rxn_class'] = np.array(rxns, dtype=np.uint8)
 
-
-def col_fn_pretrain(data_batch):
-    batch_size, max_node = len(data_batch), 0
-    edge_idxes, edge_feats, node_feats, lstnode = [], [], [], 0
-    batch, ptr, reats, node_per_graph = [], [0], [], []
-    for idx, data in enumerate(data_batch):
-        graph, ret = data
-        num_nodes = graph['num_nodes']
-        num_edges = graph['edge_index'].shape[1]
-        reats.append(ret)
-
-        edge_idxes.append(graph['edge_index'] + lstnode)
-        edge_feats.append(graph['edge_feat'])
-        node_feats.append(graph['node_feat'])
-
-        lstnode += num_nodes
-        max_node = max(max_node, num_nodes)
-        node_per_graph.append(num_nodes)
-        batch.append(np.ones(num_nodes, dtype=np.int64) * idx)
-        ptr.append(lstnode)
-
-    result = {
-        'edge_index': np.concatenate(edge_idxes, axis=-1),
-        'edge_attr': np.concatenate(edge_feats, axis=0),
-        'batch': np.concatenate(batch, axis=0),
-        'x': np.concatenate(node_feats, axis=0),
-        'ptr': np.array(ptr, dtype=np.int64)
+    result = {k: torch.from_numpy(v) for k, v in result.items()}
+    result['num_nodes'] = int(ptr[-1])
+    return result
+
+
+def batch_index(node_per_graph):
+    """
+    the node indices of a batch of graphs with node_per_graph nodes
+    :return: dict of ptr, batch, batch_mask and pad_index as numpy arrays
+    """
+    batch_size = len(node_per_graph)
+    ptr = np.zeros(batch_size + 1, dtype=np.int64)
+    np.cumsum(node_per_graph, out=ptr[1:])
+    num_nodes = int(ptr[-1])
+    max_node = int(node_per_graph.max()) if batch_size > 0 else 0
+
+    graph_idx = np.arange(batch_size, dtype=np.int64)
+    batch_mask = np.arange(max_node) < node_per_graph[:, None]
+    # the position of every node in the padded [batch_size * max_node]
+    # memory, the node n of graph b goes to b * max_node + n - ptr[b]
+    pad_index = np.arange(num_nodes, dtype=np.int64) + np.repeat(
+        graph_idx * max_node - ptr[:-1], node_per_graph
+    )
+    return {
+        'batch': np.repeat(graph_idx, node_per_graph), 'ptr': ptr,
+        'batch_mask': batch_mask, 'pad_index': pad_index
     }
 
-    result = {k: torch.from_numpy(v) for k, v in result.items()}
-    result['num_nodes'] = lstnode
 
-    all_batch_mask = torch.zeros((batch_size, max_node))
-    for idx, mk in enumerate(node_per_graph):
-        all_batch_mask[idx, :mk] = 1
-    result['batch_mask'] = all_batch_mask.bool()
+class SizeSortedBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of molecules with similar sizes, the indices of sampler are
+    taken pool_size batches at a time, sorted by size and cut into
+    batches, the batches of a pool are shuffled so the sizes still come
+    in random order, less padding for the encoder and the memory
+    """
+    def __init__(self, sampler, sizes, batch_size, pool_size=100, seed=2023):
+        self.sampler, self.sizes = sampler, sizes
+        self.batch_size, self.pool_size = batch_size, pool_size
+        self.rng = random.Random(seed)
+
+    def __len__(self):
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+    def make_batches(self, pool):
+        pool.sort(key=lambda x: self.sizes[x])
+        batches = [
+            pool[i: i + self.batch_size]
+            for i in range(0, len(pool), self.batch_size)
+        ]
+        self.rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        pool = []
+        for idx in self.sampler:
+            pool.append(idx)
+            if len(pool) == self.batch_size * self.pool_size:
+                yield from self.make_batches(pool)
+                pool = []
+        if len(pool) > 0:
+            yield from self.make_batches(pool)
+
+    def state_dict(self):
+        return {'rng': self.rng.getstate()}
+
+    def load_state_dict(self, state):
+        self.rng.setstate(state['rng'])
+
+
+class SkipBatchSampler(torch.utils.data.Sampler):
+    """
+    Wraps a batch sampler, the first skip batches of the next epoch are
+    dropped before any of their samples is loaded, used to resume
+    training in the middle of an epoch with the same batches
+    """
+    def __init__(self, batch_sampler):
+        self.batch_sampler, self.skip = batch_sampler, 0
+
+    def __len__(self):
+        return len(self.batch_sampler) - self.skip
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        return itertools.islice(iter(self.batch_sampler), skip, None)
+
+    def state_dict(self):
+        if hasattr(self.batch_sampler, 'state_dict'):
+            return self.batch_sampler.state_dict()
+        return {}
+
+    def load_state_dict(self, state):
+        if hasattr(self.batch_sampler, 'load_state_dict'):
+            self.batch_sampler.load_state_dict(state)
 
-    return GData(**result), reats
+
+def col_fn_pretrain(data_batch):
+    graphs = [x[0] for x in data_batch]
+    reats = [x[1] for x in data_batch]
+    return GData(**collate_graphs(graphs)), reats
 
 
 class RetroDataset(torch.utils.data.Dataset):
@@ -156,66 +251,287 @@ class RetroDataset(torch.utils.data.Dataset):
         aligned_reactants.sort(key=lambda x: x[1])
         return '.'.join(x[0] for x in aligned_reactants)
 
-    def __getitem__(self, index):
-        this_reac, this_prod = self.remap_reac_prod(
-            reac=self.reat_sm[index], prod=self.prod_sm[index]
-        )
+    def make_sample(self, reac, prod, rxn=None):
+        this_reac, this_prod = self.remap_reac_prod(reac=reac, prod=prod)
         this_reac = self.process_reac_via_prod(this_prod, this_reac)
-        rxn = None if self.rxn_cls is None else self.rxn_cls[index]
         ret = ['<CLS>' if rxn is None else f'<RXN>_{rxn}']
         ret.extend(smi_tokenizer(remove_am_wo_cano(this_reac)))
         ret.append('<END>')
 
-        graph = smiles2graph(this_prod, with_amap=False)
+        graph = cached_smiles2graph(this_prod, with_amap=False)
 
         return graph,  ret, rxn
 
+    def __getitem__(self, index):
+        rxn = None if self.rxn_cls is None else self.rxn_cls[index]
+        return self.make_sample(
+            reac=self.reat_sm[index], prod=self.prod_sm[index], rxn=rxn
+        )
+
+
+class SeqDistillDataset(torch.utils.data.Dataset):
+    """
+    The products of a RetroDataset with the answers of a teacher model
+    as targets, for sequence level distillation. answers[i] holds the
+    reactant smiles the teacher gives for the canonical prod_sm[i],
+    every answer is a sample, collated by col_fn_retro.
+    """
+
+    def __init__(
+        self, prod_sm: List[str], answers: List[List[str]],
+        rxn_cls: Optional[List[int]] = None
+    ):
+        super(SeqDistillDataset, self).__init__()
+        self.prod_sm, self.rxn_cls = prod_sm, rxn_cls
+        self.samples = [
+            (idx, x) for idx, answer in enumerate(answers) for x in answer
+        ]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        idx, answer = self.samples[index]
+        rxn = None if self.rxn_cls is None else self.rxn_cls[idx]
+        ret = ['<CLS>' if rxn is None else f'<RXN>_{rxn}']
+        ret.extend(smi_tokenizer(answer))
+        ret.append('<END>')
+        graph = cached_smiles2graph(self.prod_sm[idx], with_amap=False)
+        return graph, ret, rxn
+
 
 def col_fn_retro(data_batch):
-    batch_size, max_node = len(data_batch), 0
-    edge_idxes, edge_feats, node_feats, lstnode = [], [], [], 0
-    batch, ptr, reats, node_per_graph = [], [0], [], []
-    node_rxn, edge_rxn = [], []
-    for idx, data in enumerate(data_batch):
-        graph, ret, rxn = data
-        num_nodes = graph['num_nodes']
-        num_edges = graph['edge_index'].shape[1]
-        reats.append(ret)
-
-        edge_idxes.append(graph['edge_index'] + lstnode)
-        edge_feats.append(graph['edge_feat'])
-        node_feats.append(graph['node_feat'])
-
-        lstnode += num_nodes
-        max_node = max(max_node, num_nodes)
-        node_per_graph.append(num_nodes)
-        batch.append(np.ones(num_nodes, dtype=np.int64) * idx)
-        ptr.append(lstnode)
-
-        if rxn is not None:
-            node_rxn.append(np.ones(num_nodes, dtype=np.int64) * rxn)
-            edge_rxn.append(np.ones(num_edges, dtype=np.int64) * rxn)
-
-    result = {
-        'edge_index': np.concatenate(edge_idxes, axis=-1),
-        'edge_attr': np.concatenate(edge_feats, axis=0),
-        'batch': np.concatenate(batch, axis=0),
-        'x': np.concatenate(node_feats, axis=0),
-        'ptr': np.array(ptr, dtype=np.int64)
-    }
+    graphs = [x[0] for x in data_batch]
+    reats = [x[1] for x in data_batch]
+    rxns = [x[2] for x in data_batch]
+    if any(x is None for x in rxns):
+        rxns = None
+    return GData(**collate_graphs(graphs, rxns)), reats
+
+
+class MemoryCacheDataset(torch.utils.data.Dataset):
+    """
+    Training samples read from the cache of training.build_memory_cache,
+    the node features of a frozen encoder in a memory-mapped file and
+    the target tokens, no rdkit or gnn work per sample. The cache holds
+    the canonical product and bank randomized variants of every
+    reaction, with aug_prob a random variant of the bank is drawn.
+    """
+
+    def __init__(self, path, aug_prob=0):
+        super(MemoryCacheDataset, self).__init__()
+        self.path, self.aug_prob = path, aug_prob
+        self._open()
+
+    def _open(self):
+        with open(f'{self.path}/meta.json') as Fin:
+            meta = json.load(Fin)
+        self.num, self.bank = meta['num'], meta['bank']
+        self.offset = np.load(f'{self.path}/feat_offset.npy', mmap_mode='r')
+        self.feat = np.memmap(
+            f'{self.path}/feat.bin', dtype=meta['dtype'], mode='r',
+            shape=(int(self.offset[-1]), meta['dim'])
+        )
+        self.tokens = StringColumn(f'{self.path}/tokens')
+
+    def __len__(self):
+        return self.num
 
+    def __getitem__(self, index):
+        variant = 0
+        if self.bank > 0 and random.random() < self.aug_prob:
+            variant = random.randint(1, self.bank)
+        entry = variant * self.num + index
+        start, end = self.offset[entry], self.offset[entry + 1]
+        return self.feat[start: end], self.tokens[entry].split(' ')
+
+    def __getstate__(self):
+        # reopen the files instead of pickling the content
+        return {'path': self.path, 'aug_prob': self.aug_prob}
+
+    def __setstate__(self, state):
+        self.path, self.aug_prob = state['path'], state['aug_prob']
+        self._open()
+
+
+def col_fn_cached(data_batch):
+    # the cached node features are passed to the model as cached_feat
+    feats = [x[0] for x in data_batch]
+    reats = [x[1] for x in data_batch]
+    result = batch_index(np.array([len(x) for x in feats], dtype=np.int64))
+    result['cached_feat'] = np.concatenate(feats, axis=0).astype(np.float32)
     result = {k: torch.from_numpy(v) for k, v in result.items()}
-    result['num_nodes'] = lstnode
+    result['num_nodes'] = int(result['ptr'][-1])
+    return GData(**result), reats
 
-    all_batch_mask = torch.zeros((batch_size, max_node))
-    for idx, mk in enumerate(node_per_graph):
-        all_batch_mask[idx, :mk] = 1
-    result['batch_mask'] = all_batch_mask.bool()
 
-    if len(node_rxn) > 0:
-        node_rxn = np.concatenate(node_rxn, axis=0)
-        edge_rxn = np.concatenate(edge_rxn, axis=0)
-        result['node_rxn'] = torch.from_numpy(node_rxn)
-        result['edge_rxn'] = torch.from_numpy(edge_rxn)
+def count_rows(csv_file):
+    # number of data rows, header excluded, without parsing the file
+    num_lines, last = 0, b'\n'
+    with open(csv_file, 'rb') as Fin:
+        for chunk in iter(lambda: Fin.read(1 << 20), b''):
+            num_lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return num_lines + (last != b'\n') - 1
 
-    return GData(**result), reats
+
+class StreamingRetroDataset(torch.utils.data.IterableDataset):
+    """
+    Streams reactions from csv shards in the format of the canonicalized
+    datasets, for corpora that do not fit in memory.
+
+    Every epoch the shard order is shuffled with a fixed seed and shards
+    are dealt to global workers (rank * num_workers + worker_id) without
+    duplication, each worker reads its shards sequentially through a
+    seeded shuffle buffer. With equalize, all the global workers yield
+    the same number of samples so ddp ranks run the same number of steps.
+
+    The position of every global worker is reported through StreamCollate
+    and recorded by update_cursor, state_dict/load_state_dict resume the
+    stream in the middle of an epoch with the same data order.
+    """
+
+    def __init__(
+        self, shards: List[str], aug_prob: float = 0,
+        use_class: bool = False, buffer_size: int = 10000,
+        seed: int = 2023, num_workers: int = 0, equalize: bool = True,
+        rank: Optional[int] = None, world_size: Optional[int] = None
+    ):
+        super(StreamingRetroDataset, self).__init__()
+        if len(shards) == 0:
+            raise ValueError('no shard is given')
+        self.shards = sorted(shards)
+        self.shard_sizes = [count_rows(x) for x in self.shards]
+        self.processor = RetroDataset([], [], aug_prob=aug_prob)
+        self.use_class = use_class
+        self.buffer_size = buffer_size
+        self.seed, self.equalize = seed, equalize
+        self.num_workers = max(num_workers, 1)
+
+        if rank is None or world_size is None:
+            if torch.distributed.is_available() and \
+                    torch.distributed.is_initialized():
+                rank = torch.distributed.get_rank()
+                world_size = torch.distributed.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        self.rank, self.world_size = rank, world_size
+        self.total_workers = self.world_size * self.num_workers
+        if len(self.shards) < self.total_workers:
+            raise ValueError(
+                f'{len(self.shards)} shards can not feed '
+                f'{self.total_workers} workers'
+            )
+
+        self.epoch, self.consumed, self.skip = 0, {}, {}
+        self.cursor = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch, self.consumed, self.skip = epoch, {}, {}
+
+    def assign_shards(self):
+        order = list(range(len(self.shards)))
+        random.Random(f'{self.seed}-{self.epoch}').shuffle(order)
+        total = self.total_workers
+        return [order[x::total] for x in range(total)]
+
+    def worker_sizes(self):
+        sizes = [
+            sum(self.shard_sizes[x] for x in shards)
+            for shards in self.assign_shards()
+        ]
+        return [min(sizes)] * len(sizes) if self.equalize else sizes
+
+    def __len__(self):
+        # the samples left in this epoch, without the ones skipped on resume
+        start = self.rank * self.num_workers
+        gids = range(start, start + self.num_workers)
+        sizes = self.worker_sizes()
+        return sum(sizes[x] - self.skip.get(x, 0) for x in gids)
+
+    def read_shards(self, shard_ids):
+        for idx in shard_ids:
+            with open(self.shards[idx], newline='') as Fin:
+                for row in csv.DictReader(Fin):
+                    rxn = int(row['class']) if self.use_class else None
+                    yield row['reactants>reagents>production'], rxn
+
+    def shuffle_buffer(self, rows, rng):
+        buffer = []
+        for row in rows:
+            if len(buffer) < self.buffer_size:
+                buffer.append(row)
+                continue
+            idx = rng.randrange(self.buffer_size)
+            yield buffer[idx]
+            buffer[idx] = row
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker_id = 0 if info is None else info.id
+        if info is not None and info.num_workers != self.num_workers:
+            raise ValueError(
+                f'dataset built for {self.num_workers} workers '
+                f'but loaded by {info.num_workers}'
+            )
+        gid = self.rank * self.num_workers + worker_id
+        limit = self.worker_sizes()[gid]
+        skip = self.skip.get(gid, 0)
+        rng = random.Random(f'{self.seed}-{self.epoch}-{gid}')
+
+        rows = self.read_shards(self.assign_shards()[gid])
+        for position, (rxn_smi, rxn) in enumerate(
+            self.shuffle_buffer(rows, rng)
+        ):
+            if position >= limit:
+                break
+            if position < skip:
+                continue
+            reac, prod = rxn_smi.strip().split('>>')
+            sample = self.processor.make_sample(reac, prod, rxn)
+            self.cursor = (self.epoch, gid, position + 1)
+            yield sample
+
+    def update_cursor(self, graph):
+        epoch, gid, position = graph.stream_cursor
+        if epoch == self.epoch:
+            self.consumed[gid] = max(self.consumed.get(gid, 0), position)
+
+    def state_dict(self):
+        return {
+            'epoch': self.epoch, 'consumed': dict(self.consumed),
+            'total_workers': self.total_workers, 'seed': self.seed
+        }
+
+    def load_state_dict(self, state):
+        if state['total_workers'] != self.total_workers or \
+                state['seed'] != self.seed:
+            raise ValueError(
+                'the stream can only be resumed with the same seed '
+                'and number of ranks and workers'
+            )
+        self.epoch = state['epoch']
+        self.consumed = dict(state['consumed'])
+        self.skip = dict(state['consumed'])
+
+
+class StreamCollate(object):
+    """
+    Wraps a collate function and tags every batch with the cursor of the
+    worker that produced it, used by StreamingRetroDataset.update_cursor
+    """
+
+    def __init__(self, dataset, collate_fn=col_fn_retro):
+        super(StreamCollate, self).__init__()
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+
+    def __call__(self, data_batch):
+        info = torch.utils.data.get_worker_info()
+        dataset = self.dataset if info is None else info.dataset
+        graph, reats = self.collate_fn(data_batch)
+        graph.stream_cursor = dataset.cursor
+        return graph, reats
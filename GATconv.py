@@ -1,5 +1,6 @@
 from torch_geometric.nn.inits import glorot, zeros
 from torch_geometric.utils import softmax as sp_softmax
+import math
 import torch
 import torch.nn.functional as F
 from torch_geometric.nn.conv import MessagePassing
@@ -8,6 +9,42 @@ from torch.nn import Parameter
 import torch_geometric
 
 
+def add_self_loops(edge_index, num_nodes):
+    """
+    append the self loops (i, i) after all the edges of edge_index
+    """
+    loops = torch.arange(num_nodes, device=edge_index.device)
+    loops = loops.to(edge_index.dtype).unsqueeze(0).repeat(2, 1)
+    return torch.cat([edge_index, loops], dim=1)
+
+
+def to_csr(edge_index, num_nodes):
+    """
+    sort the edges by their target nodes, returns the sorted edge_index,
+    the permutation applied to the edges and the in-degree of every node
+    """
+    _, perm = torch.sort(edge_index[1], stable=True)
+    degree = torch.bincount(edge_index[1], minlength=num_nodes)
+    return edge_index[:, perm], perm, degree
+
+
+def dense_index(edge_index, batch_mask, node_pos=None):
+    """
+    positions of the nodes in the padded [batch_size * max_node] layout,
+    the graph of every edge and its position in the flattened
+    [max_node, max_node] adjacency, row for target and column for source,
+    node_pos is the pad_index of the batch if the collate function built it
+    """
+    max_node = batch_mask.shape[1]
+    if node_pos is None:
+        node_pos = torch.nonzero(batch_mask.reshape(-1)).squeeze(-1)
+    dst_pos = node_pos[edge_index[1]]
+    edge_batch = torch.div(dst_pos, max_node, rounding_mode='floor')
+    edge_pos = (dst_pos % max_node) * max_node
+    edge_pos = edge_pos + node_pos[edge_index[0]] % max_node
+    return node_pos, edge_batch, edge_pos
+
+
 class SelfLoopGATConv(MessagePassing):
     def __init__(
         self, in_channels, out_channels, edge_dim, heads=1,
@@ -51,26 +88,29 @@ class SelfLoopGATConv(MessagePassing):
         glorot(self.att_edge)
         zeros(self.bias)
 
-    def forward(self, x, edge_index, edge_attr, size=None):
+    def forward(
+        self, x, edge_index, edge_attr, size=None, self_loop_added=False
+    ):
         num_nodes = x.shape[0]
 
-        # add self loop
-
-        self_edges = torch.Tensor([(i, i) for i in range(num_nodes)])
-        self_edges = self_edges.T.to(edge_index)
-
-        edge_index = torch.cat([edge_index, self_edges], dim=1)
-        real_edge_attr = torch.cat([
-            edge_attr, self.self_edge.repeat(num_nodes, 1)
-        ], dim=0)
-
+        # add self loop, GATBase adds the self loops to edge_index once
+        # per batch and passes self_loop_added=True to every layer
+        if not self_loop_added:
+            edge_index = add_self_loops(edge_index, num_nodes)
 
         # old prop
 
         H, C = self.heads, self.out_channels
         x_src = self.lin_src(x).view(-1, H, C)
         x_dst = self.lin_dst(x).view(-1, H, C)
-        edge_attr = self.lin_edge(real_edge_attr)
+
+        # lin_edge(cat(edge_attr, self_edge)) without materializing the
+        # repeated self_edge, it is projected once and broadcast
+        self_edge_attr = self.lin_edge(self.self_edge)
+        edge_attr = torch.cat([
+            self.lin_edge(edge_attr),
+            self_edge_attr.expand(num_nodes, -1)
+        ], dim=0)
 
         x = (x_src, x_dst)
         alpha_src = (x_src * self.att_src).sum(dim=-1)
@@ -86,12 +126,125 @@ class SelfLoopGATConv(MessagePassing):
         out = out.view(-1, H * C) + self.bias
         return out
 
+    def fused_forward(self, x, edge_index, edge_attr, degree):
+        """
+        the same computation as forward with segment reductions instead
+        of propagate, edge_index holds the edges sorted by to_csr without
+        self loops, the self loop of every node is handled densely
+        """
+        H, C = self.heads, self.out_channels
+        src, dst = edge_index
+
+        # lin_src and lin_dst are the same module, project x once
+        x_proj = self.lin_src(x).view(-1, H, C)
+        edge_attr = self.lin_edge(edge_attr).view(-1, H, C)
+        self_edge_attr = self.lin_edge(self.self_edge).view(1, H, C)
+
+        alpha_src = (x_proj * self.att_src).sum(dim=-1)
+        alpha_dst = (x_proj * self.att_dst).sum(dim=-1)
+        alpha_edge = (edge_attr * self.att_edge).sum(dim=-1)
+        alpha = alpha_dst.index_select(0, dst)
+        alpha = alpha + alpha_src.index_select(0, src) + alpha_edge
+        alpha = F.leaky_relu(alpha.float(), self.negative_slope)
+        alpha_loop = (self_edge_attr * self.att_edge).sum(dim=-1)
+        alpha_loop = alpha_dst + alpha_src + alpha_loop
+        alpha_loop = F.leaky_relu(alpha_loop.float(), self.negative_slope)
+
+        # softmax over the incoming edges and the self loop of every node,
+        # in float32 under bf16 autocast
+        alpha_max = torch.segment_reduce(
+            alpha.detach(), 'max', lengths=degree
+        )
+        alpha_max = torch.maximum(alpha_max, alpha_loop.detach())
+        alpha = (alpha - alpha_max.index_select(0, dst)).exp()
+        alpha_loop = (alpha_loop - alpha_max).exp()
+        alpha_sum = torch.segment_reduce(alpha, 'sum', lengths=degree)
+        alpha_sum = alpha_sum + alpha_loop + 1e-16
+        alpha = self.dropout_fun(alpha / alpha_sum.index_select(0, dst))
+        alpha_loop = self.dropout_fun(alpha_loop / alpha_sum)
+
+        out = x_proj.index_select(0, src) + edge_attr
+        out = torch.segment_reduce(
+            alpha.unsqueeze(-1) * out, 'sum', lengths=degree
+        )
+        out = out + alpha_loop.unsqueeze(-1) * (x_proj + self_edge_attr)
+        return out.view(-1, H * C) + self.bias
+
+    def dense_forward(self, x, edge_index, edge_attr, batch_mask, index):
+        """
+        the same computation as forward on the padded batch, index comes
+        from dense_index, the attention over nodes and the aggregation of
+        node features are batched matmuls, the edge features only enter
+        as attention bias and per edge values, molecules have no
+        duplicated edges so every edge has its own adjacency entry
+        """
+        node_pos, edge_batch, edge_pos = index
+        batch_size, max_node = batch_mask.shape
+        H, C = self.heads, self.out_channels
+
+        # lin_src and lin_dst are the same module, project x once
+        x_proj = self.lin_src(x).view(-1, H, C)
+        alpha_src = (x_proj * self.att_src).sum(dim=-1)
+        alpha_dst = (x_proj * self.att_dst).sum(dim=-1)
+
+        # att_edge folded into lin_edge, [edge_dim, H] instead of
+        # multiplying the [num_edges, H, C] projection
+        att_weight = self.lin_edge.weight.view(H, C, -1) * \
+            self.att_edge.view(H, C, 1)
+        att_bias = self.lin_edge.bias.view(H, C) * self.att_edge.view(H, C)
+        att_weight, att_bias = att_weight.sum(dim=1), att_bias.sum(dim=1)
+        # the logits in float32 under bf16 autocast, like the other paths
+        alpha_edge = F.linear(edge_attr, att_weight, att_bias).float()
+        alpha_loop = F.linear(self.self_edge, att_weight, att_bias).float()
+        edge_attr = self.lin_edge(edge_attr).view(-1, H, C)
+        self_edge_attr = self.lin_edge(self.self_edge).view(1, H, C)
+
+        # [batch, head, target, source] logits, -inf for missing edges,
+        # padded nodes keep their self loop so no row is fully masked
+        alpha = alpha_edge.new_full(
+            (batch_size, H, max_node, max_node), -math.inf
+        )
+        alpha.diagonal(dim1=-2, dim2=-1).copy_(alpha_loop.view(1, H, 1))
+        head = torch.arange(H, device=x.device)
+        alpha.view(batch_size, H, -1).index_put_(
+            (edge_batch.unsqueeze(-1), head, edge_pos.unsqueeze(-1)),
+            alpha_edge
+        )
+
+        alpha_src = self.to_dense(alpha_src, node_pos, batch_mask)
+        alpha_dst = self.to_dense(alpha_dst, node_pos, batch_mask)
+        alpha = alpha_dst.unsqueeze(-1) + alpha_src.unsqueeze(-2) + alpha
+        alpha = F.leaky_relu(alpha, self.negative_slope)
+        alpha = self.dropout_fun(torch.softmax(alpha, dim=-1))
+
+        x_dense = self.to_dense(x_proj, node_pos, batch_mask)
+        out = torch.matmul(alpha, x_dense).transpose(1, 2)
+        out = out.reshape(-1, H, C).index_select(0, node_pos)
+
+        # the edge features of the self loops and the real edges
+        loop_alpha = alpha.diagonal(dim1=-2, dim2=-1).transpose(1, 2)
+        loop_alpha = loop_alpha.reshape(-1, H).index_select(0, node_pos)
+        out = out + loop_alpha.unsqueeze(-1) * self_edge_attr
+        edge_alpha = alpha.view(batch_size, H, -1)[edge_batch, :, edge_pos]
+        out = out.index_add(
+            0, edge_index[1], edge_alpha.unsqueeze(-1) * edge_attr
+        )
+        return out.view(-1, H * C) + self.bias
+
+    def to_dense(self, x, node_pos, batch_mask):
+        # [num_nodes, heads, ...] to [batch, heads, max_node, ...]
+        batch_size, max_node = batch_mask.shape
+        result = x.new_zeros((batch_size * max_node, ) + x.shape[1:])
+        result.index_copy_(0, node_pos, x)
+        return result.view(batch_size, max_node, *x.shape[1:]).transpose(1, 2)
+
     def edge_update(self, alpha_j, alpha_i, edge_attr, index, ptr, size_i):
         edge_attr = edge_attr.view(-1, self.heads, self.out_channels)
         alpha_edge = (edge_attr * self.att_edge).sum(dim=-1)
         alpha = alpha_i + alpha_j + alpha_edge
 
-        alpha = F.leaky_relu(alpha, self.negative_slope)
+        # softmax in float32 under bf16 autocast
+        alpha = F.leaky_relu(alpha.float(), self.negative_slope)
         alpha = self.dropout_fun(sp_softmax(alpha, index, ptr, size_i))
         return alpha
 
@@ -0,0 +1,71 @@
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from data_utils import load_data
+from Dataset import RetroDataset, col_fn_retro
+
+
+def batch_bytes(graph):
+    compact, wide = 0, 0
+    for k, v in graph:
+        if not isinstance(v, torch.Tensor):
+            continue
+        compact += v.numel() * v.element_size()
+        # before the compact dtypes every integer tensor was int64
+        if v.dtype == torch.bool or v.is_floating_point():
+            wide += v.numel() * v.element_size()
+        else:
+            wide += v.numel() * 8
+    return compact, wide
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Batch memory benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset used for benchmark'
+    )
+    parser.add_argument(
+        '--bs', default=512, type=int,
+        help='the batch size'
+    )
+    parser.add_argument(
+        '--num_batch', default=20, type=int,
+        help='the number of batches measured'
+    )
+    parser.add_argument(
+        '--use_class', action='store_true',
+        help='include the reaction class tensors'
+    )
+    args = parser.parse_args()
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    data_set = RetroDataset(
+        prod_sm=prod, reat_sm=reac, aug_prob=0,
+        rxn_cls=rxn if args.use_class else None
+    )
+    loader = DataLoader(
+        data_set, collate_fn=col_fn_retro, batch_size=args.bs,
+        shuffle=False
+    )
+
+    compacts, wides = [], []
+    for idx, (graph, _) in enumerate(loader):
+        if idx >= args.num_batch:
+            break
+        compact, wide = batch_bytes(graph)
+        compacts.append(compact)
+        wides.append(wide)
+
+    compact, wide = np.mean(compacts), np.mean(wides)
+    print(f'[INFO] bytes per batch of {args.bs} graphs')
+    print(f'[int64]   {wide / 1024:.1f} KiB')
+    print(f'[compact] {compact / 1024:.1f} KiB')
+    print(f'[saved]   {(wide - compact) / 1024:.1f} KiB '
+          f'({(1 - compact / wide) * 100:.1f}%)')
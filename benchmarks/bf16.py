@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import pickle
+import time
+import numpy as np
+import torch
+from rdkit import RDLogger
+from torch.utils.data import DataLoader
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed, generate_tgt_mask, bf16_autocast
+from Dataset import RetroDataset, col_fn_retro
+from training import calc_trans_loss, preeval
+from inference_tools import beam_search_one
+from inference_one import make_graph_batch
+from utils.chemistry_parse import canonical_smiles, clear_map_number
+from benchmarks.dense_backend import best_time
+from benchmarks.decoder_depth import parse_config, parse_log, build_model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('bfloat16 autocast benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', type=str, default='',
+        help='the path of a json containing all tokens, for untrained models'
+    )
+    parser.add_argument(
+        '--log', type=str, default='',
+        help='the log-*.json of a trained model, its mod-*.pth and '
+        'token-*.pkl are loaded, untrained model if not given'
+    )
+    parser.add_argument('--bs', default=64, type=int)
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=6, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument(
+        '--num_products', default=10, type=int,
+        help='the number of test products decoded by beam search'
+    )
+    parser.add_argument('--beams', default=10, type=int)
+    parser.add_argument('--max_len', default=100, type=int)
+    args = parser.parse_args()
+
+    RDLogger.DisableLog('rdApp.*')
+    fix_seed(2023)
+    if args.log != '':
+        sizes = parse_log(args.log)
+        timestamp = os.path.basename(args.log)[4: -5]
+        base_dir = os.path.dirname(args.log)
+        with open(os.path.join(base_dir, f'token-{timestamp}.pkl'), 'rb') \
+                as Fin:
+            tokenizer = pickle.load(Fin)
+        model = build_model(
+            sizes, tokenizer.get_token_size(), sizes.use_class
+        )
+        model.load_state_dict(torch.load(
+            os.path.join(base_dir, f'mod-{timestamp}.pth'),
+            map_location='cpu'
+        ), strict=False)
+        use_class = sizes.use_class
+    else:
+        SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+        with open(args.token_path) as Fin:
+            tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+        sizes = parse_config(f'{args.n_layer}:{args.n_layer}', args)
+        model = build_model(sizes, tokenizer.get_token_size(), False)
+        use_class = False
+    pad_idx = tokenizer.token2idx['<PAD>']
+
+    reac, prod, rxn = load_data(args.data_path, 'test')
+    dataset = RetroDataset(
+        prod_sm=prod, reat_sm=reac, aug_prob=0,
+        rxn_cls=rxn if use_class else None
+    )
+    graph, tran = next(iter(DataLoader(
+        dataset, batch_size=args.bs, shuffle=True, collate_fn=col_fn_retro
+    )))
+    tops = torch.LongTensor(tokenizer.encode2d(tran))
+    trans_dec_ip, trans_dec_op = tops[:, :-1], tops[:, 1:]
+    trans_op_mask, diag_mask = generate_tgt_mask(
+        trans_dec_ip, tokenizer, '<PAD>'
+    )
+    num_token = (trans_dec_op != pad_idx).sum().item()
+
+    def train_step(bf16):
+        def wrapper():
+            model.zero_grad()
+            with bf16_autocast('cpu', bf16):
+                trans_logs = model(
+                    graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
+                    tgt_pad_mask=trans_op_mask
+                )
+            loss = calc_trans_loss(trans_logs, trans_dec_op, pad_idx)
+            loss.backward()
+            return loss.item()
+        return wrapper
+
+    model.train()
+    fp32_loss, bf16_loss = train_step(False)(), train_step(True)()
+    fp32_time, bf16_time = best_time(
+        [train_step(False), train_step(True)], args.repeat
+    )
+    print(f'[train, bs {args.bs}, {num_token} tokens] fp32 {fp32_time:.0f} '
+          f'ms ({num_token / fp32_time * 1e3:.0f} tokens/s)  bf16 '
+          f'{bf16_time:.0f} ms ({num_token / bf16_time * 1e3:.0f} tokens/s)'
+          f'  speedup {fp32_time / bf16_time:.2f}x  loss {fp32_loss:.4f} / '
+          f'{bf16_loss:.4f}')
+
+    # teacher forced accuracy on the test split
+    loader = DataLoader(
+        dataset, batch_size=args.bs, shuffle=False, collate_fn=col_fn_retro
+    )
+    accs = [preeval(
+        model=model, loader=loader, device=torch.device('cpu'),
+        tokenizer=tokenizer, pad_token='<PAD>', end_token='<END>', bf16=x
+    ) for x in [False, True]]
+    print(f'[eval] teacher forced accuracy fp32 {accs[0]:.4f}  bf16 '
+          f'{accs[1]:.4f}')
+
+    results = {False: ([], [], []), True: ([], [], [])}
+    for idx in range(args.num_products):
+        rxn_cls = rxn[idx] if use_class else None
+        graph = make_graph_batch(clear_map_number(prod[idx]), rxn_cls)
+        start_token = f'<RXN>_{rxn_cls}' if use_class else '<CLS>'
+        answer = clear_map_number(reac[idx])
+        for bf16 in [False, True]:
+            start = time.perf_counter()
+            preds, probs = beam_search_one(
+                model, tokenizer, graph, 'cpu', max_len=args.max_len,
+                size=args.beams, begin_token=start_token,
+                end_token='<END>', pen_para=0, validate=False, bf16=bf16
+            )
+            times, topk, top1 = results[bf16]
+            times.append(time.perf_counter() - start)
+            preds = [canonical_smiles(x) for x in preds]
+            topk.append([answer in preds[:1], answer in preds])
+            top1.append(preds[0] if len(preds) > 0 else '')
+
+    same = np.mean([
+        x == y for x, y in zip(results[False][2], results[True][2])
+    ])
+    for bf16, (times, topk, top1) in results.items():
+        topk = np.mean(topk, axis=0)
+        print(f'[beam search, {"bf16" if bf16 else "fp32"}] '
+              f'{np.mean(times) * 1e3:.0f} ms/product  top-1 {topk[0]:.3f}'
+              f'  top-k {topk[1]:.3f}')
+    print(f'[beam search] bf16 top-1 equal to fp32 for {same:.1%} products')
@@ -0,0 +1,130 @@
+import argparse
+import time
+import random
+import numpy as np
+import torch
+from torch_geometric.data import Data as GData
+
+from data_utils import load_data
+from Dataset import col_fn_retro
+from utils.chemistry_parse import clear_map_number
+from utils.graph_utils import fast_smiles2graph
+
+
+def legacy_col_fn_retro(data_batch):
+    # the per-graph implementation col_fn_retro used to have
+    batch_size, max_node = len(data_batch), 0
+    edge_idxes, edge_feats, node_feats, lstnode = [], [], [], 0
+    batch, ptr, reats, node_per_graph = [], [0], [], []
+    node_rxn, edge_rxn = [], []
+    for idx, data in enumerate(data_batch):
+        graph, ret, rxn = data
+        num_nodes = graph['num_nodes']
+        num_edges = graph['edge_index'].shape[1]
+        reats.append(ret)
+
+        edge_idxes.append(graph['edge_index'] + lstnode)
+        edge_feats.append(graph['edge_feat'])
+        node_feats.append(graph['node_feat'])
+
+        lstnode += num_nodes
+        max_node = max(max_node, num_nodes)
+        node_per_graph.append(num_nodes)
+        batch.append(np.ones(num_nodes, dtype=np.int64) * idx)
+        ptr.append(lstnode)
+
+        if rxn is not None:
+            node_rxn.append(np.full(num_nodes, rxn, dtype=np.uint8))
+            edge_rxn.append(np.full(num_edges, rxn, dtype=np.uint8))
+
+    result = {
+        'edge_index': np.concatenate(edge_idxes, axis=-1),
+        'edge_attr': np.concatenate(edge_feats, axis=0),
+        'batch': np.concatenate(batch, axis=0),
+        'x': np.concatenate(node_feats, axis=0),
+        'ptr': np.array(ptr, dtype=np.int64)
+    }
+
+    result = {k: torch.from_numpy(v) for k, v in result.items()}
+    result['num_nodes'] = lstnode
+
+    all_batch_mask = torch.zeros((batch_size, max_node))
+    for idx, mk in enumerate(node_per_graph):
+        all_batch_mask[idx, :mk] = 1
+    result['batch_mask'] = all_batch_mask.bool()
+
+    if len(node_rxn) > 0:
+        node_rxn = np.concatenate(node_rxn, axis=0)
+        edge_rxn = np.concatenate(edge_rxn, axis=0)
+        result['node_rxn'] = torch.from_numpy(node_rxn)
+        result['edge_rxn'] = torch.from_numpy(edge_rxn)
+
+    return GData(**result), reats
+
+
+def check_same(ref, res):
+    keys = set(ref[0].keys()) - {'node_rxn', 'edge_rxn'}
+    assert keys == set(res[0].keys()) - {'rxn_class'}, 'fields mismatch'
+    if 'rxn_class' in res[0]:
+        # the classes are now stored per graph
+        rxn_class = res[0].rxn_class
+        edge_batch = res[0].batch[res[0].edge_index[0].long()]
+        assert torch.equal(ref[0].node_rxn, rxn_class[res[0].batch]), \
+            'value of node_rxn mismatch'
+        assert torch.equal(ref[0].edge_rxn, rxn_class[edge_batch]), \
+            'value of edge_rxn mismatch'
+    for k in keys:
+        x, y = ref[0][k], res[0][k]
+        if isinstance(x, torch.Tensor):
+            assert x.dtype == y.dtype, f'dtype of {k} mismatch'
+            assert torch.equal(x, y), f'value of {k} mismatch'
+        else:
+            assert x == y, f'value of {k} mismatch'
+    assert ref[1] == res[1], 'tokens mismatch'
+
+
+def timeit(fun, data_batch, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun(data_batch)
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Collate benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset used for benchmark'
+    )
+    parser.add_argument(
+        '--batch_sizes', default=[32, 128, 512, 2048], type=int, nargs='+',
+        help='the batch sizes to be benchmarked'
+    )
+    parser.add_argument(
+        '--repeat', default=20, type=int,
+        help='the number of repeats for every batch size'
+    )
+    parser.add_argument(
+        '--use_class', action='store_true',
+        help='include the reaction class tensors'
+    )
+    args = parser.parse_args()
+
+    random.seed(2023)
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    samples = []
+    for x, y in zip(prod, rxn):
+        graph = fast_smiles2graph(clear_map_number(x))
+        samples.append((graph, ['<CLS>'], y if args.use_class else None))
+
+    for bs in args.batch_sizes:
+        data_batch = [random.choice(samples) for _ in range(bs)]
+        check_same(legacy_col_fn_retro(data_batch), col_fn_retro(data_batch))
+        old_time = timeit(legacy_col_fn_retro, data_batch, args.repeat)
+        new_time = timeit(col_fn_retro, data_batch, args.repeat)
+        print(f'[bs {bs}] legacy {old_time:.3f} ms  vectorized '
+              f'{new_time:.3f} ms  speedup {old_time / new_time:.2f}x')
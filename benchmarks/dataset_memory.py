@@ -0,0 +1,85 @@
+import argparse
+import gc
+import multiprocessing
+import os
+import time
+
+from data_utils import load_data, load_data_columnar, convert_to_columnar
+
+
+def memory_info():
+    # Rss and Private_Dirty in MiB, Private_Dirty counts the pages a
+    # forked process has copied from its parent
+    result = {}
+    with open('/proc/self/smaps_rollup') as Fin:
+        for line in Fin:
+            key = line.split(':')[0]
+            if key in ['Rss', 'Private_Dirty']:
+                result[key] = int(line.split()[1]) / 1024
+    return result
+
+
+def touch_worker(data, queue):
+    before = memory_info()
+    total = 0
+    for reac, prod in zip(data[0], data[1]):
+        total += len(reac) + len(prod)
+    after = memory_info()
+    queue.put({k: after[k] - before[k] for k in after})
+
+
+def measure(loader_fn, data_dir, part, num_proc):
+    gc.collect()
+    base = memory_info()
+    start = time.perf_counter()
+    data = loader_fn(data_dir, part)
+    load_time = time.perf_counter() - start
+    loaded = memory_info()
+
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    procs = [
+        ctx.Process(target=touch_worker, args=(data, queue))
+        for _ in range(num_proc)
+    ]
+    for p in procs:
+        p.start()
+    child = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    child_dirty = max(x['Private_Dirty'] for x in child)
+    return load_time, loaded['Rss'] - base['Rss'], child_dirty
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Dataset memory benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='train', type=str,
+        help='the split of dataset used for benchmark'
+    )
+    parser.add_argument(
+        '--num_proc', default=4, type=int,
+        help='the number of forked processes reading the data, '
+        'mimicking dataloader workers'
+    )
+    args = parser.parse_args()
+
+    column_dir = os.path.join(args.data_path, 'columnar')
+    if os.path.exists(os.path.join(column_dir, f'{args.part}_class.npy')):
+        print('[INFO] columnar files exist, conversion time not measured')
+    else:
+        start = time.perf_counter()
+        convert_to_columnar(args.data_path, args.part)
+        print(f'[convert] {time.perf_counter() - start:.2f} s (once)')
+
+    for name, fun in [('csv', load_data), ('columnar', load_data_columnar)]:
+        load_time, rss, dirty = measure(
+            fun, args.data_path, args.part, args.num_proc
+        )
+        print(f'[{name}] load {load_time:.3f} s, parent rss +{rss:.1f} MiB'
+              f', copied per worker after one pass {dirty:.1f} MiB')
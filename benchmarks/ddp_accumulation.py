@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import copy
+import json
+import time
+import torch
+import torch.distributed as torch_dist
+import torch.multiprocessing as torch_mp
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed, generate_tgt_mask
+from torch.utils.data import DataLoader, Subset
+from Dataset import RetroDataset, col_fn_retro
+from model import PretrainModel, PositionalEncoding
+from sparse_backBone import GATBase
+from training import calc_trans_loss
+from checkpoint_utils import get_rng_state
+from ddp_training import setup_cpu_rank, ddp_pretrain, MetricCollector
+
+
+# name: (all-reduce on every micro-batch, static_graph, bucket_cap_mb,
+# gradient_as_bucket_view)
+CONFIGS = {
+    'sync_every': (True, False, 25, False),
+    'no_sync': (False, False, 25, False),
+    'no_sync+static': (False, True, 25, False),
+    'no_sync+static+bucket': (False, True, 100, True),
+}
+
+
+def build_model(args, tokenizer, dropout=0.1):
+    GNN = GATBase(
+        num_layers=args.n_layer, dropout=dropout, num_heads=args.heads,
+        embedding_dim=args.dim
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=args.dim, nhead=args.heads, batch_first=True,
+        dim_feedforward=args.dim * 2, dropout=dropout
+    )
+    return PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, args.n_layer),
+        d_model=args.dim, pos_enc=PositionalEncoding(args.dim, dropout)
+    )
+
+
+def init_rank(rank, args):
+    torch_dist.init_process_group(
+        backend='gloo', init_method=f'tcp://127.0.0.1:{args.port}',
+        world_size=args.num_ranks, rank=rank
+    )
+    setup_cpu_rank(rank, args.num_ranks, args.threads_per_rank)
+    fix_seed(2023 + rank)
+
+
+def worker(rank, args, tokenizer, config, accu, queue):
+    sync_every, static_graph, bucket_cap_mb, bucket_view = CONFIGS[config]
+    init_rank(rank, args)
+    model = build_model(args, tokenizer)
+    model = torch.nn.parallel.DistributedDataParallel(
+        model, find_unused_parameters=not static_graph,
+        static_graph=static_graph, bucket_cap_mb=bucket_cap_mb,
+        gradient_as_bucket_view=bucket_view
+    )
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+    batches = []
+    for idx in range(accu):
+        start = (rank * accu + idx) * args.bs
+        graph, tran = col_fn_retro([
+            dataset[x % len(dataset)] for x in range(start, start + args.bs)
+        ])
+        tops = torch.LongTensor(tokenizer.encode2d(tran))
+        trans_op_mask, diag_mask = generate_tgt_mask(
+            tops[:, :-1], tokenizer, '<PAD>'
+        )
+        batches.append((graph, tops, trans_op_mask, diag_mask))
+    pad_idx = tokenizer.token2idx['<PAD>']
+
+    def step(sync_every):
+        # one optimizer step over accu micro-batches, as in ddp_pretrain
+        for idx, (graph, tops, trans_op_mask, diag_mask) in \
+                enumerate(batches):
+            sync = sync_every or idx == accu - 1
+            with contextlib.nullcontext() if sync else model.no_sync():
+                trans_logs = model(
+                    graphs=graph, tgt=tops[:, :-1], tgt_mask=diag_mask,
+                    tgt_pad_mask=trans_op_mask
+                )
+                loss = calc_trans_loss(trans_logs, tops[:, 1:], pad_idx)
+                (loss / accu).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    # static graph is recorded in the first iteration, which all-reduces
+    step(True)
+    torch_dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step(sync_every)
+    torch_dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        queue.put(elapsed)
+    torch_dist.destroy_process_group()
+
+
+def resume_worker(rank, args, tokenizer, accu, queue):
+    """
+    the step of ddp_pretrain resumed in the middle of an epoch with a new
+    static graph wrapper, its first micro-batch is not the first of an
+    accumulation, against the same step syncing every micro-batch. the
+    update of sgd with lr 1 is the averaged gradient
+    """
+    init_rank(rank, args)
+    # no dropout, the two runs draw the same outputs
+    module = build_model(args, tokenizer, dropout=0)
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+    start = rank * accu * args.bs
+    loader = DataLoader(
+        Subset(dataset, range(start, start + accu * args.bs)),
+        batch_size=args.bs, shuffle=False, collate_fn=col_fn_retro
+    )
+    params = []
+    for static_graph in [False, True]:
+        model = torch.nn.parallel.DistributedDataParallel(
+            copy.deepcopy(module), find_unused_parameters=not static_graph,
+            static_graph=static_graph
+        )
+        resume = {
+            'step': accu, 'rng': get_rng_state(),
+            'losses': MetricCollector('loss').state_dict()
+        } if static_graph else None
+        ddp_pretrain(
+            loader=loader, model=model, device='cpu', tokenizer=tokenizer,
+            optimizer=torch.optim.SGD(model.parameters(), lr=1.0),
+            pad_token='<PAD>', warmup=False, accu=accu, resume=resume
+        )
+        params.append(list(model.module.parameters()))
+    if rank == 0:
+        queue.put(max(
+            (x - y).abs().max().item() for x, y in zip(*params)
+        ))
+    torch_dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('DDP gradient accumulation benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--part', default='train', type=str,
+        help='the split of dataset the reactions come from'
+    )
+    parser.add_argument(
+        '--configs', default=list(CONFIGS.keys()), type=str, nargs='+',
+        choices=list(CONFIGS.keys()), help='the ddp settings to compare'
+    )
+    parser.add_argument(
+        '--accus', default=[1, 2, 4, 8], type=int, nargs='+',
+        help='the gradient accumulation factors'
+    )
+    parser.add_argument('--num_ranks', default=2, type=int)
+    parser.add_argument('--threads_per_rank', default=0, type=int)
+    parser.add_argument('--bs', default=16, type=int)
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=4, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument('--steps', default=3, type=int)
+    parser.add_argument('--port', default=12355, type=int)
+    parser.add_argument(
+        '--resume_check', action='store_true',
+        help='check a static graph step resumed in the middle of an '
+        'epoch against syncing every micro-batch instead'
+    )
+    args = parser.parse_args()
+
+    # built once, the order of the special tokens depends on the hash
+    # seed of the process
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+
+    ctx = torch_mp.get_context('spawn')
+    if args.resume_check:
+        print('| accu | max abs diff of the resumed static graph step |')
+        print('|---|---|')
+        for accu in args.accus:
+            queue = ctx.Queue()
+            torch_mp.spawn(
+                resume_worker, nprocs=args.num_ranks,
+                args=(args, tokenizer, accu, queue)
+            )
+            print(f'| {accu} | {queue.get():.3g} |')
+    else:
+        print(f'[{args.num_ranks} gloo ranks, bs {args.bs} per rank, dim '
+              f'{args.dim}, {args.n_layer} layers, samples/s]')
+        print('| accu | ' + ' | '.join(args.configs) + ' |')
+        print('|---' * (len(args.configs) + 1) + '|')
+        for accu in args.accus:
+            row = []
+            for config in args.configs:
+                queue = ctx.Queue()
+                torch_mp.spawn(
+                    worker, nprocs=args.num_ranks,
+                    args=(args, tokenizer, config, accu, queue)
+                )
+                elapsed = queue.get()
+                samples = args.steps * accu * args.bs * args.num_ranks
+                row.append(f'{samples / elapsed:.1f}')
+            print(f'| {accu} | ' + ' | '.join(row) + ' |')
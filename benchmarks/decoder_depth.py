@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import pickle
+import time
+import numpy as np
+import torch
+from rdkit import RDLogger
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed
+from model import PretrainModel, PositionalEncoding, fill_model_sizes
+from sparse_backBone import GATBase
+from inference_tools import beam_search_one
+from inference_one import make_graph_batch
+from utils.chemistry_parse import canonical_smiles, clear_map_number
+
+SIZE_KEYS = [
+    'enc_layer', 'dec_layer', 'enc_dim', 'dec_dim',
+    'enc_heads', 'dec_heads', 'enc_ffn', 'dec_ffn'
+]
+
+
+def parse_config(config, args):
+    # enc_layer:dec_layer[:enc_dim:dec_dim], the rest from the shared args
+    values = [int(x) for x in config.split(':')]
+    sizes = argparse.Namespace(
+        n_layer=args.n_layer, dim=args.dim, heads=args.heads,
+        **{k: -1 for k in SIZE_KEYS}
+    )
+    for key, value in zip(SIZE_KEYS, values):
+        setattr(sizes, key, value)
+    return fill_model_sizes(sizes)
+
+
+def parse_log(log_path):
+    # the args of a training log, logs older than the separate sizes
+    # only have n_layer, dim and heads
+    with open(log_path) as Fin:
+        log_args = json.load(Fin)['args']
+    for key in SIZE_KEYS:
+        log_args.setdefault(key, -1)
+    return fill_model_sizes(argparse.Namespace(**log_args))
+
+
+def build_model(sizes, token_size, use_class):
+    GNN = GATBase(
+        num_layers=sizes.enc_layer, dropout=0,
+        embedding_dim=sizes.enc_dim, num_heads=sizes.enc_heads,
+        n_class=11 if use_class else None, edge_hidden=sizes.enc_ffn
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=sizes.dec_dim, nhead=sizes.dec_heads, batch_first=True,
+        dim_feedforward=sizes.dec_ffn, dropout=0
+    )
+    return PretrainModel(
+        token_size=token_size, encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, sizes.dec_layer),
+        d_model=sizes.dec_dim, pos_enc=PositionalEncoding(sizes.dec_dim, 0),
+        memory_dim=sizes.enc_dim
+    ).eval()
+
+
+def count_params(module):
+    return sum(x.numel() for x in module.parameters()) / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Encoder/decoder depth benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', type=str, default='',
+        help='the path of a json containing all tokens, for --configs'
+    )
+    parser.add_argument(
+        '--configs', default=['8:8', '10:4', '12:2'], type=str, nargs='*',
+        help='untrained models as enc_layer:dec_layer[:enc_dim:dec_dim], '
+        'only the latency is measured'
+    )
+    parser.add_argument(
+        '--logs', default=[], type=str, nargs='*',
+        help='the log-*.json of trained models, the mod-*.pth and '
+        'token-*.pkl next to them are loaded and evaluated'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=8, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument(
+        '--num_products', default=20, type=int,
+        help='the number of test products decoded for every model'
+    )
+    parser.add_argument('--beams', default=10, type=int)
+    parser.add_argument(
+        '--max_len', default=300, type=int,
+        help='the max length of decoding, untrained models seldom '
+        'predict <END> and decode up to it'
+    )
+    args = parser.parse_args()
+
+    # the predictions of untrained models are mostly invalid smiles
+    RDLogger.DisableLog('rdApp.*')
+    fix_seed(2023)
+    reac, prod, rxn = load_data(args.data_path, 'test')
+    reac, prod = reac[:args.num_products], prod[:args.num_products]
+    rxn = rxn[:args.num_products]
+
+    models = []
+    if len(args.configs) > 0:
+        assert args.token_path != '', 'configs require the token list'
+        SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+        with open(args.token_path) as Fin:
+            tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+        for config in args.configs:
+            sizes = parse_config(config, args)
+            model = build_model(sizes, tokenizer.get_token_size(), False)
+            models.append((config, sizes, model, tokenizer, False))
+
+    for log_path in args.logs:
+        sizes = parse_log(log_path)
+        timestamp = os.path.basename(log_path)[4: -5]
+        base_dir = os.path.dirname(log_path)
+        with open(os.path.join(base_dir, f'token-{timestamp}.pkl'), 'rb') \
+                as Fin:
+            tokenizer = pickle.load(Fin)
+        model = build_model(
+            sizes, tokenizer.get_token_size(), sizes.use_class
+        )
+        weight = torch.load(
+            os.path.join(base_dir, f'mod-{timestamp}.pth'),
+            map_location='cpu'
+        )
+        model.load_state_dict(weight, strict=False)
+        models.append((log_path, sizes, model, tokenizer, sizes.use_class))
+
+    print('| model | enc layer x dim | dec layer x dim | params (M) '
+          '| decode ms/product | top-1 | top-k |')
+    print('|---|---|---|---|---|---|---|')
+    for name, sizes, model, tokenizer, use_class in models:
+        times, topk = [], []
+        for reac_smi, prod_smi, rxn_cls in zip(reac, prod, rxn):
+            start_token = f'<RXN>_{rxn_cls}' if use_class else '<CLS>'
+            graph = make_graph_batch(
+                clear_map_number(prod_smi),
+                rxn_cls if use_class else None
+            )
+            start = time.perf_counter()
+            preds, probs = beam_search_one(
+                model, tokenizer, graph, 'cpu', max_len=args.max_len,
+                size=args.beams, begin_token=start_token,
+                end_token='<END>', pen_para=0, validate=False
+            )
+            times.append(time.perf_counter() - start)
+            answer = clear_map_number(reac_smi)
+            preds = [canonical_smiles(x) for x in preds]
+            topk.append([answer in preds[:1], answer in preds])
+
+        topk = np.mean(topk, axis=0)
+        print(f'| {name} | {sizes.enc_layer} x {sizes.enc_dim} '
+              f'| {sizes.dec_layer} x {sizes.dec_dim} '
+              f'| {count_params(model):.2f} '
+              f'| {np.mean(times) * 1e3:.1f} '
+              f'| {topk[0]:.3f} | {topk[1]:.3f} |')
@@ -0,0 +1,119 @@
+import argparse
+import random
+import time
+import torch
+
+from data_utils import load_data, fix_seed
+from Dataset import col_fn_retro
+from sparse_backBone import GATBase
+from utils.chemistry_parse import clear_map_number
+from utils.graph_utils import fast_smiles2graph
+from benchmarks.encoder import max_diff
+
+
+def make_batch(graphs, batch_size, similar_size):
+    # similar_size takes neighbours in the list sorted by atom number,
+    # which keeps the padding of the dense batch small
+    if similar_size:
+        start = random.randint(0, max(len(graphs) - batch_size, 0))
+        batch = graphs[start: start + batch_size]
+    else:
+        batch = [random.choice(graphs) for _ in range(batch_size)]
+    return col_fn_retro([(x, [], None) for x in batch])[0]
+
+
+def padded_ratio(model, G):
+    # the quantity GATBase.select_backend compares with dense_ratio
+    batch_size, max_node = G.batch_mask.shape
+    padded = batch_size * max_node * max_node * model.num_heads
+    sparse = (G.edge_index.shape[1] + G.x.shape[0]) * model.embedding_dim
+    return padded / sparse
+
+
+def best_time(funs, repeat):
+    # interleaved runs, the fastest one is the least disturbed
+    result = [float('inf')] * len(funs)
+    for _ in range(repeat):
+        for idx, fun in enumerate(funs):
+            start = time.perf_counter()
+            fun()
+            result[idx] = min(result[idx], time.perf_counter() - start)
+    return [x * 1e3 for x in result]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Dense backend benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset the molecules come from'
+    )
+    parser.add_argument(
+        '--batch_sizes', default=[1, 4, 16, 64, 256], type=int, nargs='+',
+        help='the numbers of molecules per batch'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=8, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument(
+        '--train', action='store_true',
+        help='time forward and backward in train mode'
+    )
+    args = parser.parse_args()
+
+    fix_seed(2023)
+    models = {}
+    for backend in ['fused', 'dense']:
+        models[backend] = GATBase(
+            num_layers=args.n_layer, num_heads=args.heads,
+            embedding_dim=args.dim, dropout=0, backend=backend
+        )
+        models[backend].load_state_dict(models['fused'].state_dict())
+        models[backend].train(args.train)
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    graphs = [fast_smiles2graph(clear_map_number(x)) for x in prod]
+    graphs.sort(key=lambda x: x['num_nodes'])
+
+    results = []
+    for bs in args.batch_sizes:
+        for similar_size in [False, True]:
+            G = make_batch(graphs, bs, similar_size)
+
+            def run(model):
+                def wrapper():
+                    with torch.set_grad_enabled(args.train):
+                        result = model(G)
+                        if args.train:
+                            sum(x.sum() for x in result).backward()
+                return wrapper
+
+            with torch.no_grad():
+                diff = max_diff(models['fused'](G), models['dense'](G))
+            sparse_time, dense_time = best_time(
+                [run(models['fused']), run(models['dense'])], args.repeat
+            )
+            ratio = padded_ratio(models['dense'], G)
+            results.append((ratio, sparse_time, dense_time))
+            print(f'[bs {bs}, max_node {G.batch_mask.shape[1]}, '
+                  f'{"similar" if similar_size else "random"} sizes] '
+                  f'ratio {ratio:.3f}  fused {sparse_time:.1f} ms  dense '
+                  f'{dense_time:.1f} ms  speedup '
+                  f'{sparse_time / dense_time:.2f}x  max abs diff {diff:.2e}')
+
+    # the largest ratio below which dense is never slower
+    crossover = None
+    for ratio, sparse_time, dense_time in sorted(results):
+        if dense_time > sparse_time:
+            break
+        crossover = ratio
+    if crossover is None:
+        print('[INFO] fused is faster for every batch measured, '
+              'keep --dense_ratio 0')
+    else:
+        print(f'[INFO] dense is faster up to ratio {crossover:.3f}, '
+              f'use --gnn_backend auto --dense_ratio {crossover:.3f}')
@@ -0,0 +1,78 @@
+import argparse
+import torch
+
+from data_utils import load_data, fix_seed
+from Dataset import col_fn_retro
+from sparse_backBone import SparseAtomEncoder, SparseBondEncoder
+from utils.chemistry_parse import clear_map_number
+from utils.graph_utils import fast_smiles2graph
+from benchmarks.encoder import timeit
+
+
+def legacy_encode(encoder, embedding, feat, rxn_class):
+    # per column lookups, then the class embedding of every element
+    # concatenated and projected, as the encoders used to do
+    result = embedding(feat.long())
+    if rxn_class is not None:
+        class_emb = encoder.rxn_class_emb(rxn_class.long())
+        result = encoder.lin(torch.cat([class_emb, result], dim=-1))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Embedding benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset the molecules come from'
+    )
+    parser.add_argument(
+        '--bs', default=512, type=int,
+        help='the number of molecules per batch'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument(
+        '--use_class', action='store_true',
+        help='condition the embeddings on the reaction class'
+    )
+    args = parser.parse_args()
+
+    fix_seed(2023)
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    data_batch = [
+        (fast_smiles2graph(clear_map_number(x)), [], y)
+        for x, y in zip(prod[:args.bs], rxn[:args.bs])
+    ]
+    G = col_fn_retro(data_batch)[0] if args.use_class else \
+        col_fn_retro([(x, y, None) for x, y, _ in data_batch])[0]
+    n_class = 11 if args.use_class else None
+    rxn_class = G.get('rxn_class', None)
+    edge_batch = G.batch[G.edge_index[0].long()]
+
+    atom = SparseAtomEncoder(args.dim, n_class)
+    bond = SparseBondEncoder(args.dim, n_class)
+    cases = {
+        'atom': (atom, atom.atom_encoder, G.x, G.batch),
+        'bond': (bond, bond.bond_encoder, G.edge_attr, edge_batch)
+    }
+    for name, (encoder, embedding, feat, index) in cases.items():
+        # the per element classes the batches used to carry
+        element_class = None if rxn_class is None else rxn_class[index]
+
+        def legacy():
+            return legacy_encode(encoder, embedding, feat, element_class)
+
+        def fused():
+            return encoder(feat, rxn_class, index)
+
+        with torch.no_grad():
+            diff = (legacy() - fused()).abs().max().item()
+            old_time = timeit(legacy, args.repeat)
+            new_time = timeit(fused, args.repeat)
+        print(f'[{name}, {feat.shape[0]} rows] legacy {old_time:.2f} ms  '
+              f'fused {new_time:.2f} ms  speedup {old_time / new_time:.2f}x'
+              f'  max abs diff {diff:.2e}')
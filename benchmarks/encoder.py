@@ -0,0 +1,154 @@
+import argparse
+import functools
+import random
+import time
+import torch
+
+from data_utils import load_data, fix_seed
+from Dataset import col_fn_retro
+from sparse_backBone import GATBase
+from utils.chemistry_parse import clear_map_number
+from utils.graph_utils import fast_smiles2graph
+
+
+def legacy_conv_forward(conv, x, edge_index, edge_attr):
+    # SelfLoopGATConv.forward before the self loops were shared
+    num_nodes = x.shape[0]
+    self_edges = torch.Tensor([(i, i) for i in range(num_nodes)])
+    self_edges = self_edges.T.to(edge_index)
+    edge_index = torch.cat([edge_index, self_edges], dim=1)
+    real_edge_attr = torch.cat([
+        edge_attr, conv.self_edge.repeat(num_nodes, 1)
+    ], dim=0)
+
+    H, C = conv.heads, conv.out_channels
+    x_src = conv.lin_src(x).view(-1, H, C)
+    x_dst = conv.lin_dst(x).view(-1, H, C)
+    edge_attr = conv.lin_edge(real_edge_attr)
+
+    alpha_src = (x_src * conv.att_src).sum(dim=-1)
+    alpha_dst = (x_dst * conv.att_dst).sum(dim=-1)
+    alpha = conv.edge_updater(
+        edge_index, alpha=(alpha_src, alpha_dst), edge_attr=edge_attr
+    )
+    out = conv.propagate(
+        edge_index, x=(x_src, x_dst), alpha=alpha, size=None,
+        edge_attr=edge_attr.view(-1, H, C)
+    )
+    return out.view(-1, H * C) + conv.bias
+
+
+def legacy_forward(model, G):
+    edge_index = G.edge_index.long()
+    rxn_class = G.get('rxn_class', None)
+    edge_batch = None if rxn_class is None else G.batch[edge_index[0]]
+    node_feats = model.atom_encoder(G.x, rxn_class, G.batch)
+    edge_feats = model.bond_encoder(G.edge_attr, rxn_class, edge_batch)
+    for layer in range(model.num_layers):
+        conv_res = model.batch_norms[layer](legacy_conv_forward(
+            model.convs[layer], node_feats, edge_index, edge_feats
+        ))
+        node_feats = model.dropout_fun(torch.relu(conv_res)) + node_feats
+        # SparseEdgeUpdateLayer with the concatenated input
+        edge_layer = model.edge_update[layer]
+        node_i = node_feats[edge_index[0]]
+        node_j = node_feats[edge_index[1]]
+        x = torch.cat([node_i, node_j, edge_feats], dim=-1)
+        edge_feats = torch.relu(edge_layer.mlp(x) + edge_feats)
+    return node_feats, edge_feats
+
+
+def make_batches(data_path, part, batch_sizes):
+    reac, prod, rxn = load_data(data_path, part)
+    graphs = [fast_smiles2graph(clear_map_number(x)) for x in prod]
+    batches = {}
+    for bs in batch_sizes:
+        data_batch = [(random.choice(graphs), [], None) for _ in range(bs)]
+        batches[bs] = col_fn_retro(data_batch)[0]
+    return batches
+
+
+def saved_activations(fun, model):
+    # bytes of the tensors autograd keeps for backward, counted once
+    # per storage, parameters excluded
+    params = set(x.data_ptr() for x in model.parameters())
+    storages = {}
+
+    def pack(x):
+        storage = x.storage()
+        if storage.data_ptr() not in params:
+            storages[storage.data_ptr()] = storage.size() * x.element_size()
+        return x
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        fun()
+    return sum(storages.values()) / 1024 / 1024
+
+
+def timeit(fun, repeat):
+    fun()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fun()
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+def max_diff(x, y):
+    return max((a - b).abs().max().item() for a, b in zip(x, y))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Encoder benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset the molecules come from'
+    )
+    parser.add_argument(
+        '--batch_sizes', default=[64, 256, 1024], type=int, nargs='+',
+        help='the numbers of molecules per batch'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=8, type=int)
+    parser.add_argument('--heads', default=8, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument(
+        '--train', action='store_true',
+        help='time forward and backward in train mode'
+    )
+    args = parser.parse_args()
+
+    fix_seed(2023)
+    model = GATBase(
+        num_layers=args.n_layer, num_heads=args.heads,
+        embedding_dim=args.dim, dropout=0
+    )
+    model = model.train() if args.train else model.eval()
+    batches = make_batches(args.data_path, args.part, args.batch_sizes)
+
+    for bs, G in batches.items():
+        def run(fun):
+            def wrapper():
+                with torch.set_grad_enabled(args.train):
+                    result = fun(G)
+                    if args.train:
+                        sum(x.sum() for x in result).backward()
+                return result
+            return wrapper
+
+        legacy = functools.partial(legacy_forward, model)
+        with torch.no_grad():
+            diff = max_diff(legacy(G), model(G))
+        old_time = timeit(run(legacy), args.repeat)
+        new_time = timeit(run(model), args.repeat)
+        print(f'[bs {bs}, {G.num_nodes} nodes] legacy {old_time:.1f} ms  '
+              f'current {new_time:.1f} ms  speedup {old_time / new_time:.2f}x'
+              f'  max abs diff {diff:.2e}')
+        if args.train:
+            old_mem = saved_activations(run(legacy), model)
+            new_mem = saved_activations(run(model), model)
+            print(f'    saved activations legacy {old_mem:.1f} MiB  '
+                  f'current {new_mem:.1f} MiB')
@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas
+from tqdm import tqdm
+
+from utils.chemistry_parse import clear_map_number
+from utils.graph_utils import (
+    smiles2graph, fast_smiles2graph, GraphFeaturizer
+)
+
+
+def load_smiles(data_dir, part, max_num):
+    df = pandas.read_csv(
+        os.path.join(data_dir, f'canonicalized_raw_{part}.csv')
+    )
+    answer = []
+    for resu in df['reactants>reagents>production'][:max_num]:
+        rea, prd = resu.strip().split('>>')
+        answer.append(prd)
+        answer.extend(clear_map_number(rea).split('.'))
+    return answer
+
+
+def check_same(smiles):
+    for smi in tqdm(smiles, desc='check'):
+        for amap in [False, True]:
+            ref = smiles2graph(smi, with_amap=amap)
+            res = fast_smiles2graph(smi, with_amap=amap)
+            if amap:
+                assert ref[1] == res[1], f'amap mismatch for {smi}'
+                ref, res = ref[0], res[0]
+            assert ref['num_nodes'] == res['num_nodes'], smi
+            for k in ['edge_index', 'edge_feat', 'node_feat']:
+                assert ref[k].shape == res[k].shape, f'{k} {smi}'
+                assert np.all(ref[k] == res[k]), f'{k} {smi}'
+
+
+def timeit(fun, smiles, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for smi in smiles:
+            fun(smi)
+    return (time.perf_counter() - start) / (repeat * len(smiles)) * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Featurizer benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset used for benchmark'
+    )
+    parser.add_argument(
+        '--max_num', default=2000, type=int,
+        help='the max number of reactions used'
+    )
+    parser.add_argument(
+        '--repeat', default=3, type=int,
+        help='the number of passes over the molecules, mimicking epochs'
+    )
+    args = parser.parse_args()
+
+    smiles = load_smiles(args.data_path, args.part, args.max_num)
+    print(f'[INFO] {len(smiles)} molecules, {len(set(smiles))} unique')
+    check_same(smiles)
+    print('[INFO] output values are identical')
+
+    featurizer = GraphFeaturizer(cache_size=len(smiles))
+    base_time = timeit(smiles2graph, smiles, args.repeat)
+    fast_time = timeit(fast_smiles2graph, smiles, args.repeat)
+    cache_time = timeit(featurizer, smiles, args.repeat)
+
+    print(f'[smiles2graph]      {base_time:.2f} us / mol')
+    print(f'[fast_smiles2graph] {fast_time:.2f} us / mol')
+    print(f'[GraphFeaturizer]   {cache_time:.2f} us / mol, hits '
+          f'{featurizer.hits} misses {featurizer.misses}')
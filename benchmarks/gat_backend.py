@@ -0,0 +1,80 @@
+import argparse
+import torch
+
+from data_utils import fix_seed
+from sparse_backBone import GATBase
+from GATconv import add_self_loops, to_csr
+from benchmarks.encoder import make_batches, max_diff, timeit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('GAT backend benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset the molecules come from'
+    )
+    parser.add_argument(
+        '--batch_sizes', default=[16, 64, 256, 1024], type=int, nargs='+',
+        help='the numbers of molecules per batch'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=8, type=int)
+    parser.add_argument('--heads', default=8, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument(
+        '--train', action='store_true',
+        help='time forward and backward in train mode'
+    )
+    args = parser.parse_args()
+
+    fix_seed(2023)
+    models = {}
+    for backend in ['pyg', 'fused']:
+        models[backend] = GATBase(
+            num_layers=args.n_layer, num_heads=args.heads,
+            embedding_dim=args.dim, dropout=0, backend=backend
+        )
+        models[backend].load_state_dict(models['pyg'].state_dict())
+        models[backend].train(args.train)
+    batches = make_batches(args.data_path, args.part, args.batch_sizes)
+
+    for bs, G in batches.items():
+        def run(fun):
+            def wrapper():
+                with torch.set_grad_enabled(args.train):
+                    result = fun()
+                    if args.train:
+                        sum(x.sum() for x in result).backward()
+                return result
+            return wrapper
+
+        # a single attention layer, csr conversion included
+        conv = models['pyg'].convs[0]
+        x = torch.randn(G.num_nodes, args.dim, requires_grad=args.train)
+        edge_attr = torch.randn(G.edge_index.shape[1], args.dim)
+        edge_index = G.edge_index.long()
+
+        def pyg_conv():
+            loop_index = add_self_loops(edge_index, G.num_nodes)
+            return [conv(x, loop_index, edge_attr, self_loop_added=True)]
+
+        def fused_conv():
+            csr_index, perm, degree = to_csr(edge_index, G.num_nodes)
+            return [conv.fused_forward(x, csr_index, edge_attr[perm], degree)]
+
+        layers = {
+            'conv': (pyg_conv, fused_conv),
+            'encoder': (lambda: models['pyg'](G), lambda: models['fused'](G))
+        }
+        for name, (pyg_fun, fused_fun) in layers.items():
+            with torch.no_grad():
+                diff = max_diff(pyg_fun(), fused_fun())
+            old_time = timeit(run(pyg_fun), args.repeat)
+            new_time = timeit(run(fused_fun), args.repeat)
+            print(f'[bs {bs}, {G.num_nodes} nodes, {name}] pyg '
+                  f'{old_time:.1f} ms  fused {new_time:.1f} ms  speedup '
+                  f'{old_time / new_time:.2f}x  max abs diff {diff:.2e}')
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+import torch
+import torch.multiprocessing as torch_mp
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed, generate_tgt_mask
+from Dataset import RetroDataset, col_fn_retro
+from model import PretrainModel, PositionalEncoding
+from sparse_backBone import GATBase
+from training import calc_trans_loss
+from lora_utils import add_lora, adapter_state, apply_adapter
+
+
+def max_rss():
+    # the peak resident memory of this process in MiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tensor_mib(tensors):
+    return sum(x.numel() * x.element_size() for x in tensors) / 2 ** 20
+
+
+def build_model(args, tokenizer):
+    fix_seed(2023)
+    GNN = GATBase(
+        num_layers=args.n_layer, dropout=0.1, num_heads=args.heads,
+        embedding_dim=args.dim
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=args.dim, nhead=args.heads, batch_first=True,
+        dim_feedforward=args.dim * 2, dropout=0.1
+    )
+    return PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, args.n_layer),
+        d_model=args.dim, pos_enc=PositionalEncoding(args.dim, 0.1)
+    )
+
+
+def worker(idx, args, tokenizer, rank, queue):
+    model = build_model(args, tokenizer)
+    if rank > 0:
+        add_lora(model, rank, 2 * rank)
+    params = [x for x in model.parameters() if x.requires_grad]
+    optimizer = torch.optim.Adam(params, lr=1e-4)
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+    graph, tran = col_fn_retro([dataset[x] for x in range(args.bs)])
+    tops = torch.LongTensor(tokenizer.encode2d(tran))
+    trans_op_mask, diag_mask = generate_tgt_mask(
+        tops[:, :-1], tokenizer, '<PAD>'
+    )
+    pad_idx = tokenizer.token2idx['<PAD>']
+
+    def step():
+        trans_logs = model(
+            graphs=graph, tgt=tops[:, :-1], tgt_mask=diag_mask,
+            tgt_pad_mask=trans_op_mask
+        )
+        calc_trans_loss(trans_logs, tops[:, 1:], pad_idx).backward()
+        grads = tensor_mib(x.grad for x in params if x.grad is not None)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        return grads
+
+    grads = step()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    elapsed = (time.perf_counter() - start) / args.steps
+    states = tensor_mib(
+        v for state in optimizer.state.values() for v in state.values()
+        if isinstance(v, torch.Tensor) and v.dim() > 0
+    )
+    queue.put({
+        'trainable': tensor_mib(params), 'grads': grads,
+        'adam': states, 'rss': max_rss(), 'step': elapsed
+    })
+
+
+def swap_time(args, tokenizer, rank, repeat=5):
+    """
+    the seconds to switch a served model to another fine-tune, loading
+    a full checkpoint from disk against taking out the adapters of one
+    and adding those of another on the same base model
+    """
+    model = build_model(args, tokenizer).eval()
+    folder = tempfile.mkdtemp()
+    full_path = os.path.join(folder, 'mod.pth')
+    adapter_path = os.path.join(folder, 'adapter.pth')
+    torch.save(model.state_dict(), full_path)
+
+    tuned = add_lora(build_model(args, tokenizer), rank, 2 * rank)
+    with torch.no_grad():
+        for x in tuned.parameters():
+            if x.requires_grad:
+                x.normal_(std=0.01)
+    torch.save(adapter_state(tuned), adapter_path)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        model.load_state_dict(torch.load(full_path, map_location='cpu'))
+    full = (time.perf_counter() - start) / repeat
+
+    adapters = torch.load(adapter_path, map_location='cpu')
+    start = time.perf_counter()
+    for _ in range(repeat):
+        new_adapters = torch.load(adapter_path, map_location='cpu')
+        apply_adapter(model, adapters, sign=-1)
+        apply_adapter(model, new_adapters)
+        adapters = new_adapters
+    swap = (time.perf_counter() - start) / repeat
+    sizes = [os.path.getsize(x) / 2 ** 20 for x in [full_path, adapter_path]]
+    for x in [full_path, adapter_path]:
+        os.remove(x)
+    os.rmdir(folder)
+    return full, swap, sizes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Low rank adapter benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--part', default='train', type=str,
+        help='the split of dataset the reactions come from'
+    )
+    parser.add_argument(
+        '--ranks', default=[0, 8, 32], type=int, nargs='+',
+        help='the ranks of the adapters to compare, 0 for the whole model'
+    )
+    parser.add_argument('--bs', default=8, type=int)
+    parser.add_argument('--dim', default=512, type=int)
+    parser.add_argument('--n_layer', default=6, type=int)
+    parser.add_argument('--heads', default=8, type=int)
+    parser.add_argument('--steps', default=3, type=int)
+    args = parser.parse_args()
+
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+
+    # one process per setting, for the peak memory of each
+    ctx = torch_mp.get_context('spawn')
+    print(f'[bs {args.bs}, dim {args.dim}, {args.n_layer} layers, MiB]')
+    print('| training | trainable | grads | adam states | peak rss | '
+          's/step |')
+    print('|---' * 6 + '|')
+    for rank in args.ranks:
+        queue = ctx.Queue()
+        torch_mp.spawn(worker, nprocs=1, args=(args, tokenizer, rank, queue))
+        result = queue.get()
+        name = f'lora rank {rank}' if rank > 0 else 'whole model'
+        print(f'| {name} | {result["trainable"]:.2f} | '
+              f'{result["grads"]:.2f} | {result["adam"]:.2f} | '
+              f'{result["rss"]:.1f} | {result["step"]:.2f} |')
+
+    print('\n| adapter rank | full file MiB | adapter file MiB | '
+          'load full s | swap adapters s |')
+    print('|---' * 5 + '|')
+    for rank in args.ranks:
+        if rank > 0:
+            full, swap, sizes = swap_time(args, tokenizer, rank)
+            print(f'| {rank} | {sizes[0]:.1f} | {sizes[1]:.2f} | '
+                  f'{full:.3f} | {swap:.3f} |')
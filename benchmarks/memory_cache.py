@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed
+from Dataset import (
+    RetroDataset, col_fn_retro, MemoryCacheDataset, col_fn_cached
+)
+from model import PretrainModel, PositionalEncoding
+from sparse_backBone import GATBase
+from training import pretrain, build_memory_cache
+
+
+def build_model(args, tokenizer, frozen=True):
+    fix_seed(2023)
+    GNN = GATBase(
+        num_layers=args.n_layer, dropout=0.1, num_heads=args.heads,
+        embedding_dim=args.dim
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=args.dim, nhead=args.heads, batch_first=True,
+        dim_feedforward=args.dim * 2, dropout=0.1
+    )
+    model = PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, args.dec_layer),
+        d_model=args.dim, pos_enc=PositionalEncoding(args.dim, 0.1)
+    )
+    # a frozen encoder gets no gradients
+    model.encoder.requires_grad_(not frozen)
+    return model
+
+
+def epoch_time(args, model, tokenizer, dataset, collate_fn):
+    # one warm-up epoch fills the featurizer cache of the dataset
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    loader = DataLoader(
+        dataset, collate_fn=collate_fn, num_workers=args.num_workers,
+        batch_sampler=BatchSampler(
+            RandomSampler(dataset), batch_size=args.bs, drop_last=False
+        )
+    )
+    times = []
+    for _ in range(args.epochs + 1):
+        start = time.perf_counter()
+        pretrain(
+            loader=loader, model=model, optimizer=optimizer,
+            tokenizer=tokenizer, device='cpu', pad_token='<PAD>',
+            warmup=False
+        )
+        times.append(time.perf_counter() - start)
+    return min(times[1:])
+
+
+def folder_mib(path):
+    return sum(
+        os.path.getsize(os.path.join(path, x)) for x in os.listdir(path)
+    ) / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Encoder memory cache benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--part', default='train', type=str,
+        help='the split of dataset the reactions come from'
+    )
+    parser.add_argument(
+        '--aug_prob', default=[0, 0.5], type=float, nargs='+',
+        help='the augmentation probabilities to compare, the cache draws '
+        'from a bank of --bank randomized products'
+    )
+    parser.add_argument('--bank', default=2, type=int)
+    parser.add_argument('--bs', default=32, type=int)
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=8, type=int)
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument('--epochs', default=2, type=int)
+    parser.add_argument('--num_workers', default=0, type=int)
+    args = parser.parse_args()
+    if args.dec_layer < 0:
+        args.dec_layer = args.n_layer
+
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+    reac, prod, rxn = load_data(args.data_path, args.part)
+
+    print(f'[{len(reac)} reactions, bs {args.bs}, dim {args.dim}, '
+          f'{args.n_layer} encoder and {args.dec_layer} decoder layers, '
+          's per epoch, speedup against the frozen encoder on graphs]')
+    print('| aug_prob | data | cache MiB | build s | epoch s | speedup |')
+    print('|---' * 6 + '|')
+    for aug_prob in args.aug_prob:
+        bank = args.bank if aug_prob > 0 else 0
+        dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=aug_prob)
+        model = build_model(args, tokenizer, frozen=False)
+        trained = epoch_time(args, model, tokenizer, dataset, col_fn_retro)
+        model = build_model(args, tokenizer)
+        base = epoch_time(args, model, tokenizer, dataset, col_fn_retro)
+        print(f'| {aug_prob} | graphs, encoder trained | - | - | '
+              f'{trained:.2f} | {base / trained:.2f}x |')
+        print(f'| {aug_prob} | graphs, encoder frozen | - | - | '
+              f'{base:.2f} | 1.00x |')
+        for fp16 in [False, True]:
+            path = tempfile.mkdtemp()
+            model = build_model(args, tokenizer)
+            start = time.perf_counter()
+            build_memory_cache(
+                model, reac, prod, None, path, 'cpu', bank=bank,
+                fp16=fp16, bs=args.bs, num_workers=args.num_workers
+            )
+            build = time.perf_counter() - start
+            dataset = MemoryCacheDataset(path, aug_prob)
+            cached = epoch_time(args, model, tokenizer, dataset, col_fn_cached)
+            name = 'cache fp16' if fp16 else 'cache fp32'
+            print(f'| {aug_prob} | {name} | {folder_mib(path):.1f} | '
+                  f'{build:.1f} | {cached:.2f} | {base / cached:.2f}x |')
+            shutil.rmtree(path)
@@ -0,0 +1,135 @@
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, RandomSampler
+
+from data_utils import load_data, fix_seed
+from Dataset import col_fn_retro, SizeSortedBatchSampler
+from model import PretrainModel
+from utils.chemistry_parse import clear_map_number, count_atoms
+from utils.graph_utils import fast_smiles2graph
+from benchmarks.encoder import timeit
+
+
+def legacy_graph2batch(node_feat, batch_mask):
+    # PretrainModel.graph2batch before pad_index
+    batch_size, max_node = batch_mask.shape
+    answer = torch.zeros(batch_size, max_node, node_feat.shape[-1])
+    answer = answer.to(node_feat)
+    answer[batch_mask] = node_feat
+    return answer
+
+
+def make_batches(graphs, batch_sampler, num_batch):
+    batches = []
+    for idx, batch in enumerate(batch_sampler):
+        if idx >= num_batch:
+            break
+        batches.append(col_fn_retro([(graphs[x], [], None) for x in batch])[0])
+    return batches
+
+
+def run_all(fun, batches):
+    def wrapper():
+        for G in batches:
+            fun(G)
+    return wrapper
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Memory packing benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset the molecules come from'
+    )
+    parser.add_argument(
+        '--batch_sizes', default=[32, 128, 512], type=int, nargs='+',
+        help='the numbers of molecules per batch'
+    )
+    parser.add_argument(
+        '--num_batch', default=10, type=int,
+        help='the number of batches measured for every batch size'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument(
+        '--tgt_len', default=60, type=int,
+        help='the length of the queries attending to the memory'
+    )
+    parser.add_argument(
+        '--sort_pool', default=100, type=int,
+        help='the number of batches sorted together'
+    )
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    fix_seed(2023)
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    graphs = [fast_smiles2graph(clear_map_number(x)) for x in prod]
+    sizes = np.array([count_atoms(x) for x in prod])
+    cross_attn = torch.nn.MultiheadAttention(
+        args.dim, args.heads, batch_first=True
+    ).eval()
+
+    def scatter(G, fun):
+        fun(G.node_feat, G).backward(G.grad)
+
+    def attention(G):
+        memory = torch.randn(*G.batch_mask.shape, args.dim)
+        query = torch.randn(G.batch_mask.shape[0], args.tgt_len, args.dim)
+        with torch.no_grad():
+            cross_attn(
+                query, memory, memory,
+                key_padding_mask=torch.logical_not(G.batch_mask)
+            )
+
+    for bs in args.batch_sizes:
+        # molecules drawn with replacement, the pool of the size sorted
+        # sampler is as large as in training on a full dataset
+        random_batches = make_batches(graphs, BatchSampler(RandomSampler(
+            graphs, replacement=True, num_samples=bs * args.num_batch
+        ), batch_size=bs, drop_last=True), args.num_batch)
+        sorted_batches = make_batches(graphs, SizeSortedBatchSampler(
+            RandomSampler(
+                graphs, replacement=True, num_samples=bs * args.sort_pool
+            ), sizes=sizes, batch_size=bs, pool_size=args.sort_pool
+        ), args.num_batch)
+        for G in random_batches:
+            G.node_feat = torch.randn(G.num_nodes, args.dim)
+            G.node_feat.requires_grad_(True)
+            G.grad = torch.randn(*G.batch_mask.shape, args.dim)
+
+        old_time = timeit(run_all(lambda G: scatter(
+            G, lambda x, G: legacy_graph2batch(x, G.batch_mask)
+        ), random_batches), args.repeat)
+        new_time = timeit(run_all(lambda G: scatter(
+            G, lambda x, G: PretrainModel.graph2batch(
+                None, x, G.batch_mask, G.pad_index
+            )
+        ), random_batches), args.repeat)
+        random_attn = timeit(run_all(attention, random_batches), args.repeat)
+        sorted_attn = timeit(run_all(attention, sorted_batches), args.repeat)
+
+        # float32 memory of all the batches in MiB
+        packed = sum(G.num_nodes for G in random_batches)
+        random_pad = sum(G.batch_mask.numel() for G in random_batches)
+        sorted_pad = sum(G.batch_mask.numel() for G in sorted_batches)
+        sorted_nodes = sum(G.num_nodes for G in sorted_batches)
+        to_mib = args.dim * 4 / 1024 / 1024
+
+        print(f'[bs {bs}, {args.num_batch} batches]')
+        print(f'    graph2batch fwd+bwd: mask {old_time:.2f} ms  pad_index '
+              f'{new_time:.2f} ms  speedup {old_time / new_time:.2f}x')
+        print(f'    memory: padded {random_pad * to_mib:.2f} MiB  '
+              f'size sorted {sorted_pad * to_mib * packed / sorted_nodes:.2f}'
+              f' MiB  packed {packed * to_mib:.2f} MiB '
+              f'(padding {1 - packed / random_pad:.1%} / '
+              f'{1 - sorted_nodes / sorted_pad:.1%} / 0%)')
+        print(f'    cross attention over {args.tgt_len} queries: padded '
+              f'{random_attn:.2f} ms  size sorted {sorted_attn:.2f} ms '
+              f'(per node {random_attn / packed * 1e3:.2f} / '
+              f'{sorted_attn / sorted_nodes * 1e3:.2f} us)')
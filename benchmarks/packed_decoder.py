@@ -0,0 +1,145 @@
+import argparse
+import json
+import torch
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+from torch.utils.data import DataLoader
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import (
+    load_data, fix_seed, generate_tgt_mask, generate_packed_batch
+)
+from Dataset import RetroDataset, col_fn_retro
+from model import PretrainModel, PositionalEncoding
+from sparse_backBone import GATBase
+from training import calc_trans_loss, calc_packed_loss
+from benchmarks.dense_backend import best_time
+
+
+def padded_step(model, graph, tops, pad_idx, tokenizer):
+    trans_dec_ip, trans_dec_op = tops[:, :-1], tops[:, 1:]
+    trans_op_mask, diag_mask = generate_tgt_mask(
+        trans_dec_ip, tokenizer, '<PAD>'
+    )
+    trans_logs = model(
+        graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
+        tgt_pad_mask=trans_op_mask
+    )
+    return calc_trans_loss(trans_logs, trans_dec_op, pad_idx)
+
+
+def packed_step(model, graph, tops, pad_idx, pack_len):
+    # the packing is part of the step, it runs in the training loop
+    trans_dec_ip, trans_dec_op, diag_mask, packing = \
+        generate_packed_batch(tops, graph.ptr, pad_idx, pack_len)
+    trans_logs = model(
+        graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
+        tgt_pad_mask=None, packing=packing
+    )
+    return calc_packed_loss(trans_logs, trans_dec_op, tops.shape[0])
+
+
+def grad_diff(model, step_a, step_b):
+    grads = []
+    for step in [step_a, step_b]:
+        model.zero_grad()
+        loss = step()
+        loss.backward()
+        grads.append((loss.item(), [
+            x.grad.clone() for x in model.parameters() if x.grad is not None
+        ]))
+    model.zero_grad()
+    diff = max((x - y).abs().max().item() for x, y in zip(
+        grads[0][1], grads[1][1]
+    ))
+    return grads[0][0], grads[1][0], diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Packed decoder benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--part', default='val', type=str,
+        help='the split of dataset the reactions come from'
+    )
+    parser.add_argument(
+        '--batch_sizes', default=[32, 128], type=int, nargs='+',
+        help='the numbers of reactions per batch'
+    )
+    parser.add_argument(
+        '--pack_lens', default=[0, 256], type=int, nargs='+',
+        help='the row lengths of packing, 0 for the longest sequence'
+    )
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=6, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    fix_seed(2023)
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+    pad_idx = tokenizer.token2idx['<PAD>']
+
+    GNN = GATBase(
+        num_layers=args.n_layer, dropout=0, num_heads=args.heads,
+        embedding_dim=args.dim
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=args.dim, nhead=args.heads, batch_first=True,
+        dim_feedforward=args.dim * 2, dropout=0
+    )
+    model = PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, args.n_layer),
+        d_model=args.dim, pos_enc=PositionalEncoding(args.dim, 0)
+    ).train()
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+
+    for bs in args.batch_sizes:
+        graph, tran = next(iter(DataLoader(
+            dataset, batch_size=bs, shuffle=True, collate_fn=col_fn_retro
+        )))
+        tops = torch.LongTensor(tokenizer.encode2d(tran))
+        num_token = (tops[:, 1:] != pad_idx).sum().item()
+        print(f'[bs {bs}] {num_token} tokens, padded to '
+              f'{tops.shape[0] * (tops.shape[1] - 1)}')
+
+        def padded():
+            return padded_step(model, graph, tops, pad_idx, tokenizer)
+
+        funs = [padded]
+        for pack_len in args.pack_lens:
+            def packed(pack_len=pack_len):
+                return packed_step(model, graph, tops, pad_idx, pack_len)
+
+            rows = generate_packed_batch(
+                tops, graph.ptr, pad_idx, pack_len
+            )[0].shape
+            padded_loss, packed_loss, diff = grad_diff(model, padded, packed)
+            print(f'    pack_len {pack_len}: rows {list(rows)}  loss padded '
+                  f'{padded_loss:.6f} packed {packed_loss:.6f}  max abs '
+                  f'grad diff {diff:.2e}')
+            funs.append(packed)
+
+        def train_step(fun):
+            def wrapper():
+                fun().backward()
+                model.zero_grad()
+            return wrapper
+
+        times = best_time([train_step(x) for x in funs], args.repeat)
+        names = ['padded'] + [f'pack_len {x}' for x in args.pack_lens]
+        print('    fwd+bwd ' + '  '.join(
+            f'{name} {t:.1f} ms ({num_token / t * 1e3:.0f} tokens/s)'
+            for name, t in zip(names, times)
+        ))
@@ -0,0 +1,101 @@
+import argparse
+import json
+import torch
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data
+from Dataset import RetroDataset, col_fn_retro
+from model import build_model
+from prune_utils import (
+    ATTENTIONS, full_arch, remove_units, pruned_copy, decode_latency
+)
+from benchmarks.student_latency import model_args
+
+
+def mask_heads(model, units):
+    # zeroes the columns of out_proj of the heads, the model acts as
+    # without them but computes them all
+    model = pruned_copy(model, full_arch(model))
+    with torch.no_grad():
+        for name, layer, head in units:
+            attn = getattr(model.decoder.layers[layer], name)
+            dim = attn.head_dim
+            attn.out_proj.weight[:, head * dim: (head + 1) * dim] = 0
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Structured pruning latency benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument('--dim', default=512, type=int)
+    parser.add_argument('--n_layer', default=6, type=int)
+    parser.add_argument('--heads', default=8, type=int)
+    parser.add_argument('--beams', default=10, type=int)
+    parser.add_argument('--max_len', default=100, type=int)
+    parser.add_argument('--molecules', default=3, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+    reac, prod, rxn = load_data(args.data_path, 'test')
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+    graphs = [
+        col_fn_retro([dataset[x % len(dataset)]])[0]
+        for x in range(args.molecules)
+    ]
+
+    torch.manual_seed(2023)
+    model = build_model(
+        model_args(args.dim, args.n_layer, args.heads), tokenizer, 'cpu', 0
+    ).eval()
+    arch = full_arch(model)
+    half = [
+        (name, layer, head) for name in ATTENTIONS
+        for layer in arch['dec_layers']
+        for head in range(args.heads // 2, args.heads)
+    ]
+    dec_half = [('dec', x) for x in arch['dec_layers'][args.n_layer // 2:]]
+    enc_half = [('enc', x) for x in arch['enc_layers'][args.n_layer // 2:]]
+    settings = [
+        ('unpruned', model),
+        ('half heads masked', mask_heads(model, half)),
+        ('half heads removed', pruned_copy(model, remove_units(arch, half))),
+        ('half decoder layers removed', pruned_copy(
+            model, remove_units(arch, dec_half)
+        )),
+        ('half encoder layers removed', pruned_copy(
+            model, remove_units(arch, enc_half)
+        )),
+        ('half decoder layers and heads removed', pruned_copy(
+            model, remove_units(arch, dec_half + [
+                x for x in half if ('dec', x[1]) not in dec_half
+            ])
+        ))
+    ]
+
+    # fixed tokens, every setting decodes max_len tokens for the beams
+    print(f'[dim {args.dim}, {args.n_layer} layers, {args.heads} heads, '
+          f'{args.beams} beams, {args.max_len} tokens, one molecule at a '
+          f'time, {torch.get_num_threads()} threads]')
+    print('| model | params | ms/molecule | speedup |')
+    print('|---' * 4 + '|')
+    base = None
+    for name, this_model in settings:
+        elapsed = decode_latency(
+            this_model, graphs, 'cpu', args.beams, args.max_len
+        )
+        base = base or elapsed
+        params = sum(x.numel() for x in this_model.parameters()) / 1e6
+        print(f'| {name} | {params:.1f}M | {elapsed:.0f} | '
+              f'{base / elapsed:.2f}x |')
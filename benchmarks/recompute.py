@@ -0,0 +1,132 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+import torch
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed, generate_tgt_mask
+from Dataset import RetroDataset, col_fn_retro
+from model import PretrainModel, PositionalEncoding
+from sparse_backBone import GATBase
+from training import calc_trans_loss
+
+
+def max_rss():
+    # the peak resident memory of this process in MiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(args, tokenizer, enc_recompute, dec_recompute, queue):
+    # runs in a fresh process, max rss only ever grows
+    torch.set_num_threads(args.threads)
+    fix_seed(2023)
+    GNN = GATBase(
+        num_layers=args.n_layer, dropout=args.dropout, num_heads=args.heads,
+        embedding_dim=args.dim, recompute=enc_recompute
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=args.dim, nhead=args.heads, batch_first=True,
+        dim_feedforward=args.dim * 2, dropout=args.dropout
+    )
+    model = PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, args.n_layer),
+        d_model=args.dim, pos_enc=PositionalEncoding(args.dim, args.dropout),
+        recompute=dec_recompute
+    ).train()
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+    graph, tran = col_fn_retro([
+        dataset[x % len(dataset)] for x in range(args.bs)
+    ])
+    tops = torch.LongTensor(tokenizer.encode2d(tran))
+    trans_dec_ip, trans_dec_op = tops[:, :-1], tops[:, 1:]
+    trans_op_mask, diag_mask = generate_tgt_mask(
+        trans_dec_ip, tokenizer, '<PAD>'
+    )
+    pad_idx = tokenizer.token2idx['<PAD>']
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        trans_logs = model(
+            graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
+            tgt_pad_mask=trans_op_mask
+        )
+        loss = calc_trans_loss(trans_logs, trans_dec_op, pad_idx)
+        loss.backward()
+        return loss.item()
+
+    base = max_rss()
+    fix_seed(2023)
+    loss = step()
+    peak = max_rss() - base
+    grad_norm = sum(
+        x.grad.norm() ** 2 for x in model.parameters() if x.grad is not None
+    ).sqrt().item()
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    queue.put((peak, min(times) * 1e3, loss, grad_norm))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Activation recompute benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--part', default='train', type=str,
+        help='the split of dataset the reactions come from'
+    )
+    parser.add_argument(
+        '--configs', default=['0:0', '-1:0', '0:-1', '-1:-1'], type=str,
+        nargs='+', help='the settings as enc_recompute:dec_recompute'
+    )
+    parser.add_argument('--bs', default=128, type=int)
+    parser.add_argument('--dim', default=256, type=int)
+    parser.add_argument('--n_layer', default=8, type=int)
+    parser.add_argument('--heads', default=4, type=int)
+    parser.add_argument('--dropout', default=0.1, type=float)
+    parser.add_argument('--threads', default=1, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    # built once, the order of the special tokens depends on the hash
+    # seed of the process
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for config in args.configs:
+        enc_recompute, dec_recompute = [int(x) for x in config.split(':')]
+        queue = ctx.Queue()
+        process = ctx.Process(
+            target=measure,
+            args=(args, tokenizer, enc_recompute, dec_recompute, queue)
+        )
+        process.start()
+        peak, step_time, loss, grad_norm = queue.get()
+        process.join()
+        results.append((config, peak, step_time, loss, grad_norm))
+
+    base_peak, base_time = results[0][1], results[0][2]
+    print(f'[bs {args.bs}, dim {args.dim}, {args.n_layer} layers]')
+    for config, peak, step_time, loss, grad_norm in results:
+        print(f'    enc:dec recompute {config}: peak {peak:.0f} MiB '
+              f'({peak / base_peak:.0%})  fwd+bwd {step_time:.0f} ms '
+              f'({step_time / base_time - 1:+.0%})  loss {loss:.6f}  '
+              f'grad norm {grad_norm:.6f}')
@@ -0,0 +1,79 @@
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data
+from Dataset import RetroDataset, col_fn_retro
+from model import fill_model_sizes, build_model
+from inference_tools import beam_search_one
+
+
+def model_args(dim, n_layer, heads):
+    sizes = {
+        f'{part}_{key}': -1 for part in ['enc', 'dec']
+        for key in ['layer', 'dim', 'heads', 'ffn']
+    }
+    return fill_model_sizes(argparse.Namespace(
+        dim=dim, n_layer=n_layer, heads=heads, negative_slope=0.2,
+        use_class=False, gnn_backend='pyg', dense_ratio=0, **sizes
+    ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Student size latency benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--sizes', default=['768,8,12', '512,6,8', '256,4,4', '256,2,4'],
+        type=str, nargs='+', help='the dim, n_layer and heads of models'
+    )
+    parser.add_argument('--beams', default=10, type=int)
+    parser.add_argument('--max_len', default=100, type=int)
+    parser.add_argument('--molecules', default=10, type=int)
+    parser.add_argument('--threads', default=0, type=int)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+    reac, prod, rxn = load_data(args.data_path, 'test')
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+
+    # untrained weights rarely end a beam, so every model decodes about
+    # max_len tokens and the times compare the cost per token
+    print(f'[{args.beams} beams, up to {args.max_len} tokens, one molecule '
+          f'at a time, {torch.get_num_threads()} threads]')
+    print('| dim, n_layer, heads | params | ms/molecule | speedup |')
+    print('|---' * 4 + '|')
+    base = None
+    for size in args.sizes:
+        dim, n_layer, heads = [int(x) for x in size.split(',')]
+        torch.manual_seed(2023)
+        model = build_model(
+            model_args(dim, n_layer, heads), tokenizer, 'cpu', 0
+        ).eval()
+        times = []
+        for idx in range(args.molecules + 1):
+            graph, tran = col_fn_retro([dataset[idx % len(dataset)]])
+            start = time.perf_counter()
+            beam_search_one(
+                model, tokenizer, graph, 'cpu', args.max_len,
+                size=args.beams, begin_token='<CLS>', end_token='<END>'
+            )
+            times.append(time.perf_counter() - start)
+        elapsed = np.mean(times[1:]) * 1e3
+        base = base or elapsed
+        params = sum(x.numel() for x in model.parameters()) / 1e6
+        print(f'| {size} | {params:.1f}M | {elapsed:.0f} | '
+              f'{base / elapsed:.2f}x |')
@@ -0,0 +1,159 @@
+import argparse
+import json
+import resource
+import time
+import torch
+import torch.distributed as torch_dist
+import torch.multiprocessing as torch_mp
+from torch.nn import TransformerDecoderLayer, TransformerDecoder
+
+from tokenlizer import DEFAULT_SP, Tokenizer
+from data_utils import load_data, fix_seed, generate_tgt_mask
+from Dataset import RetroDataset, col_fn_retro
+from model import PretrainModel, PositionalEncoding
+from sparse_backBone import GATBase
+from training import calc_trans_loss
+from ddp_training import setup_cpu_rank, build_adam, full_optimizer_state
+
+
+def max_rss():
+    # the peak resident memory of this process in MiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tensor_mib(tensors):
+    return sum(x.numel() * x.element_size() for x in tensors) / 2 ** 20
+
+
+def optimizer_mib(optimizer):
+    # the states kept by this rank, the local shard for the sharded one
+    states = getattr(optimizer, 'optim', optimizer).state.values()
+    return tensor_mib(
+        v for state in states for v in state.values()
+        if isinstance(v, torch.Tensor)
+    )
+
+
+def worker(rank, args, tokenizer, num_ranks, zero, queue):
+    torch_dist.init_process_group(
+        backend='gloo', init_method=f'tcp://127.0.0.1:{args.port}',
+        world_size=num_ranks, rank=rank
+    )
+    setup_cpu_rank(rank, num_ranks, args.threads_per_rank)
+    fix_seed(2023)
+    GNN = GATBase(
+        num_layers=args.n_layer, dropout=0.1, num_heads=args.heads,
+        embedding_dim=args.dim
+    )
+    decode_layer = TransformerDecoderLayer(
+        d_model=args.dim, nhead=args.heads, batch_first=True,
+        dim_feedforward=args.dim * 2, dropout=0.1
+    )
+    model = PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=TransformerDecoder(decode_layer, args.n_layer),
+        d_model=args.dim, pos_enc=PositionalEncoding(args.dim, 0.1)
+    )
+    model = torch.nn.parallel.DistributedDataParallel(
+        model, find_unused_parameters=True
+    )
+    optimizer = build_adam(model, 1e-4, zero=zero)
+
+    reac, prod, rxn = load_data(args.data_path, args.part)
+    dataset = RetroDataset(prod_sm=prod, reat_sm=reac, aug_prob=0)
+    graph, tran = col_fn_retro([
+        dataset[x % len(dataset)]
+        for x in range(rank * args.bs, (rank + 1) * args.bs)
+    ])
+    tops = torch.LongTensor(tokenizer.encode2d(tran))
+    trans_op_mask, diag_mask = generate_tgt_mask(
+        tops[:, :-1], tokenizer, '<PAD>'
+    )
+    pad_idx = tokenizer.token2idx['<PAD>']
+
+    def step():
+        trans_logs = model(
+            graphs=graph, tgt=tops[:, :-1], tgt_mask=diag_mask,
+            tgt_pad_mask=trans_op_mask
+        )
+        calc_trans_loss(trans_logs, tops[:, 1:], pad_idx).backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    step()
+    torch_dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    torch_dist.barrier()
+    elapsed = (time.perf_counter() - start) / args.steps
+    rss = max_rss()
+
+    # the full state gathered on rank 0, as saved in the checkpoints
+    start = time.perf_counter()
+    full_optimizer_state(optimizer)
+    consolidate = time.perf_counter() - start
+
+    queue.put({
+        'rank': rank, 'params': tensor_mib(model.parameters()),
+        'optimizer': optimizer_mib(optimizer), 'step': elapsed,
+        'consolidate': consolidate, 'rss': rss,
+        'rss_saving': max_rss()
+    })
+    torch_dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('ZeRO sharded optimizer benchmark')
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--token_path', required=True, type=str,
+        help='the path of a json containing all tokens'
+    )
+    parser.add_argument(
+        '--part', default='train', type=str,
+        help='the split of dataset the reactions come from'
+    )
+    parser.add_argument(
+        '--ranks', default=[1, 2, 4], type=int, nargs='+',
+        help='the numbers of gloo ranks to compare'
+    )
+    parser.add_argument('--threads_per_rank', default=0, type=int)
+    parser.add_argument('--bs', default=8, type=int)
+    parser.add_argument('--dim', default=512, type=int)
+    parser.add_argument('--n_layer', default=6, type=int)
+    parser.add_argument('--heads', default=8, type=int)
+    parser.add_argument('--steps', default=3, type=int)
+    parser.add_argument('--port', default=12356, type=int)
+    args = parser.parse_args()
+
+    # built once, the order of the special tokens depends on the hash
+    # seed of the process
+    SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+    with open(args.token_path) as Fin:
+        tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+
+    ctx = torch_mp.get_context('spawn')
+    print(f'[bs {args.bs} per rank, dim {args.dim}, {args.n_layer} layers, '
+          'MiB per rank, max over the ranks]')
+    print('| ranks | optimizer | params | adam states | peak rss | '
+          'peak rss saving | s/step | gather s |')
+    print('|---' * 8 + '|')
+    for num_ranks in args.ranks:
+        for zero in [False, True]:
+            queue = ctx.Queue()
+            torch_mp.spawn(
+                worker, nprocs=num_ranks,
+                args=(args, tokenizer, num_ranks, zero, queue)
+            )
+            results = [queue.get() for _ in range(num_ranks)]
+            row = [str(num_ranks), 'zero' if zero else 'adam']
+            row.append(f'{results[0]["params"]:.1f}')
+            for key in ['optimizer', 'rss', 'rss_saving']:
+                row.append(f'{max(x[key] for x in results):.1f}')
+            for key in ['step', 'consolidate']:
+                row.append(f'{max(x[key] for x in results):.2f}')
+            print('| ' + ' | '.join(row) + ' |')
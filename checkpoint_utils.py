@@ -0,0 +1,172 @@
+import glob
+import json
+import os
+import random
+import threading
+import time
+import numpy as np
+import torch
+
+
+def save_atomic(obj, path):
+    # a rank killed while saving leaves the previous file intact
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def dump_json_atomic(obj, path):
+    # readers of path never see a half written file, such as the
+    # evaluation sidecar reading the training log, one temp file per process
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as Fout:
+        json.dump(obj, Fout, indent=4)
+    os.replace(tmp_path, path)
+
+
+def checkpoint_run_id(path):
+    # the timestamp or run id of {base_log}/ckpt-{run_id}-{epoch}-{step}.pth
+    return os.path.basename(path)[len('ckpt-'):].rsplit('-', 2)[0]
+
+
+def checkpoint_position(path):
+    # the epoch and step of {base_log}/ckpt-{run_id}-{epoch}-{step}.pth
+    epoch, step = os.path.basename(path)[:-len('.pth')].rsplit('-', 2)[1:]
+    return int(epoch), int(step)
+
+
+def sidecar_path(ckpt_prefix):
+    # eval_sidecar.py writes its results on {base_log}/ckpt-{run_id}
+    # states to {base_log}/async-{run_id}.json
+    folder, name = os.path.split(ckpt_prefix)
+    return os.path.join(folder, f'async-{name[len("ckpt-"):]}.json')
+
+
+def get_rng_state():
+    # plain python and tensor types only, loadable with weights_only
+    np_state = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        'numpy': (np_state[0], np_state[1].tolist()) + np_state[2:],
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all()
+        if torch.cuda.is_available() else []
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state(
+        (np_state[0], np.array(np_state[1], dtype=np.uint32)) +
+        tuple(np_state[2:])
+    )
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) > 0:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def cpu_snapshot(obj):
+    """
+    a copy of obj with all the tensors copied to cpu memory, the dicts
+    and lists are copied as well, so that training can go on while the
+    copy is written
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [cpu_snapshot(x) for x in obj]
+    if isinstance(obj, tuple):
+        return tuple(cpu_snapshot(x) for x in obj)
+    return obj
+
+
+class Checkpointer(object):
+    """
+    Full training states saved as {prefix}-{epoch}-{step}.pth, step is the
+    number of batches trained in the epoch, only the newest keep files are
+    kept. With the results file of an evaluation sidecar given, the states
+    it has yet to evaluate are kept as well. The training loop is only
+    blocked to copy the state to cpu memory, a background thread writes
+    the copy, the next save waits for the previous write. The seconds
+    blocked by every save are recorded in blocked.
+    """
+
+    def __init__(
+        self, prefix, every=0, keep=2, background=True, sidecar=None
+    ):
+        super(Checkpointer, self).__init__()
+        self.prefix, self.every, self.sidecar = prefix, every, sidecar
+        self.keep, self.background = max(keep, 1), background
+        self.num_steps, self.blocked = 0, []
+        self.thread, self.error = None, None
+
+    def path(self, epoch, step):
+        return f'{self.prefix}-{epoch:04d}-{step:07d}.pth'
+
+    def saved(self):
+        return sorted(glob.glob(f'{glob.escape(self.prefix)}-*.pth'))
+
+    def latest(self):
+        saved = self.saved()
+        return saved[-1] if len(saved) > 0 else None
+
+    def step(self):
+        # called after every optimizer step, true when a save is due
+        self.num_steps += 1
+        return self.every > 0 and self.num_steps % self.every == 0
+
+    def save(self, state, epoch, step):
+        start = time.perf_counter()
+        self.wait()
+        state, path = cpu_snapshot(state), self.path(epoch, step)
+        if self.background:
+            self.thread = threading.Thread(
+                target=self.background_write, args=(state, path)
+            )
+            self.thread.start()
+        else:
+            self.write(state, path)
+        self.blocked.append(time.perf_counter() - start)
+
+    def unevaluated(self, paths):
+        """
+        the paths among paths the sidecar is going to evaluate and has not
+        yet, none until the sidecar has written its results file
+        """
+        if self.sidecar is None or not os.path.exists(self.sidecar):
+            return set()
+        with open(self.sidecar) as Fin:
+            info = json.load(Fin)
+        done = set((x['epoch'], x['step']) for x in info['async_metric'])
+        answer = set()
+        for path in paths:
+            epoch, step = checkpoint_position(path)
+            if (epoch, step) not in done and \
+                    (info.get('mid_epoch', False) or step == 0):
+                answer.add(path)
+        return answer
+
+    def write(self, state, path):
+        save_atomic(state, path)
+        old = self.saved()[:-self.keep]
+        pending = self.unevaluated(old)
+        for x in old:
+            if x not in pending:
+                os.remove(x)
+
+    def background_write(self, state, path):
+        # raised in the training loop by the next wait
+        try:
+            self.write(state, path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('failed to write checkpoint') from error
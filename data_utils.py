@@ -8,21 +8,121 @@ from tqdm import tqdm
 import rdkit
 from rdkit import Chem
 import multiprocessing
+import mmap
 
 
 def load_data(data_dir, part):
     df_train = pandas.read_csv(
         os.path.join(data_dir, f'canonicalized_raw_{part}.csv')
     )
-    rxn_class, reacts, prods = [], [], []
-    for idx, resu in enumerate(df_train['reactants>reagents>production']):
-        rxn_class.append(df_train['class'][idx])
+    rxn_class = df_train['class'].tolist()
+    reacts, prods = [], []
+    for resu in df_train['reactants>reagents>production']:
         rea, prd = resu.strip().split('>>')
         reacts.append(rea)
         prods.append(prd)
     return reacts, prods, rxn_class
 
 
+class StringColumn(object):
+    """
+    Read-only list of strings backed by a memory-mapped utf-8 buffer and
+    an offset array, all the processes reading the same files share one
+    physical copy and touching an item never triggers copy-on-write
+    """
+
+    def __init__(self, prefix):
+        super(StringColumn, self).__init__()
+        self.prefix = prefix
+        self._open()
+
+    def _open(self):
+        self.offset = np.load(f'{self.prefix}_offset.npy', mmap_mode='r')
+        self.length = len(self.offset) - 1
+        with open(f'{self.prefix}.bin', 'rb') as Fin:
+            if self.offset[-1] > 0:
+                self.buffer = mmap.mmap(
+                    Fin.fileno(), 0, access=mmap.ACCESS_READ
+                )
+            else:
+                self.buffer = b''
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(f'index {index} out of range')
+        start, end = self.offset[index], self.offset[index + 1]
+        return self.buffer[start: end].decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(self.length):
+            yield self[idx]
+
+    def __getstate__(self):
+        # reopen the files instead of pickling the content
+        return {'prefix': self.prefix}
+
+    def __setstate__(self, state):
+        self.prefix = state['prefix']
+        self._open()
+
+
+def write_string_column(prefix, strings):
+    data = [x.encode('utf-8') for x in strings]
+    offset = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in data], out=offset[1:])
+    # write to temp files and rename, so concurrent readers or writers
+    # never see a partial column
+    with open(f'{prefix}.bin.tmp', 'wb') as Fout:
+        Fout.write(b''.join(data))
+    with open(f'{prefix}_offset.npy.tmp', 'wb') as Fout:
+        np.save(Fout, offset)
+    os.replace(f'{prefix}.bin.tmp', f'{prefix}.bin')
+    os.replace(f'{prefix}_offset.npy.tmp', f'{prefix}_offset.npy')
+
+
+def convert_to_columnar(data_dir, part, force=False):
+    """
+    Convert canonicalized_raw_{part}.csv into columnar files under
+    data_dir/columnar, skipped when the files are newer than the csv
+    :return: the prefix of the columnar files
+    """
+    csv_file = os.path.join(data_dir, f'canonicalized_raw_{part}.csv')
+    out_dir = os.path.join(data_dir, 'columnar')
+    prefix = os.path.join(out_dir, part)
+    class_file = f'{prefix}_class.npy'
+    if not force and os.path.exists(class_file) and \
+            os.path.getmtime(class_file) >= os.path.getmtime(csv_file):
+        return prefix
+
+    os.makedirs(out_dir, exist_ok=True)
+    reacts, prods, rxn_class = load_data(data_dir, part)
+    write_string_column(f'{prefix}_reac', reacts)
+    write_string_column(f'{prefix}_prod', prods)
+    # the class file is written last and marks a finished conversion
+    with open(f'{class_file}.tmp', 'wb') as Fout:
+        np.save(Fout, np.array(rxn_class, dtype=np.int64))
+    os.replace(f'{class_file}.tmp', class_file)
+    return prefix
+
+
+def load_data_columnar(data_dir, part):
+    """
+    Same outputs as load_data, but the reactants and products are
+    memory-mapped StringColumns and the classes a memory-mapped array,
+    the columnar files are created on the first call
+    """
+    prefix = convert_to_columnar(data_dir, part)
+    reacts = StringColumn(f'{prefix}_reac')
+    prods = StringColumn(f'{prefix}_prod')
+    rxn_class = np.load(f'{prefix}_class.npy', mmap_mode='r')
+    return reacts, prods, rxn_class
+
+
 def fix_seed(seed):
     random.seed(seed)
     torch.manual_seed(seed)
@@ -30,6 +130,17 @@ def fix_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def bf16_autocast(device, enabled=True):
+    """
+    bfloat16 autocast for the type of device, a no-op when not enabled,
+    the callers keep softmax and losses in float32
+    """
+    return torch.autocast(
+        device_type=torch.device(device).type, dtype=torch.bfloat16,
+        enabled=enabled
+    )
+
+
 def generate_square_subsequent_mask(sz, device='cpu'):
     mask = (torch.triu(torch.ones((sz, sz))) == 1).transpose(0, 1)
     # mask = mask.float().masked_fill(mask == 0, float('-inf'))
@@ -45,6 +156,102 @@ def generate_tgt_mask(tgt, tokenizer, pad='<PAD>', device='cpu'):
     return tgt_pad_mask, tgt_sub_mask
 
 
+def pack_sequences(lengths, pack_len):
+    """
+    First fit decreasing of the sequences into rows of pack_len tokens,
+    :return: a list of rows, each the indices of the sequences it holds
+    """
+    rows, space = [], []
+    for idx in sorted(range(len(lengths)), key=lambda x: -lengths[x]):
+        for ridx, left in enumerate(space):
+            if left >= lengths[idx]:
+                rows[ridx].append(idx)
+                space[ridx] -= lengths[idx]
+                break
+        else:
+            rows.append([idx])
+            space.append(pack_len - lengths[idx])
+    return rows
+
+
+def generate_packed_batch(tops, ptr, pad_idx, pack_len):
+    """
+    Pack the decoder inputs of a padded token batch into rows of at
+    least pack_len tokens, the memory of every row is the nodes of the
+    graphs whose sequences it holds
+
+    :param tops: LongTensor [batch_size, max_len], the padded sequences
+    :param ptr: LongTensor [batch_size + 1], the node offsets of graphs
+    :param pad_idx: int, the index of padding token
+    :param pack_len: int, the length of a row, raised to the longest
+        sequence when it is shorter
+    :return: (tgt, label, tgt_mask, packing) where tgt [rows, pack_len]
+        is the packed input, label the outputs of all the real tokens
+        in the flattened order of out_index, tgt_mask [rows, pack_len,
+        pack_len] the block-diagonal causal mask, and packing a dict of
+        the position, memory_index, memory_mask and out_index tensors
+        for PretrainModel
+    """
+    tops, ptr = tops.cpu(), ptr.cpu()
+    batch_size = tops.shape[0]
+    seq_len = (tops != pad_idx).sum(dim=-1) - 1
+    node_num = ptr[1:] - ptr[:-1]
+    pack_len = max(pack_len, seq_len.max().item())
+    rows = pack_sequences(seq_len.tolist(), pack_len)
+
+    seq_row = torch.zeros(batch_size, dtype=torch.long)
+    seq_start = torch.zeros(batch_size, dtype=torch.long)
+    node_start = torch.zeros(batch_size, dtype=torch.long)
+    mem_len = 0
+    for ridx, row in enumerate(rows):
+        row = torch.LongTensor(row)
+        seq_row[row] = ridx
+        seq_start[row] = torch.cumsum(seq_len[row], 0) - seq_len[row]
+        node_start[row] = torch.cumsum(node_num[row], 0) - node_num[row]
+        mem_len = max(mem_len, node_num[row].sum().item())
+
+    # every token and node with its sequence and offset inside it
+    seq_idx = torch.repeat_interleave(torch.arange(batch_size), seq_len)
+    offset = torch.arange(len(seq_idx)) - \
+        torch.repeat_interleave(torch.cumsum(seq_len, 0) - seq_len, seq_len)
+    out_index = seq_row[seq_idx] * pack_len + seq_start[seq_idx] + offset
+
+    graph_idx = torch.repeat_interleave(torch.arange(batch_size), node_num)
+    node_offset = torch.arange(len(graph_idx)) - ptr[graph_idx]
+    mem_index = seq_row[graph_idx] * mem_len + \
+        node_start[graph_idx] + node_offset
+
+    num_row = len(rows)
+    tgt = torch.full((num_row * pack_len, ), pad_idx, dtype=torch.long)
+    tgt[out_index] = tops[seq_idx, offset]
+    label = tops[seq_idx, offset + 1]
+    position = torch.zeros(num_row * pack_len, dtype=torch.long)
+    position[out_index] = offset
+    segment = torch.full((num_row * pack_len, ), -1, dtype=torch.long)
+    segment[out_index] = seq_idx
+    memory_index = torch.zeros(num_row * mem_len, dtype=torch.long)
+    memory_index[mem_index] = torch.arange(len(graph_idx))
+    mem_segment = torch.full((num_row * mem_len, ), -1, dtype=torch.long)
+    mem_segment[mem_index] = graph_idx
+
+    # padding attends to padding only, so no row of a mask is all masked
+    segment = segment.view(num_row, pack_len)
+    mem_segment = mem_segment.view(num_row, mem_len)
+    causal = torch.tril(torch.ones(pack_len, pack_len, dtype=torch.bool))
+    tgt_mask = segment.unsqueeze(-1) == segment.unsqueeze(1)
+    tgt_mask = torch.logical_not(tgt_mask & causal)
+    memory_mask = segment.unsqueeze(-1) == mem_segment.unsqueeze(1)
+    memory_mask |= (segment == -1).unsqueeze(-1)
+    memory_mask = torch.logical_not(memory_mask)
+
+    packing = {
+        'position': position.view(num_row, pack_len),
+        'memory_index': memory_index.view(num_row, mem_len),
+        'memory_mask': memory_mask, 'out_index': out_index
+    }
+    return tgt.view(num_row, pack_len), label, tgt_mask, packing
+
+
 def correct_trans_output(trans_pred, end_idx, pad_idx):
     batch_size, max_len = trans_pred.shape
     device = trans_pred.device
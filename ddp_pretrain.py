@@ -6,15 +6,22 @@ import os
 import time
 
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler
 from sparse_backBone import GATBase
-from Dataset import TransDataset, col_fn_pretrain
-from model import PositionalEncoding, PretrainModel
-from ddp_training import ddp_pretrain, ddp_preeval
+from Dataset import TransDataset, SkipBatchSampler, col_fn_pretrain
+from model import PositionalEncoding, PretrainModel, fill_model_sizes
+from ddp_training import (
+    ddp_pretrain, ddp_preeval, setup_cpu_rank, init_distributed,
+    build_adam, full_optimizer_state
+)
+from checkpoint_utils import (
+    Checkpointer, checkpoint_run_id, get_rng_state, set_rng_state
+)
 from data_utils import fix_seed, check_early_stop
 from tokenlizer import DEFAULT_SP, Tokenizer
 from torch.optim.lr_scheduler import ExponentialLR
 from utils.chemistry_parse import clear_map_number
+import numpy as np
 import pandas
 from tqdm import tqdm
 
@@ -26,14 +33,30 @@ import torch.multiprocessing as torch_mp
 from torch.utils.data.distributed import DistributedSampler
 
 
-def create_log_model(args):
-    timestamp = time.time()
+def create_log_model(args, run_id=None):
+    timestamp = time.time() if run_id is None else run_id
     if not os.path.exists(args.base_log):
         os.makedirs(args.base_log)
     detail_log_dir = os.path.join(args.base_log, f'log-{timestamp}.json')
     detail_model_dir = os.path.join(args.base_log, f'mod-{timestamp}.pth')
     token_path = os.path.join(args.base_log, f'token-{timestamp}.pkl')
-    return detail_log_dir, detail_model_dir, token_path
+    ckpt_prefix = os.path.join(args.base_log, f'ckpt-{timestamp}')
+    return detail_log_dir, detail_model_dir, token_path, ckpt_prefix
+
+
+def load_tokenizer(args):
+    if args.checkpoint != '':
+        assert args.token_ckpt != '', \
+            'require token_ckpt when checkpoint is given'
+        with open(args.token_ckpt, 'rb') as Fin:
+            tokenizer = pickle.load(Fin)
+    else:
+        assert args.token_path != '', 'file containing all tokens are required'
+        SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+
+        with open(args.token_path) as Fin:
+            tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+    return tokenizer
 
 
 def load_moles(data_dir, part, verbose):
@@ -52,19 +75,42 @@ def load_moles(data_dir, part, verbose):
         moles.add(prd)
         if '.' in rea:
             reacts.add(rea)
-    return list(moles), list(reacts)
-
+    # sorted, the order of a set depends on the hash seed of the process
+    return sorted(moles), sorted(reacts)
 
-def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
 
+def main_worker(
+    worker_idx, args, tokenizer, log_dir, model_dir, token_dir, ckpt_prefix
+):
+    worker_idx, local_rank, local_size = init_distributed(worker_idx, args)
     print(f'[INFO] Process {worker_idx} start')
-    torch_dist.init_process_group(
-        backend='nccl', init_method=f'tcp://127.0.0.1:{args.port}',
-        world_size=args.num_gpus, rank=worker_idx
-    )
 
-    device = torch.device(f'cuda:{worker_idx}')
     verbose = (worker_idx == 0)
+    if args.dist_backend == 'gloo':
+        device = torch.device('cpu')
+        threads, cpus = setup_cpu_rank(
+            local_rank, local_size, args.threads_per_rank, args.numa_bind
+        )
+        print(f'[INFO {worker_idx}] {threads} threads on cpus {cpus}')
+    else:
+        device = torch.device(f'cuda:{local_rank}')
+        torch.cuda.set_device(device)
+    pin = device.type == 'cuda'
+
+    if tokenizer is None:
+        # the ranks of torchrun are separate processes and the order of
+        # special tokens depends on the hash seed, so rank 0 builds the
+        # tokenizer, restarted ranks reuse the one of the first attempt
+        if verbose and not os.path.exists(token_dir):
+            with open(token_dir, 'wb') as Fout:
+                pickle.dump(load_tokenizer(args), Fout)
+        torch_dist.barrier()
+        with open(token_dir, 'rb') as Fin:
+            tokenizer = pickle.load(Fin)
+
+    # rank 0 builds the same initial model as the single process scripts,
+    # the other ranks draw their own dropout and augmentation
+    fix_seed(args.seed + worker_idx)
 
     train_moles, train_reac = load_moles(args.data_path, 'train', verbose)
     test_moles, test_reac = load_moles(args.data_path, 'val', verbose)
@@ -74,48 +120,72 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
     train_set = TransDataset(train_moles, train_reac, mode='train')
     test_set = TransDataset(test_moles, test_reac, mode='eval')
 
-    train_sampler = DistributedSampler(train_set, shuffle=True)
+    train_sampler = DistributedSampler(
+        train_set, shuffle=True, seed=args.seed
+    )
     test_sampler = DistributedSampler(test_set, shuffle=False)
 
     train_loader = DataLoader(
-        train_set, collate_fn=col_fn_pretrain, batch_size=args.bs,
-        shuffle=False, pin_memory=True, sampler=train_sampler,
-        num_workers=args.num_workers
+        train_set, collate_fn=col_fn_pretrain, pin_memory=pin,
+        batch_sampler=SkipBatchSampler(BatchSampler(
+            train_sampler, batch_size=args.bs, drop_last=False
+        )), num_workers=args.num_workers
     )
     test_loader = DataLoader(
         test_set, collate_fn=col_fn_pretrain,  batch_size=args.bs,
-        shuffle=False, pin_memory=True, sampler=test_sampler,
+        shuffle=False, pin_memory=pin, sampler=test_sampler,
         num_workers=args.num_workers
     )
 
     GNN = GATBase(
-        num_layers=args.n_layer, dropout=args.dropout,
-        embedding_dim=args.dim, num_heads=args.heads,
-        negative_slope=args.negative_slope, n_class=None
+        num_layers=args.enc_layer, dropout=args.dropout,
+        embedding_dim=args.enc_dim, num_heads=args.enc_heads,
+        negative_slope=args.negative_slope, n_class=None,
+        backend=args.gnn_backend, dense_ratio=args.dense_ratio,
+        edge_hidden=args.enc_ffn, recompute=args.enc_recompute
     )
 
     decode_layer = TransformerDecoderLayer(
-        d_model=args.dim, nhead=args.heads, batch_first=True,
-        dim_feedforward=args.dim * 2, dropout=args.dropout
+        d_model=args.dec_dim, nhead=args.dec_heads, batch_first=True,
+        dim_feedforward=args.dec_ffn, dropout=args.dropout
     )
-    Decoder = TransformerDecoder(decode_layer, args.n_layer)
-    Pos_env = PositionalEncoding(args.dim, args.dropout, maxlen=2000)
+    Decoder = TransformerDecoder(decode_layer, args.dec_layer)
+    Pos_env = PositionalEncoding(args.dec_dim, args.dropout, maxlen=2000)
 
     model = PretrainModel(
         token_size=tokenizer.get_token_size(), encoder=GNN,
-        decoder=Decoder, d_model=args.dim, pos_enc=Pos_env
+        decoder=Decoder, d_model=args.dec_dim, pos_enc=Pos_env,
+        memory_dim=args.enc_dim, recompute=args.dec_recompute
     ).to(device)
 
     if args.checkpoint != '':
         weight = torch.load(args.checkpoint, map_location=device)
         model.load_state_dict(weight)
 
+    checkpointer = Checkpointer(
+        ckpt_prefix, args.ckpt_every, args.keep_ckpt, not args.sync_ckpt
+    )
+    resume_path, state = args.resume, None
+    if int(os.environ.get('TORCHELASTIC_RESTART_COUNT', 0)) > 0:
+        # restarted by torchrun after a failure, the newest state saved
+        # by the ranks of this run
+        resume_path = checkpointer.latest() or resume_path
+    if resume_path != '':
+        print(f'[INFO {worker_idx}] Resuming from {resume_path}')
+        state = torch.load(resume_path, map_location='cpu')
+        model.load_state_dict(state['model'])
+
+    # the graph is static when the used parameters are the same in every
+    # iteration, e.g. use_class always on or off, no search for unused ones
     model = torch.nn.parallel.DistributedDataParallel(
-        model, device_ids=[worker_idx], output_device=worker_idx,
-        find_unused_parameters=True
+        model, find_unused_parameters=not args.static_graph,
+        static_graph=args.static_graph, bucket_cap_mb=args.bucket_cap_mb,
+        gradient_as_bucket_view=args.grad_bucket_view,
+        device_ids=[local_rank] if device.type == 'cuda' else None,
+        output_device=local_rank if device.type == 'cuda' else None
     )
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    optimizer = build_adam(model, args.lr, zero=args.zero)
     lr_scher = ExponentialLR(optimizer, args.lrgamma, verbose=verbose)
     best_cov, best_ep = None, None
 
@@ -124,11 +194,56 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
         'test_metric': []
     }
 
+    def save_state(epoch, step, losses):
+        # every rank has its own rng and loss state
+        ranks = [None] * torch_dist.get_world_size()
+        optimizer_state = full_optimizer_state(optimizer)
+        torch_dist.all_gather_object(ranks, {
+            'rng': get_rng_state(), 'data': {}, 'losses': losses
+        })
+        if verbose:
+            checkpointer.save({
+                'model': model.module.state_dict(),
+                'optimizer': optimizer_state,
+                'lr_sh': lr_scher.state_dict(), 'epoch': epoch,
+                'step': step, 'log_info': log_info, 'best_perf': best_cov,
+                'best_ep': best_ep, 'ranks': ranks
+            }, epoch, step)
+
+    def on_step(step, losses):
+        if checkpointer.step():
+            save_state(ep, step, losses)
+
+    start_ep, resume = 0, None
+    if state is not None:
+        optimizer.load_state_dict(state['optimizer'])
+        lr_scher.load_state_dict(state['lr_sh'])
+        log_info, start_ep = state['log_info'], state['epoch']
+        best_cov, best_ep = state['best_perf'], state['best_ep']
+        if len(state['ranks']) == torch_dist.get_world_size():
+            rank_state = state['ranks'][worker_idx]
+            train_loader.batch_sampler.skip = state['step']
+            if state['step'] > 0:
+                resume = {
+                    'step': state['step'], 'losses': rank_state['losses'],
+                    'rng': rank_state['rng']
+                }
+            else:
+                set_rng_state(rank_state['rng'])
+        elif state['step'] > 0:
+            raise ValueError(
+                'a state saved in the middle of an epoch can only be '
+                'resumed with the same number of ranks'
+            )
+        else:
+            print(f'[INFO {worker_idx}] {len(state["ranks"])} ranks saved '
+                  'the state, the rng is not restored')
+
     if verbose:
         with open(log_dir, 'w') as Fout:
             json.dump(log_info, Fout, indent=4)
 
-    for ep in range(args.epoch):
+    for ep in range(start_ep, args.epoch):
         if verbose:
             print(f'[INFO] traing at epoch {ep + 1}')
 
@@ -136,13 +251,16 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
         loss = ddp_pretrain(
             loader=train_loader, model=model, optimizer=optimizer,
             tokenizer=tokenizer, device=device, pad_token='<PAD>',
-            warmup=(ep < args.warmup), accu=args.accu, verbose=verbose
+            warmup=(ep < args.warmup), accu=args.accu, verbose=verbose,
+            pack_len=args.pack_len, bf16=args.bf16, resume=resume,
+            on_step=on_step
         )
+        resume = None
 
         test_results = ddp_preeval(
             loader=test_loader, model=model, tokenizer=tokenizer,
             pad_token='<PAD>', end_token='<END>', device=device,
-            verbose=verbose
+            verbose=verbose, bf16=args.bf16
         )
         torch_dist.barrier()
         loss.all_reduct(device)
@@ -165,6 +283,8 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
         if ep >= args.warmup:
             lr_scher.step()
 
+        save_state(ep + 1, 0, None)
+
         if args.early_stop >= 5 and ep > max(10, args.early_stop):
             val_his = log_info['test_metric'][-args.early_stop:]
             val_his = [x['trans_acc'] for x in val_his]
@@ -175,6 +295,10 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
     if not verbose:
         return
 
+    checkpointer.wait()
+    if len(checkpointer.blocked) > 0:
+        blocked = np.mean(checkpointer.blocked) * 1e3
+        print(f'[INFO] training blocked {blocked:.1f} ms per checkpoint')
     print('[BEST EP]', best_ep)
     print('[BEST TEST]', log_info['test_metric'][best_ep])
 
@@ -229,10 +353,53 @@ if __name__ == '__main__':
         '--heads', default=4, type=int,
         help='the number of heads for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
     parser.add_argument(
         '--negative_slope', type=float, default=0.2,
         help='negative slope for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention, auto chooses '
+        'between fused and dense by the shape of every batch'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense, '
+        'see benchmarks/dense_backend.py'
+    )
     parser.add_argument(
         '--token_path', type=str, default='',
         help='the path of json containing tokens'
@@ -246,6 +413,25 @@ if __name__ == '__main__':
         help='the path of token checkpoint, required while' +
         ' checkpoint is specified'
     )
+    parser.add_argument(
+        '--resume', type=str, default='',
+        help='the path of a full training state saved by this script, '
+        'the run goes on at the saved step with the same data order'
+    )
+    parser.add_argument(
+        '--ckpt_every', type=int, default=0,
+        help='save the full training state every this number of '
+        'optimizer steps, 0 for the end of every epoch only'
+    )
+    parser.add_argument(
+        '--keep_ckpt', type=int, default=2,
+        help='the number of newest training states kept'
+    )
+    parser.add_argument(
+        '--sync_ckpt', action='store_true',
+        help='write the training states in the training loop instead '
+        'of a background thread'
+    )
     parser.add_argument(
         '--lrgamma', type=float, default=1,
         help='the gamma for lr_scheduler weight decay'
@@ -264,39 +450,101 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--num_gpus', type=int, default=1,
-        help='the number of gpus to train and eval'
+        help='the number of gpus to train and eval, or cpu ranks for gloo, '
+        'unused when started by torchrun'
+    )
+    parser.add_argument(
+        '--dist_backend', type=str, default='nccl',
+        choices=['nccl', 'gloo'],
+        help='the backend of torch.distributed, gloo trains on cpu with '
+        'num_gpus processes'
+    )
+    parser.add_argument(
+        '--threads_per_rank', type=int, default=0,
+        help='the intra-op threads of every rank for gloo, 0 for the cpus '
+        'split evenly over the ranks'
+    )
+    parser.add_argument(
+        '--numa_bind', action='store_true',
+        help='spread the gloo ranks over the numa nodes and pin every rank '
+        'to its share of the cpus of its node'
+    )
+    parser.add_argument(
+        '--static_graph', action='store_true',
+        help='use ddp static graph instead of searching unused parameters '
+        'every iteration, only when all the parameters are always used'
+    )
+    parser.add_argument(
+        '--bucket_cap_mb', type=float, default=25,
+        help='the size of ddp gradient buckets in MiB, larger buckets '
+        'mean fewer and larger all-reduce calls'
+    )
+    parser.add_argument(
+        '--grad_bucket_view', action='store_true',
+        help='keep the gradients as views of the ddp buckets, saving a '
+        'copy and the memory of the gradients'
+    )
+    parser.add_argument(
+        '--zero', action='store_true',
+        help='shard the adam states over the ranks, every rank keeps '
+        'the states of its share of the parameters only'
     )
     parser.add_argument(
         '--port', type=int, default=12345,
-        help='the port for ddp nccl communication'
+        help='the port for ddp communication'
+    )
+    parser.add_argument(
+        '--pack_len', type=int, default=0,
+        help='pack several target sequences into training rows of this '
+        'length with block-diagonal causal masks, 0 for padded batches'
+    )
+    parser.add_argument(
+        '--enc_recompute', type=int, default=0,
+        help='the number of encoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--dec_recompute', type=int, default=0,
+        help='the number of decoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast, for cpus and gpus '
+        'with fast bf16 kernels'
     )
 
     # training
 
-    args = parser.parse_args()
+    args = fill_model_sizes(parser.parse_args())
     print(args)
-
-    log_dir, model_dir, token_dir = create_log_model(args)
-
-    if args.checkpoint != '':
-        assert args.token_ckpt != '', \
-            'require token_ckpt when checkpoint is given'
-        with open(args.token_ckpt, 'rb') as Fin:
-            tokenizer = pickle.load(Fin)
+    run_id = None
+    if args.resume != '':
+        # the resumed run goes on writing the log, model, tokenizer and
+        # training state files of the run that saved the state
+        args.base_log = os.path.dirname(os.path.abspath(args.resume))
+        run_id = checkpoint_run_id(args.resume)
+
+    if 'LOCAL_RANK' in os.environ:
+        # started by torchrun, this process is one of the ranks, the files
+        # are named by the run id so that restarted ranks find them
+        if run_id is None:
+            run_id = os.environ['TORCHELASTIC_RUN_ID']
+        paths = create_log_model(args, run_id)
+        main_worker(int(os.environ['LOCAL_RANK']), args, None, *paths)
     else:
-        assert args.token_path != '', 'file containing all tokens are required'
-        SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
-
-        with open(args.token_path) as Fin:
-            tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
-
-    with open(token_dir, 'wb') as Fout:
-        pickle.dump(tokenizer, Fout)
-
-    print(f'[INFO] padding index', tokenizer.token2idx['<PAD>'])
-    fix_seed(args.seed)
-
-    torch_mp.spawn(
-        main_worker, nprocs=args.num_gpus,
-        args=(args, tokenizer, log_dir, model_dir)
-    )
+        paths = create_log_model(args, run_id)
+        if args.resume != '':
+            with open(paths[2], 'rb') as Fin:
+                tokenizer = pickle.load(Fin)
+        else:
+            tokenizer = load_tokenizer(args)
+            with open(paths[2], 'wb') as Fout:
+                pickle.dump(tokenizer, Fout)
+
+        print(f'[INFO] padding index', tokenizer.token2idx['<PAD>'])
+        fix_seed(args.seed)
+
+        torch_mp.spawn(
+            main_worker, nprocs=args.num_gpus, args=(args, tokenizer, *paths)
+        )
@@ -4,18 +4,35 @@ import json
 import os
 import time
 import pickle
+import glob
 
 
 from tokenlizer import DEFAULT_SP, Tokenizer
-from torch.utils.data import DataLoader
-from model import PositionalEncoding, PretrainModel
-from Dataset import RetroDataset, col_fn_retro
-
-from ddp_training import ddp_pretrain, ddp_preeval
-from data_utils import load_data, fix_seed, check_early_stop
+from torch.utils.data import DataLoader, BatchSampler
+from model import PositionalEncoding, PretrainModel, fill_model_sizes
+from Dataset import (
+    RetroDataset, StreamingRetroDataset, StreamCollate, col_fn_retro,
+    SizeSortedBatchSampler, SkipBatchSampler
+)
+
+from ddp_training import (
+    ddp_pretrain, ddp_preeval, setup_cpu_rank, init_distributed,
+    build_adam, full_optimizer_state
+)
+from checkpoint_utils import (
+    Checkpointer, checkpoint_run_id, get_rng_state, set_rng_state,
+    dump_json_atomic, sidecar_path
+)
+from data_utils import (
+    load_data, load_data_columnar, convert_to_columnar, fix_seed,
+    check_early_stop
+)
 from torch.nn import TransformerDecoderLayer, TransformerDecoder
 from torch.optim.lr_scheduler import ExponentialLR
 from sparse_backBone import GATBase
+from lora_utils import add_lora, adapter_state
+from utils.chemistry_parse import count_atoms
+import numpy as np
 
 
 import torch.distributed as torch_dist
@@ -23,36 +40,88 @@ import torch.multiprocessing as torch_mp
 from torch.utils.data.distributed import DistributedSampler
 
 
-def create_log_model(args):
-    timestamp = time.time()
+def create_log_model(args, run_id=None):
+    timestamp = time.time() if run_id is None else run_id
     if not os.path.exists(args.base_log):
         os.makedirs(args.base_log)
     detail_log_dir = os.path.join(args.base_log, f'log-{timestamp}.json')
-    detail_model_dir = os.path.join(args.base_log, f'mod-{timestamp}.pth')
+    # the adapters only when training low rank adapters
+    model_name = 'adapter' if args.lora_rank > 0 else 'mod'
+    detail_model_dir = os.path.join(
+        args.base_log, f'{model_name}-{timestamp}.pth'
+    )
     token_path = os.path.join(args.base_log, f'token-{timestamp}.pkl')
-    return detail_log_dir, detail_model_dir, token_path
+    ckpt_prefix = os.path.join(args.base_log, f'ckpt-{timestamp}')
+    return detail_log_dir, detail_model_dir, token_path, ckpt_prefix
+
+
+def load_tokenizer(args):
+    if args.checkpoint != '':
+        assert args.token_ckpt != '', \
+            'require token_ckpt when checkpoint is given'
+        with open(args.token_ckpt, 'rb') as Fin:
+            tokenizer = pickle.load(Fin)
+    else:
+        assert args.token_path != '', 'file containing all tokens are required'
+        SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
+
+        with open(args.token_path) as Fin:
+            tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
+    return tokenizer
 
 
-def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
+def prepare_columnar(args):
+    # converted once, every rank maps the same files
+    parts = ['val', 'test'] if args.train_shards else \
+        ['train', 'val', 'test']
+    for part in parts:
+        convert_to_columnar(args.data_path, part)
+
+
+def main_worker(
+    worker_idx, args, tokenizer, log_dir, model_dir, token_dir, ckpt_prefix
+):
+    worker_idx, local_rank, local_size = init_distributed(worker_idx, args)
     print(f'[INFO] Process {worker_idx} start')
-    torch_dist.init_process_group(
-        backend='nccl', init_method=f'tcp://127.0.0.1:{args.port}',
-        world_size=args.num_gpus, rank=worker_idx
-    )
 
-    device = torch.device(f'cuda:{worker_idx}')
     verbose = (worker_idx == 0)
+    if args.dist_backend == 'gloo':
+        device = torch.device('cpu')
+        threads, cpus = setup_cpu_rank(
+            local_rank, local_size, args.threads_per_rank, args.numa_bind
+        )
+        print(f'[INFO {worker_idx}] {threads} threads on cpus {cpus}')
+    else:
+        device = torch.device(f'cuda:{local_rank}')
+        torch.cuda.set_device(device)
+    pin = device.type == 'cuda'
+
+    if tokenizer is None:
+        # the ranks of torchrun are separate processes and the order of
+        # special tokens depends on the hash seed, so rank 0 builds the
+        # tokenizer, restarted ranks reuse the one of the first attempt
+        if verbose and not os.path.exists(token_dir):
+            with open(token_dir, 'wb') as Fout:
+                pickle.dump(load_tokenizer(args), Fout)
+            if args.columnar:
+                prepare_columnar(args)
+        torch_dist.barrier()
+        with open(token_dir, 'rb') as Fin:
+            tokenizer = pickle.load(Fin)
+
+    # rank 0 builds the same initial model as the single process scripts,
+    # the other ranks draw their own dropout and augmentation
+    fix_seed(args.seed + worker_idx)
 
-    train_rec, train_prod, train_rxn = load_data(args.data_path, 'train')
-    val_rec, val_prod, val_rxn = load_data(args.data_path, 'val')
-    test_rec, test_prod, test_rxn = load_data(args.data_path, 'test')
+    data_loader_fn = load_data_columnar if args.columnar else load_data
+    if args.train_shards == '':
+        train_rec, train_prod, train_rxn = \
+            data_loader_fn(args.data_path, 'train')
+    val_rec, val_prod, val_rxn = data_loader_fn(args.data_path, 'val')
+    test_rec, test_prod, test_rxn = data_loader_fn(args.data_path, 'test')
 
     print(f'[INFO] worker {worker_idx} Data Loaded')
 
-    train_set = RetroDataset(
-        prod_sm=train_prod, reat_sm=train_rec, aug_prob=args.aug_prob,
-        rxn_cls=train_rxn if args.use_class else None
-    )
     valid_set = RetroDataset(
         prod_sm=val_prod, reat_sm=val_rec, aug_prob=0,
         rxn_cls=val_rxn if args.use_class else None
@@ -62,42 +131,79 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
         rxn_cls=test_rxn if args.use_class else None
     )
 
-    train_sampler = DistributedSampler(train_set, shuffle=True)
     valid_sampler = DistributedSampler(valid_set, shuffle=False)
     test_sampler = DistributedSampler(test_set, shuffle=False)
 
-    train_loader = DataLoader(
-        train_set, collate_fn=col_fn_retro, sampler=train_sampler,
-        batch_size=args.bs, shuffle=False, pin_memory=True,
-        num_workers=args.num_workers
-    )
+    if args.train_shards != '':
+        # shards are split over ranks and workers by the dataset itself,
+        # which also takes the set_epoch calls meant for the sampler
+        train_set = StreamingRetroDataset(
+            shards=glob.glob(args.train_shards), aug_prob=args.aug_prob,
+            use_class=args.use_class, buffer_size=args.shuffle_buffer,
+            seed=args.seed, num_workers=args.num_workers
+        )
+        train_sampler = train_set
+        train_loader = DataLoader(
+            train_set, collate_fn=StreamCollate(train_set),
+            batch_size=args.bs, pin_memory=pin,
+            num_workers=args.num_workers
+        )
+    else:
+        train_set = RetroDataset(
+            prod_sm=train_prod, reat_sm=train_rec, aug_prob=args.aug_prob,
+            rxn_cls=train_rxn if args.use_class else None
+        )
+        train_sampler = DistributedSampler(
+            train_set, shuffle=True, seed=args.seed
+        )
+        if args.size_sort:
+            # sorted within the indices of this rank, set_epoch still
+            # goes to the distributed sampler
+            batch_sampler = SizeSortedBatchSampler(
+                sampler=train_sampler, batch_size=args.bs,
+                sizes=np.array([count_atoms(x) for x in train_prod]),
+                pool_size=args.sort_pool, seed=args.seed
+            )
+        else:
+            batch_sampler = BatchSampler(
+                train_sampler, batch_size=args.bs, drop_last=False
+            )
+        train_loader = DataLoader(
+            train_set, collate_fn=col_fn_retro, pin_memory=pin,
+            batch_sampler=SkipBatchSampler(batch_sampler),
+            num_workers=args.num_workers
+        )
     valid_loader = DataLoader(
         valid_set, collate_fn=col_fn_retro, sampler=valid_sampler,
-        batch_size=args.bs, shuffle=False, pin_memory=True,
+        batch_size=args.bs, shuffle=False, pin_memory=pin,
         num_workers=args.num_workers
     )
     test_loader = DataLoader(
         test_set, collate_fn=col_fn_retro, sampler=test_sampler,
-        batch_size=args.bs, shuffle=False, pin_memory=True,
+        batch_size=args.bs, shuffle=False, pin_memory=pin,
         num_workers=args.num_workers
     )
 
     GNN = GATBase(
-        num_layers=args.n_layer, dropout=args.dropout, num_heads=args.heads,
-        embedding_dim=args.dim, negative_slope=args.negative_slope,
-        n_class=11 if args.use_class else None
+        num_layers=args.enc_layer, dropout=args.dropout,
+        embedding_dim=args.enc_dim, num_heads=args.enc_heads,
+        negative_slope=args.negative_slope,
+        n_class=11 if args.use_class else None,
+        backend=args.gnn_backend, dense_ratio=args.dense_ratio,
+        edge_hidden=args.enc_ffn, recompute=args.enc_recompute
     )
 
     decode_layer = TransformerDecoderLayer(
-        d_model=args.dim, nhead=args.heads, batch_first=True,
-        dim_feedforward=args.dim * 2, dropout=args.dropout
+        d_model=args.dec_dim, nhead=args.dec_heads, batch_first=True,
+        dim_feedforward=args.dec_ffn, dropout=args.dropout
     )
-    Decoder = TransformerDecoder(decode_layer, args.n_layer)
-    Pos_env = PositionalEncoding(args.dim, args.dropout, maxlen=2000)
+    Decoder = TransformerDecoder(decode_layer, args.dec_layer)
+    Pos_env = PositionalEncoding(args.dec_dim, args.dropout, maxlen=2000)
 
     model = PretrainModel(
         token_size=tokenizer.get_token_size(), encoder=GNN,
-        decoder=Decoder, d_model=args.dim, pos_enc=Pos_env
+        decoder=Decoder, d_model=args.dec_dim, pos_enc=Pos_env,
+        memory_dim=args.enc_dim, recompute=args.dec_recompute
     ).to(device)
 
     if args.checkpoint != '':
@@ -106,12 +212,34 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
         weight = torch.load(args.checkpoint, map_location=device)
         model.load_state_dict(weight, strict=True)
 
+    if args.lora_rank > 0:
+        add_lora(model, args.lora_rank, args.lora_alpha, args.lora_parts)
+
+    checkpointer = Checkpointer(
+        ckpt_prefix, args.ckpt_every, args.keep_ckpt, not args.sync_ckpt,
+        sidecar=sidecar_path(ckpt_prefix)
+    )
+    resume_path, state = args.resume, None
+    if int(os.environ.get('TORCHELASTIC_RESTART_COUNT', 0)) > 0:
+        # restarted by torchrun after a failure, the newest state saved
+        # by the ranks of this run
+        resume_path = checkpointer.latest() or resume_path
+    if resume_path != '':
+        print(f'[INFO {worker_idx}] Resuming from {resume_path}')
+        state = torch.load(resume_path, map_location='cpu')
+        model.load_state_dict(state['model'])
+
+    # the graph is static when the used parameters are the same in every
+    # iteration, e.g. use_class always on or off, no search for unused ones
     model = torch.nn.parallel.DistributedDataParallel(
-        model, device_ids=[worker_idx], output_device=worker_idx,
-        find_unused_parameters=True
+        model, find_unused_parameters=not args.static_graph,
+        static_graph=args.static_graph, bucket_cap_mb=args.bucket_cap_mb,
+        gradient_as_bucket_view=args.grad_bucket_view,
+        device_ids=[local_rank] if device.type == 'cuda' else None,
+        output_device=local_rank if device.type == 'cuda' else None
     )
 
-    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    optimizer = build_adam(model, args.lr, zero=args.zero)
     lr_sh = ExponentialLR(optimizer, gamma=args.gamma, verbose=verbose)
     best_perf, best_ep = None, None
 
@@ -122,58 +250,125 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
         'valid_metric': [], 'test_metric': []
     }
 
-    with open(log_dir, 'w') as Fout:
-        json.dump(log_info, Fout, indent=4)
-
-    for ep in range(args.epoch):
+    def train_data_state():
+        if args.train_shards != '':
+            return train_set.state_dict()
+        return train_loader.batch_sampler.state_dict()
+
+    def save_state(epoch, step, losses, data_state):
+        # every rank has its own rng, data and loss state
+        ranks = [None] * torch_dist.get_world_size()
+        optimizer_state = full_optimizer_state(optimizer)
+        torch_dist.all_gather_object(ranks, {
+            'rng': get_rng_state(), 'data': data_state, 'losses': losses
+        })
+        if verbose:
+            checkpointer.save({
+                'model': model.module.state_dict(),
+                'optimizer': optimizer_state,
+                'lr_sh': lr_sh.state_dict(), 'epoch': epoch, 'step': step,
+                'log_info': log_info, 'best_perf': best_perf,
+                'best_ep': best_ep, 'ranks': ranks
+            }, epoch, step)
+
+    def on_step(step, losses):
+        # the stream goes on from its cursor, the sampler replays the
+        # epoch from its state at the start of the epoch
+        if checkpointer.step():
+            data_state = epoch_data_state if args.train_shards == '' \
+                else train_set.state_dict()
+            save_state(ep, step, losses, data_state)
+
+    start_ep, resume = 0, None
+    if state is not None:
+        optimizer.load_state_dict(state['optimizer'])
+        lr_sh.load_state_dict(state['lr_sh'])
+        log_info, start_ep = state['log_info'], state['epoch']
+        best_perf, best_ep = state['best_perf'], state['best_ep']
+        if len(state['ranks']) == torch_dist.get_world_size():
+            rank_state = state['ranks'][worker_idx]
+            if args.train_shards != '':
+                train_set.load_state_dict(rank_state['data'])
+            else:
+                train_loader.batch_sampler.load_state_dict(rank_state['data'])
+                train_loader.batch_sampler.skip = state['step']
+            if state['step'] > 0:
+                resume = {
+                    'step': state['step'], 'losses': rank_state['losses'],
+                    'rng': rank_state['rng']
+                }
+            else:
+                set_rng_state(rank_state['rng'])
+        elif state['step'] > 0:
+            raise ValueError(
+                'a state saved in the middle of an epoch can only be '
+                'resumed with the same number of ranks'
+            )
+        else:
+            print(f'[INFO {worker_idx}] {len(state["ranks"])} ranks saved '
+                  'the state, the rng and data order are not restored')
+
+    dump_json_atomic(log_info, log_dir)
+
+    for ep in range(start_ep, args.epoch):
         if verbose:
             print(f'[INFO] traing at epoch {ep + 1}')
 
         train_sampler.set_epoch(ep)
+        epoch_data_state = train_data_state()
         train_loss = ddp_pretrain(
             loader=train_loader, model=model, optimizer=optimizer,
             tokenizer=tokenizer, device=device, pad_token='<PAD>',
             warmup=(ep < args.warmup), accu=args.accu, verbose=verbose,
-            label_smoothing=args.label_smoothing
+            label_smoothing=args.label_smoothing, pack_len=args.pack_len,
+            bf16=args.bf16, resume=resume, on_step=on_step
         )
+        resume = None
 
         valid_result = ddp_preeval(
             loader=valid_loader, model=model, tokenizer=tokenizer,
             pad_token='<PAD>', end_token='<END>', device=device,
-            verbose=verbose
+            verbose=verbose, bf16=args.bf16
         )
 
-        test_result = ddp_preeval(
-            loader=test_loader, model=model, tokenizer=tokenizer,
-            pad_token='<PAD>', end_token='<END>', device=device,
-            verbose=verbose
-        )
+        if not args.no_test_eval:
+            test_result = ddp_preeval(
+                loader=test_loader, model=model, tokenizer=tokenizer,
+                pad_token='<PAD>', end_token='<END>', device=device,
+                verbose=verbose, bf16=args.bf16
+            )
 
         torch_dist.barrier()
         train_loss.all_reduct(device)
         valid_result.all_reduct(device)
-        test_result.all_reduct(device)
 
         log_info['train_loss'].append(train_loss.get_all_value_dict())
         log_info['valid_metric'].append(valid_result.get_all_value_dict())
-        log_info['test_metric'].append(test_result.get_all_value_dict())
+        if not args.no_test_eval:
+            test_result.all_reduct(device)
+            log_info['test_metric'].append(test_result.get_all_value_dict())
 
         if verbose:
             print('[TRAIN]', log_info['train_loss'][-1])
             print('[VALID]', log_info['valid_metric'][-1])
-            print('[TEST]', log_info['test_metric'][-1])
+            if not args.no_test_eval:
+                print('[TEST]', log_info['test_metric'][-1])
             this_valid = log_info['valid_metric'][-1]
 
-            with open(log_dir, 'w') as Fout:
-                json.dump(log_info, Fout, indent=4)
+            dump_json_atomic(log_info, log_dir)
 
             if best_perf is None or this_valid['trans_acc'] > best_perf:
                 best_perf, best_ep = this_valid['trans_acc'], ep
-                torch.save(model.module.state_dict(), model_dir)
+                torch.save(
+                    adapter_state(model.module) if args.lora_rank > 0
+                    else model.module.state_dict(), model_dir
+                )
 
         if ep >= args.warmup and ep >= args.step_start:
             lr_sh.step()
 
+        save_state(ep + 1, 0, None, train_data_state())
+
         if args.early_stop > 3 and ep > max(10, args.early_stop):
             tx = log_info['valid_metric'][-args.early_stop:]
             tx = [x['trans_acc'] for x in tx]
@@ -184,9 +379,17 @@ def main_worker(worker_idx, args, tokenizer, log_dir, model_dir):
     if not verbose:
         return
 
+    checkpointer.wait()
+    # eval_sidecar.py exits once the states before it are evaluated
+    log_info['finished'] = True
+    dump_json_atomic(log_info, log_dir)
+    if len(checkpointer.blocked) > 0:
+        blocked = np.mean(checkpointer.blocked) * 1e3
+        print(f'[INFO] training blocked {blocked:.1f} ms per checkpoint')
     print(f'[INFO] best acc epoch: {best_ep}')
     print(f'[INFO] best valid loss: {log_info["valid_metric"][best_ep]}')
-    print(f'[INFO] best test loss: {log_info["test_metric"][best_ep]}')
+    if not args.no_test_eval:
+        print(f'[INFO] best test loss: {log_info["test_metric"][best_ep]}')
 
 
 if __name__ == '__main__':
@@ -212,6 +415,38 @@ if __name__ == '__main__':
         '--heads', default=4, type=int,
         help='the number of heads for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
     parser.add_argument(
         '--warmup', default=1, type=int,
         help='the epoch of warmup'
@@ -228,6 +463,17 @@ if __name__ == '__main__':
         '--negative_slope', type=float, default=0.2,
         help='negative slope for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention, auto chooses '
+        'between fused and dense by the shape of every batch'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense, '
+        'see benchmarks/dense_backend.py'
+    )
     parser.add_argument(
         '--data_path', required=True, type=str,
         help='the path containing dataset'
@@ -251,7 +497,44 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--num_gpus', default=1, type=int,
-        help='the number of gpus to run ddp'
+        help='the number of gpus to run ddp, or cpu ranks for gloo, '
+        'unused when started by torchrun'
+    )
+    parser.add_argument(
+        '--dist_backend', type=str, default='nccl',
+        choices=['nccl', 'gloo'],
+        help='the backend of torch.distributed, gloo trains on cpu with '
+        'num_gpus processes'
+    )
+    parser.add_argument(
+        '--threads_per_rank', type=int, default=0,
+        help='the intra-op threads of every rank for gloo, 0 for the cpus '
+        'split evenly over the ranks'
+    )
+    parser.add_argument(
+        '--numa_bind', action='store_true',
+        help='spread the gloo ranks over the numa nodes and pin every rank '
+        'to its share of the cpus of its node'
+    )
+    parser.add_argument(
+        '--static_graph', action='store_true',
+        help='use ddp static graph instead of searching unused parameters '
+        'every iteration, only when all the parameters are always used'
+    )
+    parser.add_argument(
+        '--bucket_cap_mb', type=float, default=25,
+        help='the size of ddp gradient buckets in MiB, larger buckets '
+        'mean fewer and larger all-reduce calls'
+    )
+    parser.add_argument(
+        '--grad_bucket_view', action='store_true',
+        help='keep the gradients as views of the ddp buckets, saving a '
+        'copy and the memory of the gradients'
+    )
+    parser.add_argument(
+        '--zero', action='store_true',
+        help='shard the adam states over the ranks, every rank keeps '
+        'the states of its share of the parameters only'
     )
     parser.add_argument(
         '--lr', default='1e-3', type=float,
@@ -277,6 +560,26 @@ if __name__ == '__main__':
         '--token_ckpt', type=str, default='',
         help='the path of tokenizer, when ckpt is loaded, necessary'
     )
+    parser.add_argument(
+        '--resume', type=str, default='',
+        help='the path of a full training state saved by this script, '
+        'the run goes on at the saved step with the same data order'
+    )
+    parser.add_argument(
+        '--ckpt_every', type=int, default=0,
+        help='save the full training state every this number of '
+        'optimizer steps, 0 for the end of every epoch only'
+    )
+    parser.add_argument(
+        '--keep_ckpt', type=int, default=2,
+        help='the number of newest training states kept, the states '
+        'eval_sidecar.py has yet to evaluate are kept as well'
+    )
+    parser.add_argument(
+        '--sync_ckpt', action='store_true',
+        help='write the training states in the training loop instead '
+        'of a background thread'
+    )
     parser.add_argument(
         '--use_class', action='store_true',
         help='use class for model or not'
@@ -293,28 +596,101 @@ if __name__ == '__main__':
         '--port', type=int, default=12225,
         help='the port for ddp communation'
     )
+    parser.add_argument(
+        '--train_shards', type=str, default='',
+        help='glob of csv shards streamed as training set instead of '
+        'the train split in data_path, for corpora larger than memory'
+    )
+    parser.add_argument(
+        '--shuffle_buffer', type=int, default=10000,
+        help='the size of shuffle buffer for streamed training shards'
+    )
+    parser.add_argument(
+        '--columnar', action='store_true',
+        help='store the dataset as memory-mapped columnar files, shared '
+        'by all the dataloader workers and ddp processes'
+    )
+    parser.add_argument(
+        '--size_sort', action='store_true',
+        help='make training batches of molecules with similar sizes, '
+        'less padding in the encoder memory'
+    )
+    parser.add_argument(
+        '--sort_pool', type=int, default=100,
+        help='the number of batches sorted together for --size_sort'
+    )
+    parser.add_argument(
+        '--pack_len', type=int, default=0,
+        help='pack several target sequences into training rows of this '
+        'length with block-diagonal causal masks, 0 for padded batches'
+    )
+    parser.add_argument(
+        '--enc_recompute', type=int, default=0,
+        help='the number of encoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--dec_recompute', type=int, default=0,
+        help='the number of decoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast, for cpus and gpus '
+        'with fast bf16 kernels'
+    )
+    parser.add_argument(
+        '--no_test_eval', action='store_true',
+        help='skip the teacher forcing evaluation on the test set after '
+        'every epoch, leaving the test set to eval_sidecar.py'
+    )
+    parser.add_argument(
+        '--lora_rank', type=int, default=0,
+        help='freeze the model of checkpoint and train low rank adapters '
+        'of this rank only, 0 for training the whole model'
+    )
+    parser.add_argument(
+        '--lora_alpha', type=float, default=16,
+        help='the adapters are scaled by lora_alpha / lora_rank'
+    )
+    parser.add_argument(
+        '--lora_parts', type=str, default=['encoder', 'decoder'],
+        nargs='+', choices=['encoder', 'decoder'],
+        help='the parts of model getting adapters'
+    )
 
-    args = parser.parse_args()
+    args = fill_model_sizes(parser.parse_args())
     print(args)
-    log_dir, model_dir, token_dir = create_log_model(args)
-    fix_seed(args.seed)
-
-    if args.checkpoint != '':
-        assert args.token_ckpt != '', \
-            'require token_ckpt when checkpoint is given'
-        with open(args.token_ckpt, 'rb') as Fin:
-            tokenizer = pickle.load(Fin)
+    assert args.lora_rank == 0 or args.checkpoint != '', \
+        'adapters are trained on the model of checkpoint'
+    run_id = None
+    if args.resume != '':
+        # the resumed run goes on writing the log, model, tokenizer and
+        # training state files of the run that saved the state
+        args.base_log = os.path.dirname(os.path.abspath(args.resume))
+        run_id = checkpoint_run_id(args.resume)
+
+    if 'LOCAL_RANK' in os.environ:
+        # started by torchrun, this process is one of the ranks, the files
+        # are named by the run id so that restarted ranks find them
+        if run_id is None:
+            run_id = os.environ['TORCHELASTIC_RUN_ID']
+        paths = create_log_model(args, run_id)
+        main_worker(int(os.environ['LOCAL_RANK']), args, None, *paths)
     else:
-        assert args.token_path != '', 'file containing all tokens are required'
-        SP_TOKEN = DEFAULT_SP | set([f"<RXN>_{i}" for i in range(11)])
-
-        with open(args.token_path) as Fin:
-            tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
-
-    with open(token_dir, 'wb') as Fout:
-        pickle.dump(tokenizer, Fout)
-
-    torch_mp.spawn(
-        main_worker, nprocs=args.num_gpus,
-        args=(args, tokenizer, log_dir, model_dir)
-    )
+        paths = create_log_model(args, run_id)
+        fix_seed(args.seed)
+        if args.resume != '':
+            with open(paths[2], 'rb') as Fin:
+                tokenizer = pickle.load(Fin)
+        else:
+            tokenizer = load_tokenizer(args)
+            with open(paths[2], 'wb') as Fout:
+                pickle.dump(tokenizer, Fout)
+
+        if args.columnar:
+            prepare_columnar(args)
+
+        torch_mp.spawn(
+            main_worker, nprocs=args.num_gpus, args=(args, tokenizer, *paths)
+        )
@@ -1,15 +1,20 @@
 from tqdm import tqdm
+import contextlib
 import numpy as np
 import torch
+import glob
+import os
 from torch.nn.functional import cross_entropy
 from data_utils import (
     generate_tgt_mask, correct_trans_output,
-    convert_log_into_label
+    convert_log_into_label, generate_packed_batch, bf16_autocast
 )
 
 from data_utils import eval_trans as data_eval_trans
-from training import calc_trans_loss
+from training import calc_trans_loss, calc_packed_loss
+from checkpoint_utils import set_rng_state
 import torch.distributed as torch_dist
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from enum import Enum
 
 
@@ -39,6 +44,13 @@ class MetricCollector(object):
         self.sum, self.cnt = infos.tolist()
         self.avg = self.sum / self.cnt
 
+    def state_dict(self):
+        return {'val': self.val, 'sum': self.sum, 'cnt': self.cnt}
+
+    def load_state_dict(self, state):
+        self.val, self.sum, self.cnt = state['val'], state['sum'], state['cnt']
+        self.avg = self.sum / self.cnt if self.cnt > 0 else 0
+
     def __str__(self):
         return ''.join([
             '{name}: {val', self.type_fmt, '} avg: {avg', self.type_fmt, '}'
@@ -88,77 +100,235 @@ class MetricManager(object):
         return {x.name: x.get_value() for x in self.metrics}
 
 
-def warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor):
+def parse_cpulist(cpulist):
+    # the "0-3,8,10-11" format of sysfs
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part == '':
+            continue
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """
+    the cpus of every numa node this process may run on, read from
+    sysfs, one node with all the allowed cpus when it is not available
+    """
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for path in sorted(paths, key=lambda x: int(x.split('/')[-2][4:])):
+        with open(path) as Fin:
+            cpus = [x for x in parse_cpulist(Fin.read()) if x in allowed]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    return nodes if len(nodes) > 0 else [sorted(allowed)]
+
+
+def setup_cpu_rank(rank, world_size, threads=0, numa_bind=False):
+    """
+    the intra-op threads of a rank training on cpu, the cpus are split
+    evenly over the ranks unless threads is given, with numa_bind the
+    ranks are spread over the numa nodes round robin and every rank is
+    pinned to its share of the cpus of its node, so that its memory is
+    allocated on the local node
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if numa_bind:
+        nodes = numa_nodes()
+        node = nodes[rank % len(nodes)]
+        peers = list(range(rank % len(nodes), world_size, len(nodes)))
+        idx, num = peers.index(rank), len(peers)
+        cpus = node[idx * len(node) // num: (idx + 1) * len(node) // num]
+        cpus = cpus if len(cpus) > 0 else node
+        os.sched_setaffinity(0, cpus)
+        num_share = 1
+    else:
+        num_share = world_size
+    if threads <= 0:
+        threads = max(1, len(cpus) // num_share)
+    torch.set_num_threads(threads)
+    return threads, cpus
+
+
+def init_distributed(worker_idx, args):
+    """
+    joins the process group, the ranks started by torchrun find the
+    rendezvous in the environment, the spawned ones the port on localhost,
+    returns the global rank, the local rank and the ranks on this host
+    """
+    if 'LOCAL_RANK' in os.environ:
+        torch_dist.init_process_group(
+            backend=args.dist_backend, init_method='env://'
+        )
+        return torch_dist.get_rank(), int(os.environ['LOCAL_RANK']), \
+            int(os.environ['LOCAL_WORLD_SIZE'])
+    torch_dist.init_process_group(
+        backend=args.dist_backend,
+        init_method=f'tcp://127.0.0.1:{args.port}',
+        world_size=args.num_gpus, rank=worker_idx
+    )
+    return worker_idx, worker_idx, args.num_gpus
+
+
+def warmup_lr_scheduler(
+    optimizer, warmup_iters, warmup_factor, last_iter=-1
+):
     def f(x):
         if x >= warmup_iters:
             return 1
         alpha = float(x) / warmup_iters
         return warmup_factor * (1 - alpha) + alpha
 
-    return torch.optim.lr_scheduler.LambdaLR(optimizer, f)
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, f, last_iter)
+
+
+def build_adam(model, lr, zero=False):
+    """
+    Adam over the trainable parameters of model, with zero the states
+    are sharded over the ranks as ZeRO stage 1, every rank keeps and
+    updates the moments of its share of the parameters only and
+    broadcasts the updated parameters. The param_groups are the full
+    ones, so the lr schedulers work the same on both.
+    """
+    # frozen parameters, e.g. the base model of adapters, are left out
+    params = [x for x in model.parameters() if x.requires_grad]
+    if zero:
+        return ZeroRedundancyOptimizer(
+            params, optimizer_class=torch.optim.Adam, lr=lr
+        )
+    return torch.optim.Adam(params, lr=lr)
+
+
+def full_optimizer_state(optimizer, dst=0):
+    """
+    the state_dict of the optimizer on rank dst, the same format for
+    both optimizers of build_adam, so it loads into either of them.
+    For the sharded one this gathers the shards, a collective to be
+    called on all the ranks, the other ranks get None.
+    """
+    if not isinstance(optimizer, ZeroRedundancyOptimizer):
+        return optimizer.state_dict()
+    optimizer.consolidate_state_dict(to=dst)
+    if torch_dist.get_rank() == dst:
+        return optimizer.state_dict()
+    return None
 
 
 def ddp_pretrain(
     loader, model, optimizer, device, tokenizer, pad_token,
-    warmup, accu=1, verbose=False, label_smoothing=0
+    warmup, accu=1, verbose=False, label_smoothing=0, pack_len=0,
+    bf16=False, resume=None, on_step=None
 ):
+    # resume and on_step as in training.pretrain, with the state_dict of
+    # the loss collector instead of the list of losses
     model = model.train()
     losses = MetricCollector('loss', type_fmt=':.3f')
     manager = MetricManager([losses])
     ignore_idx = tokenizer.token2idx[pad_token]
-    its, total_len = 1, len(loader)
+    start = 0 if resume is None else resume['step']
+    its, total_len = start + 1, start + len(loader)
     if warmup:
-        warmup_iters = len(loader) - 1
-        warmup_sher = warmup_lr_scheduler(optimizer, warmup_iters, 5e-2)
-
-    iterx = tqdm(loader, desc='train') if verbose else loader
-    for graph, tran in iterx:
-        graph = graph.to(device, non_blocking=True)
-        tops = torch.LongTensor(tokenizer.encode2d(tran))
-        tops = tops.to(device, non_blocking=True)
-        trans_dec_ip = tops[:, :-1]
-        trans_dec_op = tops[:, 1:]
-
-        trans_op_mask, diag_mask = generate_tgt_mask(
-            trans_dec_ip, tokenizer, pad_token, 'cpu'
-        )
-
-        trans_op_mask = trans_op_mask.to(device, non_blocking=True)
-        diag_mask = diag_mask.to(device, non_blocking=True)
-
-        trans_logs = model(
-            graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
-            tgt_pad_mask=trans_op_mask
-        )
-
-        loss = calc_trans_loss(
-            trans_logs, trans_dec_op, ignore_idx,
-            lbsm=label_smoothing
+        warmup_iters = total_len - 1
+        warmup_sher = warmup_lr_scheduler(
+            optimizer, warmup_iters, 5e-2, last_iter=start - 1
         )
 
-        if not warmup and accu > 1:
-            loss = loss / accu
-        loss.backward()
-
-        if its % accu == 0 or its == total_len or warmup:
+    batches = iter(loader)
+    if resume is not None:
+        losses.load_state_dict(resume['losses'])
+        set_rng_state(resume['rng'])
+    iterx = tqdm(batches, desc='train', total=total_len - start) \
+        if verbose else batches
+    for graph, tran in iterx:
+        # only the micro-batch before optimizer.step all-reduces, the
+        # others accumulate their gradients locally under no_sync, a static
+        # graph is recorded in the first iteration which has to all-reduce,
+        # the first of this call as a resumed epoch may start a new wrapper
+        # in the middle of accu, an extra all-reduce is still exact as the
+        # averaging is linear
+        step = its % accu == 0 or its == total_len or warmup
+        sync = step or (its == start + 1 and model.static_graph)
+        with contextlib.nullcontext() if sync else model.no_sync():
+            tops = torch.LongTensor(tokenizer.encode2d(tran))
+            if pack_len > 0:
+                trans_dec_ip, trans_dec_op, diag_mask, packing = \
+                    generate_packed_batch(
+                        tops, graph.ptr, ignore_idx, pack_len
+                    )
+                packing = {
+                    k: v.to(device, non_blocking=True)
+                    for k, v in packing.items()
+                }
+                graph = graph.to(device, non_blocking=True)
+                trans_dec_ip = trans_dec_ip.to(device, non_blocking=True)
+                trans_dec_op = trans_dec_op.to(device, non_blocking=True)
+                diag_mask = diag_mask.to(device, non_blocking=True)
+
+                with bf16_autocast(device, bf16):
+                    trans_logs = model(
+                        graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
+                        tgt_pad_mask=None, packing=packing
+                    )
+
+                loss = calc_packed_loss(
+                    trans_logs, trans_dec_op, len(tran), lbsm=label_smoothing
+                )
+            else:
+                graph = graph.to(device, non_blocking=True)
+                tops = tops.to(device, non_blocking=True)
+                trans_dec_ip = tops[:, :-1]
+                trans_dec_op = tops[:, 1:]
+
+                trans_op_mask, diag_mask = generate_tgt_mask(
+                    trans_dec_ip, tokenizer, pad_token, 'cpu'
+                )
+
+                trans_op_mask = trans_op_mask.to(device, non_blocking=True)
+                diag_mask = diag_mask.to(device, non_blocking=True)
+
+                with bf16_autocast(device, bf16):
+                    trans_logs = model(
+                        graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
+                        tgt_pad_mask=trans_op_mask
+                    )
+
+                loss = calc_trans_loss(
+                    trans_logs, trans_dec_op, ignore_idx,
+                    lbsm=label_smoothing
+                )
+
+            if not warmup and accu > 1:
+                loss = loss / accu
+            loss.backward()
+
+        if step:
             optimizer.step()
             optimizer.zero_grad()
         its += 1
 
         losses.update(loss.item())
 
+        if hasattr(loader.dataset, 'update_cursor'):
+            loader.dataset.update_cursor(graph)
+
         if warmup:
             warmup_sher.step()
 
         if verbose:
             iterx.set_postfix_str(manager.summary_all())
 
+        if on_step is not None and step and its <= total_len:
+            on_step(its - 1, losses.state_dict())
+
     return manager
 
 
 def ddp_preeval(
     model, loader, device, tokenizer, pad_token, end_token,
-    verbose=False
+    verbose=False, bf16=False
 ):
     model = model.eval()
 
@@ -184,7 +354,7 @@ def ddp_preeval(
         trans_op_mask = trans_op_mask.to(device, non_blocking=True)
         diag_mask = diag_mask.to(device, non_blocking=True)
 
-        with torch.no_grad():
+        with torch.no_grad(), bf16_autocast(device, bf16):
             trans_logs = model(
                 graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
                 tgt_pad_mask=trans_op_mask
@@ -0,0 +1,489 @@
+import torch
+import argparse
+import json
+import os
+import time
+import pickle
+import random
+import numpy as np
+from rdkit import RDLogger
+
+from torch.utils.data import DataLoader, ConcatDataset
+from torch.optim.lr_scheduler import ExponentialLR
+from model import fill_model_sizes, build_model
+from Dataset import RetroDataset, SeqDistillDataset, col_fn_retro
+from data_utils import load_data, fix_seed, check_early_stop
+from training import pretrain, preeval
+from inference_tools import (
+    beam_search_one, beam_search_batch, topk_accuracy
+)
+from checkpoint_utils import dump_json_atomic
+
+
+def create_log_model(args):
+    timestamp = time.time()
+    if not os.path.exists(args.base_log):
+        os.makedirs(args.base_log)
+    return {
+        x: os.path.join(args.base_log, f'{x}-{timestamp}.{y}')
+        for x, y in [
+            ('log', 'json'), ('mod', 'pth'), ('token', 'pkl'),
+            ('report', 'json'), ('seqkd', 'json')
+        ]
+    }
+
+
+def teacher_args(args):
+    """
+    the architecture of teacher, from its training log if given, the
+    logs from before the separate encoder and decoder sizes and the gnn
+    backends take the shared sizes and pyg. the data and begin tokens
+    follow --use_class, so a teacher trained otherwise is rejected
+    """
+    sizes = {
+        f'{part}_{key}': -1 for part in ['enc', 'dec']
+        for key in ['layer', 'dim', 'heads', 'ffn']
+    }
+    if args.teacher_log != '':
+        teacher = dict(gnn_backend='pyg', dense_ratio=0, **sizes)
+        with open(args.teacher_log) as Fin:
+            teacher.update(json.load(Fin)['args'])
+        if teacher['use_class'] != args.use_class:
+            raise ValueError(
+                'The teacher is trained with use_class={} but --use_class '
+                'is {}, the student must use the same'.format(
+                    teacher['use_class'], args.use_class
+                )
+            )
+        return fill_model_sizes(argparse.Namespace(**teacher))
+    return fill_model_sizes(argparse.Namespace(
+        dim=args.teacher_dim, n_layer=args.teacher_n_layer,
+        heads=args.teacher_heads, negative_slope=args.negative_slope,
+        use_class=args.use_class, gnn_backend=args.gnn_backend,
+        dense_ratio=args.dense_ratio, **sizes
+    ))
+
+
+def teacher_answers(teacher, dataset, tokenizer, device, args):
+    """
+    the top seq_kd valid answers of beam search with teacher for every
+    product of dataset, the targets of sequence level distillation
+    """
+    loader = DataLoader(
+        dataset, collate_fn=col_fn_retro, batch_size=args.seq_kd_bs,
+        shuffle=False, num_workers=args.num_workers
+    )
+    answers = []
+    for graph, tran in loader:
+        result, _ = beam_search_batch(
+            teacher, tokenizer, graph.to(device), device, args.max_len,
+            size=args.seq_kd_beams, begin_tokens=[x[0] for x in tran],
+            end_token='<END>', validate=True, bf16=args.bf16
+        )
+        answers.extend(x[:args.seq_kd] for x in result)
+    return answers
+
+
+def beam_latency(model, dataset, tokenizer, device, args):
+    # ms per molecule of beam_search_one, one product at a time as the
+    # inference scripts serve them, the first call is a warm-up
+    times = []
+    for idx in range(min(args.latency_size, len(dataset)) + 1):
+        graph, tran = col_fn_retro([dataset[idx % len(dataset)]])
+        graph = graph.to(device)
+        start = time.perf_counter()
+        beam_search_one(
+            model, tokenizer, graph, device, args.max_len,
+            size=args.report_beams, begin_token=tran[0][0],
+            end_token='<END>', bf16=args.bf16
+        )
+        times.append(time.perf_counter() - start)
+    times = np.array(times[1:]) * 1e3
+    return float(times.mean()), float(np.percentile(times, 90))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Knowledge distillation')
+    parser.add_argument(
+        '--dim', default=256, type=int,
+        help='the hidden dim of student'
+    )
+    parser.add_argument(
+        '--n_layer', default=4, type=int,
+        help='the layer of student'
+    )
+    parser.add_argument(
+        '--heads', default=4, type=int,
+        help='the number of heads for attention of student'
+    )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
+    parser.add_argument(
+        '--negative_slope', type=float, default=0.2,
+        help='negative slope for attention, only useful for gat'
+    )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention of both models'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense'
+    )
+    parser.add_argument(
+        '--teacher_ckpt', type=str, required=True,
+        help='the path of the weights of teacher'
+    )
+    parser.add_argument(
+        '--token_ckpt', type=str, required=True,
+        help='the path of the tokenizer of teacher, shared by student'
+    )
+    parser.add_argument(
+        '--teacher_dim', default=768, type=int,
+        help='the hidden dim of teacher'
+    )
+    parser.add_argument(
+        '--teacher_n_layer', default=8, type=int,
+        help='the layer of teacher'
+    )
+    parser.add_argument(
+        '--teacher_heads', default=12, type=int,
+        help='the number of heads for attention of teacher'
+    )
+    parser.add_argument(
+        '--teacher_log', type=str, default='',
+        help='the training log of teacher, its args replace the sizes '
+        'of teacher above'
+    )
+    parser.add_argument(
+        '--kd_alpha', default=0.5, type=float,
+        help='the weight of the soft target loss, 1 - kd_alpha for the '
+        'loss on the targets'
+    )
+    parser.add_argument(
+        '--kd_temp', default=1.0, type=float,
+        help='the temperature of the soft targets'
+    )
+    parser.add_argument(
+        '--seq_kd', default=0, type=int,
+        help='add the top seq_kd answers of teacher beam search on the '
+        'training set as targets, 0 for none'
+    )
+    parser.add_argument(
+        '--seq_kd_beams', default=10, type=int,
+        help='the beams of teacher beam search for seq_kd'
+    )
+    parser.add_argument(
+        '--seq_kd_bs', default=8, type=int,
+        help='the number of molecules searched together for seq_kd'
+    )
+    parser.add_argument(
+        '--seq_kd_file', type=str, default='',
+        help='a json of teacher answers, reused when it exists and '
+        'written otherwise, in base_log by default'
+    )
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--aug_prob', default=0.5, type=float,
+        help='the probability of performing data augumentation'
+    )
+    parser.add_argument(
+        '--use_class', action='store_true',
+        help='use rxn_class for training or not'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=2023,
+        help='the seed for training'
+    )
+    parser.add_argument(
+        '--bs', type=int, default=128,
+        help='the batch size for training'
+    )
+    parser.add_argument(
+        '--epoch', type=int, default=200,
+        help='the max epoch for training'
+    )
+    parser.add_argument(
+        '--early_stop', default=10, type=int,
+        help='number of epochs for judging early stop'
+    )
+    parser.add_argument(
+        '--device', type=int, default=-1,
+        help='the device for training, -1 for cpu'
+    )
+    parser.add_argument(
+        '--lr', type=float, default=1e-3,
+        help='the learning rate for training'
+    )
+    parser.add_argument(
+        '--dropout', type=float, default=0.3,
+        help='the dropout rate of student'
+    )
+    parser.add_argument(
+        '--warmup', default=1, type=int,
+        help='the epoch of warmup'
+    )
+    parser.add_argument(
+        '--gamma', default=0.998, type=float,
+        help='the gamma of lr scheduler'
+    )
+    parser.add_argument(
+        '--step_start', default=50, type=int,
+        help='the step to start lr decay'
+    )
+    parser.add_argument(
+        '--accu', type=int, default=1,
+        help='the number of batch accu'
+    )
+    parser.add_argument(
+        '--label_smoothing', type=float, default=0.0,
+        help='the label smoothing of the loss on the targets'
+    )
+    parser.add_argument(
+        '--pack_len', type=int, default=0,
+        help='pack several target sequences into training rows of this '
+        'length with block-diagonal causal masks, 0 for padded batches'
+    )
+    parser.add_argument(
+        '--num_workers', default=0, type=int,
+        help='the number of workers for data loader'
+    )
+    parser.add_argument(
+        '--base_log', default='log_distill', type=str,
+        help='the base dir of logging'
+    )
+    parser.add_argument(
+        '--max_len', default=300, type=int,
+        help='the max num of tokens in beam search'
+    )
+    parser.add_argument(
+        '--report_size', default=500, type=int,
+        help='the number of test reactions for the top-k accuracy of '
+        'the report, 0 for the whole test set'
+    )
+    parser.add_argument(
+        '--report_beams', default=10, type=int,
+        help='the beams of beam search in the report'
+    )
+    parser.add_argument(
+        '--latency_size', default=50, type=int,
+        help='the number of molecules timed one by one in the report'
+    )
+    parser.add_argument(
+        '--threads', default=0, type=int,
+        help='the intra-op threads on cpu, 0 for the torch default'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run both models under bfloat16 autocast'
+    )
+    args = fill_model_sizes(parser.parse_args())
+    print(args)
+    # raises before any data is loaded if the teacher does not match
+    teacher_sizes = teacher_args(args)
+    paths = create_log_model(args)
+    # the parse errors of invalid beams are expected
+    RDLogger.DisableLog('rdApp.*')
+
+    if not torch.cuda.is_available() or args.device < 0:
+        device = torch.device('cpu')
+    else:
+        device = torch.device(f'cuda:{args.device}')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    fix_seed(args.seed)
+
+    # the student predicts with the vocabulary of teacher
+    with open(args.token_ckpt, 'rb') as Fin:
+        tokenizer = pickle.load(Fin)
+    with open(paths['token'], 'wb') as Fout:
+        pickle.dump(tokenizer, Fout)
+
+    train_rec, train_prod, train_rxn = load_data(args.data_path, 'train')
+    val_rec, val_prod, val_rxn = load_data(args.data_path, 'val')
+    test_rec, test_prod, test_rxn = load_data(args.data_path, 'test')
+    print('[INFO] Data Loaded')
+
+    teacher = build_model(teacher_sizes, tokenizer, device, 0)
+    print(f'[INFO] Loading teacher weight in {args.teacher_ckpt}')
+    weight = torch.load(args.teacher_ckpt, map_location=device)
+    teacher.load_state_dict(weight, strict=True)
+    teacher.requires_grad_(False)
+
+    train_set = RetroDataset(
+        prod_sm=train_prod, reat_sm=train_rec, aug_prob=args.aug_prob,
+        rxn_cls=train_rxn if args.use_class else None
+    )
+    if args.seq_kd > 0:
+        seqkd_path = args.seq_kd_file or paths['seqkd']
+        if os.path.exists(seqkd_path):
+            print(f'[INFO] Loading teacher answers in {seqkd_path}')
+            with open(seqkd_path) as Fin:
+                answers = json.load(Fin)['answers']
+        else:
+            print('[INFO] Searching teacher answers of the training set')
+            answers = teacher_answers(teacher, RetroDataset(
+                prod_sm=train_prod, reat_sm=train_rec, aug_prob=0,
+                rxn_cls=train_rxn if args.use_class else None
+            ), tokenizer, device, args)
+            dump_json_atomic({
+                'teacher': args.teacher_ckpt, 'beams': args.seq_kd_beams,
+                'answers': answers
+            }, seqkd_path)
+        # the answers of teacher are extra samples of the canonical
+        # products, next to the reactions of the dataset
+        train_set = ConcatDataset([train_set, SeqDistillDataset(
+            train_prod, answers, train_rxn if args.use_class else None
+        )])
+
+    valid_set = RetroDataset(
+        prod_sm=val_prod, reat_sm=val_rec, aug_prob=0,
+        rxn_cls=val_rxn if args.use_class else None
+    )
+    train_loader = DataLoader(
+        train_set, collate_fn=col_fn_retro, batch_size=args.bs,
+        shuffle=True, num_workers=args.num_workers
+    )
+    valid_loader = DataLoader(
+        valid_set, collate_fn=col_fn_retro, batch_size=args.bs,
+        shuffle=False, num_workers=args.num_workers
+    )
+
+    model = build_model(args, tokenizer, device, args.dropout)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    lr_sh = ExponentialLR(optimizer, gamma=args.gamma, verbose=True)
+    best_perf, best_ep = None, None
+
+    log_info = {'args': args.__dict__, 'train_loss': [], 'valid_metric': []}
+    dump_json_atomic(log_info, paths['log'])
+
+    for ep in range(args.epoch):
+        print(f'[INFO] traing at epoch {ep + 1}')
+        loss = pretrain(
+            loader=train_loader, model=model, optimizer=optimizer,
+            tokenizer=tokenizer, device=device, pad_token='<PAD>',
+            warmup=(ep < args.warmup), accu=args.accu,
+            label_smoothing=args.label_smoothing, pack_len=args.pack_len,
+            bf16=args.bf16, teacher=teacher, kd_alpha=args.kd_alpha,
+            kd_temp=args.kd_temp
+        )
+        log_info['train_loss'].append({'distill': loss})
+
+        valid_result = preeval(
+            loader=valid_loader, model=model, tokenizer=tokenizer,
+            pad_token='<PAD>', end_token='<END>', device=device,
+            bf16=args.bf16
+        )
+        log_info['valid_metric'].append({'trans': valid_result})
+
+        print('[TRAIN]', log_info['train_loss'][-1])
+        print('[VALID]', log_info['valid_metric'][-1])
+
+        if ep >= args.warmup and ep >= args.step_start:
+            lr_sh.step()
+
+        dump_json_atomic(log_info, paths['log'])
+
+        if best_perf is None or valid_result > best_perf:
+            best_perf, best_ep = valid_result, ep
+            torch.save(model.state_dict(), paths['mod'])
+
+        if args.early_stop > 3 and ep > max(10, args.early_stop):
+            tx = log_info['valid_metric'][-args.early_stop:]
+            tx = [x['trans'] for x in tx]
+            if check_early_stop(tx):
+                break
+
+    print(f'[INFO] best acc epoch: {best_ep}')
+    print(f'[INFO] best valid loss: {log_info["valid_metric"][best_ep]}')
+
+    # the report compares teacher and the best student on the same fixed
+    # subset of the test set
+    model.load_state_dict(torch.load(paths['mod'], map_location=device))
+    keep = list(range(len(test_rec)))
+    if 0 < args.report_size < len(keep):
+        keep = sorted(random.Random(args.seed).sample(
+            keep, args.report_size
+        ))
+    test_set = RetroDataset(
+        prod_sm=[test_prod[x] for x in keep],
+        reat_sm=[test_rec[x] for x in keep], aug_prob=0,
+        rxn_cls=[test_rxn[x] for x in keep] if args.use_class else None
+    )
+    test_loader = DataLoader(
+        test_set, collate_fn=col_fn_retro, batch_size=args.bs,
+        shuffle=False, num_workers=args.num_workers
+    )
+    report = {'test_size': len(test_set), 'threads': torch.get_num_threads()}
+    compared = [
+        ('teacher', teacher, args.teacher_ckpt),
+        ('student', model, paths['mod'])
+    ]
+    for name, this_model, path in compared:
+        latency, latency_p90 = beam_latency(
+            this_model, test_set, tokenizer, device, args
+        )
+        result = {
+            'params': sum(x.numel() for x in this_model.parameters()),
+            'file_mib': os.path.getsize(path) / 2 ** 20,
+            'latency_ms': latency, 'latency_p90_ms': latency_p90,
+            'trans_acc': preeval(
+                loader=test_loader, model=this_model, tokenizer=tokenizer,
+                pad_token='<PAD>', end_token='<END>', device=device,
+                bf16=args.bf16
+            )
+        }
+        result.update(topk_accuracy(
+            this_model, test_set, tokenizer, device, args.max_len,
+            beams=args.report_beams, num_workers=args.num_workers,
+            bf16=args.bf16
+        ))
+        report[name] = result
+    dump_json_atomic(report, paths['report'])
+
+    keys = ['params', 'file_mib', 'latency_ms', 'latency_p90_ms'] + \
+        [x for x in report['student'] if x.endswith('acc')]
+    print('| model | ' + ' | '.join(keys) + ' |')
+    print('|---' * (len(keys) + 1) + '|')
+    for name in ['teacher', 'student']:
+        row = [
+            f'{report[name][x]:.4g}' if isinstance(report[name][x], float)
+            else str(report[name][x]) for x in keys
+        ]
+        print(f'| {name} | ' + ' | '.join(row) + ' |')
+    print(f'[INFO] student files {paths["mod"]} and {paths["token"]}')
+    print(f'[INFO] report in {paths["report"]}')
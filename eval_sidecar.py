@@ -0,0 +1,254 @@
+import argparse
+import glob
+import json
+import os
+import pickle
+import random
+import time
+import torch
+from rdkit import RDLogger
+
+from torch.utils.data import DataLoader
+from model import build_model
+from Dataset import RetroDataset, col_fn_retro
+from data_utils import load_data, fix_seed
+from training import preeval
+from inference_tools import topk_accuracy
+from lora_utils import add_lora
+from checkpoint_utils import (
+    checkpoint_position, dump_json_atomic, sidecar_path
+)
+
+
+def newest_run(base_log):
+    # the run id of the newest training log in base_log
+    logs = glob.glob(os.path.join(glob.escape(base_log), 'log-*.json'))
+    if len(logs) == 0:
+        return None
+    newest = max(logs, key=os.path.getmtime)
+    return os.path.basename(newest)[len('log-'):-len('.json')]
+
+
+def load_part(args, data_path, part, use_class):
+    reac, prod, rxn = load_data(data_path, part)
+    if 0 < args.subset < len(reac):
+        # the same reactions for every checkpoint
+        keep = random.Random(args.seed).sample(range(len(reac)), args.subset)
+        keep.sort()
+        reac = [reac[x] for x in keep]
+        prod = [prod[x] for x in keep]
+        rxn = [rxn[x] for x in keep]
+    return RetroDataset(
+        prod_sm=prod, reat_sm=reac, aug_prob=0,
+        rxn_cls=rxn if use_class else None
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Evaluation sidecar')
+    parser.add_argument(
+        '--base_log', required=True, type=str,
+        help='the base dir of logging of the training run'
+    )
+    parser.add_argument(
+        '--run_id', default='', type=str,
+        help='the timestamp or run id of the training run, the newest '
+        'log in base_log by default'
+    )
+    parser.add_argument(
+        '--data_path', default='', type=str,
+        help='the path containing dataset, the one of training by default'
+    )
+    parser.add_argument(
+        '--parts', default=['val', 'test'], type=str, nargs='+',
+        choices=['val', 'test'], help='the splits to evaluate'
+    )
+    parser.add_argument(
+        '--metrics', default=['trans_acc', 'topk'], type=str, nargs='+',
+        choices=['trans_acc', 'topk'],
+        help='teacher forcing token accuracy and top-k accuracy of beam '
+        'search'
+    )
+    parser.add_argument(
+        '--subset', default=0, type=int,
+        help='evaluate a fixed random subset of this size of every split, '
+        '0 for the whole split'
+    )
+    parser.add_argument(
+        '--beams', default=10, type=int,
+        help='the number of beams'
+    )
+    parser.add_argument(
+        '--topk', default=[1, 3, 5, 10], type=int, nargs='+',
+        help='the k of the reported top-k accuracies'
+    )
+    parser.add_argument(
+        '--max_len', default=300, type=int,
+        help='the max num of tokens in result'
+    )
+    parser.add_argument(
+        '--bs', default=64, type=int,
+        help='the batch size of teacher forcing evaluation'
+    )
+    parser.add_argument(
+        '--beam_bs', default=8, type=int,
+        help='the number of molecules searched together'
+    )
+    parser.add_argument(
+        '--mid_epoch', action='store_true',
+        help='also evaluate the states saved inside epochs by --ckpt_every'
+    )
+    parser.add_argument(
+        '--poll', default=30, type=float,
+        help='the seconds between two looks for new states'
+    )
+    parser.add_argument(
+        '--idle_exit', default=0, type=float,
+        help='exit after this many seconds without a new state, 0 for '
+        'never, the sidecar always exits once the trainer has finished, '
+        'early stop included, and every state is evaluated'
+    )
+    parser.add_argument(
+        '--device', default=-1, type=int,
+        help='the device for evaluation, -1 for cpu'
+    )
+    parser.add_argument(
+        '--threads', default=0, type=int,
+        help='the intra-op threads on cpu, 0 for the torch default'
+    )
+    parser.add_argument(
+        '--num_workers', default=0, type=int,
+        help='the number of workers for data loader'
+    )
+    parser.add_argument(
+        '--seed', default=2023, type=int,
+        help='the seed of the subset'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast, for cpus and gpus '
+        'with fast bf16 kernels'
+    )
+    args = parser.parse_args()
+    print(args)
+    # the parse errors of invalid beams are expected
+    RDLogger.DisableLog('rdApp.*')
+
+    if not torch.cuda.is_available() or args.device < 0:
+        device = torch.device('cpu')
+    else:
+        device = torch.device(f'cuda:{args.device}')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    fix_seed(args.seed)
+
+    run_id = args.run_id
+    while run_id == '':
+        run_id = newest_run(args.base_log) or ''
+        if run_id == '':
+            time.sleep(args.poll)
+    log_dir = os.path.join(args.base_log, f'log-{run_id}.json')
+    token_dir = os.path.join(args.base_log, f'token-{run_id}.pkl')
+    ckpt_prefix = os.path.join(args.base_log, f'ckpt-{run_id}')
+    # the results have a file of their own, the log is only written by
+    # the trainer, which keeps the states not in the results yet
+    async_dir = sidecar_path(ckpt_prefix)
+    # results of an earlier sidecar of the same run are kept
+    results = []
+    if os.path.exists(async_dir):
+        with open(async_dir) as Fin:
+            results = json.load(Fin)['async_metric']
+    dump_json_atomic(
+        {'async_metric': results, 'mid_epoch': args.mid_epoch}, async_dir
+    )
+    while not (os.path.exists(log_dir) and os.path.exists(token_dir)):
+        time.sleep(args.poll)
+    print(f'[INFO] following the run {run_id}')
+
+    with open(log_dir) as Fin:
+        log_info = json.load(Fin)
+    train_args = argparse.Namespace(**log_info['args'])
+    with open(token_dir, 'rb') as Fin:
+        tokenizer = pickle.load(Fin)
+    # the architecture of the training run, dropout is off in eval mode
+    model = build_model(train_args, tokenizer, device, train_args.dropout)
+    if getattr(train_args, 'lora_rank', 0) > 0:
+        # the states hold the frozen model and the adapters
+        add_lora(
+            model, train_args.lora_rank, train_args.lora_alpha,
+            train_args.lora_parts
+        )
+
+    data_path = args.data_path or train_args.data_path
+    datasets = {
+        part: load_part(args, data_path, part, train_args.use_class)
+        for part in args.parts
+    }
+
+    done = set((x['epoch'], x['step']) for x in results)
+    last_new = time.time()
+    while True:
+        pending = []
+        for path in glob.glob(f'{glob.escape(ckpt_prefix)}-*.pth'):
+            epoch, step = checkpoint_position(path)
+            if (epoch, step) not in done and (args.mid_epoch or step == 0):
+                pending.append((epoch, step, path))
+        if len(pending) == 0:
+            with open(log_dir) as Fin:
+                finished = json.load(Fin).get('finished', False)
+            if finished:
+                print('[INFO] the training run is finished, exit')
+                break
+            if 0 < args.idle_exit < time.time() - last_new:
+                print('[INFO] no new state, exit')
+                break
+            time.sleep(args.poll)
+            continue
+
+        # the oldest first, the trainer only keeps the newest states
+        epoch, step, path = min(pending)
+        try:
+            state = torch.load(path, map_location='cpu')
+        except FileNotFoundError:
+            # removed by the trainer before the results file was written
+            print(f'[WARNING] {path} was removed before evaluation')
+            continue
+        model.load_state_dict(state['model'])
+        del state
+
+        start = time.time()
+        entry = {'epoch': epoch, 'step': step}
+        for part, dataset in datasets.items():
+            metric = {}
+            if 'trans_acc' in args.metrics:
+                loader = DataLoader(
+                    dataset, collate_fn=col_fn_retro, batch_size=args.bs,
+                    shuffle=False, num_workers=args.num_workers
+                )
+                metric['trans_acc'] = preeval(
+                    loader=loader, model=model, tokenizer=tokenizer,
+                    pad_token='<PAD>', end_token='<END>', device=device,
+                    bf16=args.bf16
+                )
+            if 'topk' in args.metrics:
+                metric.update(topk_accuracy(
+                    model, dataset, tokenizer, device, args.max_len,
+                    beams=args.beams, topk=args.topk, bs=args.beam_bs,
+                    num_workers=args.num_workers, bf16=args.bf16
+                ))
+            entry[part] = metric
+        entry['eval_time'] = time.time() - start
+        print('[ASYNC]', entry)
+
+        done.add((epoch, step))
+        results.append(entry)
+        results.sort(key=lambda x: (x['epoch'], x['step']))
+        last_new = time.time()
+
+        dump_json_atomic(
+            {'async_metric': results, 'mid_epoch': args.mid_epoch}, async_dir
+        )
+
+        if step == 0 and epoch >= train_args.epoch:
+            print('[INFO] the last epoch is evaluated, exit')
+            break
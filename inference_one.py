@@ -6,21 +6,23 @@ import pickle
 
 
 from torch.utils.data import DataLoader
-from model import PretrainModel, PositionalEncoding
+from model import PretrainModel, PositionalEncoding, fill_model_sizes
 from data_utils import fix_seed
 from torch.nn import TransformerDecoderLayer, TransformerDecoder
 from sparse_backBone import GATBase
 from utils.chemistry_parse import clear_map_number, canonical_smiles
-from utils.graph_utils import smiles2graph
+from utils.graph_utils import cached_smiles2graph
 import pandas
 import torch_geometric
 from inference_tools import beam_search_one
+from lora_utils import apply_adapter
+from prune_utils import load_pruned
 import time
 import os
 
 
 def make_graph_batch(smi, rxn=None):
-    graph = smiles2graph(smi, with_amap=False)
+    graph = cached_smiles2graph(smi, with_amap=False)
     num_nodes = graph['node_feat'].shape[0]
     num_edges = graph['edge_index'].shape[1]
 
@@ -33,12 +35,12 @@ def make_graph_batch(smi, rxn=None):
         'e_ptr': torch.LongTensor([0, num_edges]),
         'batch': torch.zeros(num_nodes).long(),
         'e_batch': torch.zeros(num_edges).long(),
-        'batch_mask': torch.ones(1, num_nodes).bool()
+        'batch_mask': torch.ones(1, num_nodes).bool(),
+        'pad_index': torch.arange(num_nodes)
     }
 
     if rxn is not None:
-        data['node_rxn'] = torch.ones(num_nodes).long() * rxn
-        data['edge_rxn'] = torch.ones(num_edges).long() * rxn
+        data['rxn_class'] = torch.full((1, ), rxn, dtype=torch.uint8)
     return torch_geometric.data.Data(**data)
 
 
@@ -56,10 +58,53 @@ if __name__ == '__main__':
         '--heads', default=4, type=int,
         help='the number of heads for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
     parser.add_argument(
         '--negative_slope', type=float, default=0.2,
         help='negative slope for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention, auto chooses '
+        'between fused and dense by the shape of every batch'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense, '
+        'see benchmarks/dense_backend.py'
+    )
     parser.add_argument(
         '--seed', type=int, default=2023,
         help='the seed for training'
@@ -73,6 +118,11 @@ if __name__ == '__main__':
         '--checkpoint', type=str, required=True,
         help='the path of checkpoint to restart the exp'
     )
+    parser.add_argument(
+        '--adapter', type=str, default='',
+        help='the path of low rank adapters trained on checkpoint, they '
+        'are merged into the weights of checkpoint'
+    )
     parser.add_argument(
         '--token_ckpt', type=str, required=True,
         help='the path of tokenizer, when ckpt is loaded, necessary'
@@ -103,8 +153,13 @@ if __name__ == '__main__':
         help='preserve the original output,' +
         ' if chosen the invalid smiles will not be removed'
     )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast, for cpus and gpus '
+        'with fast bf16 kernels'
+    )
 
-    args = parser.parse_args()
+    args = fill_model_sizes(parser.parse_args())
     print(args)
 
     if not torch.cuda.is_available() or args.device < 0:
@@ -117,29 +172,39 @@ if __name__ == '__main__':
         tokenizer = pickle.load(Fin)
 
     GNN = GATBase(
-        num_layers=args.n_layer, dropout=0.1, embedding_dim=args.dim,
-        num_heads=args.heads, negative_slope=args.negative_slope,
-        n_class=11 if args.use_class else None
+        num_layers=args.enc_layer, dropout=0.1,
+        embedding_dim=args.enc_dim, num_heads=args.enc_heads,
+        negative_slope=args.negative_slope,
+        n_class=11 if args.use_class else None,
+        backend=args.gnn_backend, dense_ratio=args.dense_ratio,
+        edge_hidden=args.enc_ffn
     )
 
     decode_layer = TransformerDecoderLayer(
-        d_model=args.dim, nhead=args.heads, batch_first=True,
-        dim_feedforward=args.dim * 2, dropout=0.1
+        d_model=args.dec_dim, nhead=args.dec_heads, batch_first=True,
+        dim_feedforward=args.dec_ffn, dropout=0.1
     )
-    Decoder = TransformerDecoder(decode_layer, args.n_layer)
-    Pos_env = PositionalEncoding(args.dim, 0.1, maxlen=2000)
+    Decoder = TransformerDecoder(decode_layer, args.dec_layer)
+    Pos_env = PositionalEncoding(args.dec_dim, 0.1, maxlen=2000)
 
     model = PretrainModel(
         token_size=tokenizer.get_token_size(), encoder=GNN,
-        decoder=Decoder, d_model=args.dim, pos_enc=Pos_env
+        decoder=Decoder, d_model=args.dec_dim, pos_enc=Pos_env,
+        memory_dim=args.enc_dim
     ).to(device)
 
     if args.checkpoint != '':
         assert args.token_ckpt != '', 'Missing Tokenizer Information'
         print(f'[INFO] Loading model weight in {args.checkpoint}')
         weight = torch.load(args.checkpoint, map_location=device)
+        weight = load_pruned(model, weight)
         model.load_state_dict(weight, strict=False)
 
+    if args.adapter != '':
+        print(f'[INFO] Merging adapters in {args.adapter}')
+        adapters = torch.load(args.adapter, map_location=device)
+        apply_adapter(model, adapters)
+
     print('[INFO] padding index', tokenizer.token2idx['<PAD>'])
     if args.use_class:
         assert args.input_class != -1, 'require reaction class!'
@@ -153,7 +218,7 @@ if __name__ == '__main__':
     preds, probs = beam_search_one(
         model, tokenizer, g_ip, device, max_len=args.max_len,
         size=args.beams, begin_token=start_token, end_token='<END>',
-        pen_para=0, validate=not args.org_output
+        pen_para=0, validate=not args.org_output, bf16=args.bf16
     )
 
     print('[RESULT]')
@@ -1,5 +1,9 @@
+import numpy as np
 import torch
-from data_utils import generate_square_subsequent_mask
+from torch.utils.data import DataLoader
+from data_utils import generate_square_subsequent_mask, bf16_autocast
+from Dataset import col_fn_retro
+from utils.chemistry_parse import canonical_smiles, clear_map_number
 from rdkit import Chem
 
 
@@ -10,7 +14,7 @@ def check_valid(smi):
 
 def beam_search_one(
     model, tokenizer, graph, device, max_len, size=2, pen_para=0,
-    begin_token='<CLS>', end_token='<END>',  validate=False
+    begin_token='<CLS>', end_token='<END>',  validate=False, bf16=False
 ):
     model = model.eval()
     end_id = tokenizer.token2idx[end_token]
@@ -24,7 +28,7 @@ def beam_search_one(
     fst_idx = tokenizer.token2idx['(']
     sec_idx = tokenizer.token2idx[")"]
 
-    with torch.no_grad():
+    with torch.no_grad(), bf16_autocast(device, bf16):
         base_memory, base_mem_pad_mask = model.encode(graph)
         for idx in range(max_len):
             input_beam, prob_beam = [], []
@@ -58,7 +62,8 @@ def beam_search_one(
                 tgt=tgt, memory=memory, tgt_mask=tgt_mask,
                 memory_padding_mask=mem_pad_mask
             )
-            result = torch.log_softmax(result[:, -1], dim=-1)
+            # float32, the beam scores add up over the steps
+            result = torch.log_softmax(result[:, -1].float(), dim=-1)
             result_top_k = result.topk(size, dim=-1, largest=True, sorted=True)
 
             for tdx, ep in enumerate(result_top_k.values):
@@ -98,6 +103,14 @@ def beam_search_one(
             lens = len_beam[beam_top_k.indices]
             n_close = col_beam[beam_top_k.indices]
 
+    return collect_answers(
+        tokenizer, tgt, probs, size, begin_token, end_token, validate
+    )
+
+
+def collect_answers(
+    tokenizer, tgt, probs, size, begin_token, end_token, validate
+):
     answer = [(probs[idx].item(), t.tolist()) for idx, t in enumerate(tgt)]
     answer.sort(reverse=True)
     real_answer, real_prob = [], []
@@ -110,3 +123,131 @@ def beam_search_one(
         real_answer.append(r_smiles)
         real_prob.append(y)
     return real_answer, real_prob
+
+
+def beam_search_batch(
+    model, tokenizer, graphs, device, max_len, size=2, pen_para=0,
+    begin_tokens=None, end_token='<END>', validate=False, bf16=False
+):
+    """
+    beam_search_one over a batch of graphs, the beams of all the graphs
+    are decoded together, one decoder call per step. begin_tokens are
+    the start tokens of the graphs, <CLS> for all by default. Returns
+    the answers and the scores of every graph.
+    """
+    model = model.eval()
+    batch_size = graphs.batch_mask.shape[0]
+    if begin_tokens is None:
+        begin_tokens = ['<CLS>'] * batch_size
+    end_id = tokenizer.token2idx[end_token]
+    fst_idx = tokenizer.token2idx['(']
+    sec_idx = tokenizer.token2idx[")"]
+
+    # [batch, beams, len], a single beam for every graph at the start
+    tgt = [[[tokenizer.token2idx[x]]] for x in begin_tokens]
+    tgt = torch.LongTensor(tgt).to(device)
+    probs = torch.zeros(batch_size, 1).to(device)
+    lens = torch.zeros(batch_size, 1).to(device)
+    alive = torch.ones(batch_size, 1).to(device).bool()
+    n_close = torch.zeros(batch_size, 1).to(device)
+    # an ended beam only goes on as its first candidate
+    extra = torch.arange(size).to(device) > 0
+
+    with torch.no_grad(), bf16_autocast(device, bf16):
+        base_memory, base_mem_pad_mask = model.encode(graphs)
+        for idx in range(max_len):
+            if not torch.any(alive).item():
+                break
+
+            num_beams, tgt_len = tgt.shape[1], tgt.shape[2]
+            memory = base_memory.repeat_interleave(num_beams, dim=0)
+            mem_pad_mask = base_mem_pad_mask.repeat_interleave(
+                num_beams, dim=0
+            )
+            tgt_mask = generate_square_subsequent_mask(tgt_len)
+            tgt_mask = tgt_mask.to(device)
+            result = model.decode(
+                tgt=tgt.reshape(-1, tgt_len), memory=memory,
+                tgt_mask=tgt_mask, memory_padding_mask=mem_pad_mask
+            )
+            # float32, the beam scores add up over the steps
+            result = torch.log_softmax(result[:, -1].float(), dim=-1)
+            result_top_k = result.topk(size, dim=-1, largest=True, sorted=True)
+
+            # candidates [batch, beams, size], an ended beam appends <END>
+            # and keeps its score and length
+            ended = torch.logical_not(alive).unsqueeze(-1)
+            top_idx = result_top_k.indices.reshape(batch_size, num_beams, -1)
+            top_val = result_top_k.values.reshape(batch_size, num_beams, -1)
+            cand_tok = top_idx.masked_fill(ended, end_id)
+            cand_prob = torch.where(
+                ended, probs.unsqueeze(-1), probs.unsqueeze(-1) + top_val
+            )
+            cand_len = lens.unsqueeze(-1).expand_as(cand_prob)
+            cand_len = cand_len.masked_fill(~ended, idx + 1)
+            cand_alive = cand_tok != end_id
+            cand_close = n_close.unsqueeze(-1) + \
+                1. * (cand_tok == fst_idx) - 1. * (cand_tok == sec_idx)
+
+            illegal = (cand_close < 0) | ((~cand_alive) & (cand_close != 0))
+            cand_prob = cand_prob.masked_fill(illegal, -2e9)
+
+            if 0 < pen_para < 1:
+                cand_prob = cand_prob / (cand_len ** pen_para)
+            cand_prob = cand_prob.masked_fill(ended & extra, float('-inf'))
+
+            beam_top_k = cand_prob.reshape(batch_size, -1).topk(
+                size, dim=-1, largest=True, sorted=True
+            )
+            chosen = beam_top_k.indices
+            parent = (chosen // size).unsqueeze(-1).expand(-1, -1, tgt_len)
+            new_tok = cand_tok.reshape(batch_size, -1).gather(1, chosen)
+            tgt = torch.cat([
+                tgt.gather(1, parent), new_tok.unsqueeze(-1)
+            ], dim=-1)
+            probs = beam_top_k.values
+            alive = cand_alive.reshape(batch_size, -1).gather(1, chosen)
+            lens = cand_len.reshape(batch_size, -1).gather(1, chosen)
+            n_close = cand_close.reshape(batch_size, -1).gather(1, chosen)
+
+    answers, scores = [], []
+    for idx, begin_token in enumerate(begin_tokens):
+        real_answer, real_prob = collect_answers(
+            tokenizer, tgt[idx], probs[idx], size, begin_token,
+            end_token, validate
+        )
+        answers.append(real_answer)
+        scores.append(real_prob)
+    return answers, scores
+
+
+def topk_accuracy(
+    model, dataset, tokenizer, device, max_len, beams=10,
+    topk=(1, 3, 5, 10), bs=8, num_workers=0, bf16=False
+):
+    """
+    the top-k accuracy of beam_search_batch on a RetroDataset, an answer
+    is right when it is the canonical reactants, as evaluate_answer.py
+    """
+    loader = DataLoader(
+        dataset, collate_fn=col_fn_retro, batch_size=bs,
+        shuffle=False, num_workers=num_workers
+    )
+    hits, start = np.zeros(beams), 0
+    for graph, tran in loader:
+        answers, _ = beam_search_batch(
+            model, tokenizer, graph.to(device), device, max_len,
+            size=beams, begin_tokens=[x[0] for x in tran],
+            end_token='<END>', pen_para=0, validate=False, bf16=bf16
+        )
+        for idx, answer in enumerate(answers):
+            real_ans = clear_map_number(dataset.reat_sm[start + idx])
+            for rank, x in enumerate(answer):
+                if canonical_smiles(x) == real_ans:
+                    hits[rank:] += 1
+                    break
+        start += len(answers)
+    return {
+        f'top{k}_acc': float(hits[k - 1] / len(dataset))
+        for k in topk if k <= beams
+    }
@@ -0,0 +1,115 @@
+import math
+import torch
+from torch.nn import TransformerDecoderLayer
+from torch.nn.utils import parametrize
+from GATconv import SelfLoopGATConv
+
+
+class LoRA(torch.nn.Module):
+    """
+    the parametrization weight + alpha / rank * B @ A of a [out, in]
+    weight, B starts from zeros so a new adapter leaves the model as is
+    """
+    def __init__(self, out_dim, in_dim, rank=8, alpha=16):
+        super(LoRA, self).__init__()
+        self.lora_A = torch.nn.Parameter(torch.empty(rank, in_dim))
+        self.lora_B = torch.nn.Parameter(torch.zeros(out_dim, rank))
+        torch.nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scale = alpha / rank
+
+    def forward(self, weight):
+        delta = torch.matmul(self.lora_B, self.lora_A) * self.scale
+        return weight + delta.to(weight.dtype)
+
+
+def lora_targets(model, parts=('encoder', 'decoder')):
+    """
+    the weights getting adapters as (name, module, attr), the attention
+    and feed forward projections of every TransformerDecoderLayer and
+    lin_src (shared with lin_dst) and lin_edge of every SelfLoopGATConv
+    """
+    targets = []
+    for name, module in model.named_modules():
+        if 'decoder' in parts and \
+                isinstance(module, TransformerDecoderLayer):
+            pairs = [
+                ('self_attn', 'in_proj_weight'),
+                ('self_attn.out_proj', 'weight'),
+                ('multihead_attn', 'in_proj_weight'),
+                ('multihead_attn.out_proj', 'weight'),
+                ('linear1', 'weight'), ('linear2', 'weight')
+            ]
+        elif 'encoder' in parts and isinstance(module, SelfLoopGATConv):
+            pairs = [('lin_src', 'weight'), ('lin_edge', 'weight')]
+        else:
+            continue
+        for sub_name, attr in pairs:
+            sub_module = module.get_submodule(sub_name)
+            if getattr(sub_module, attr) is not None:
+                targets.append((f'{name}.{sub_name}.{attr}', sub_module, attr))
+    return targets
+
+
+def drop_parametrized(module, state_dict, prefix, local_metadata):
+    # pyg Linear saves its weight property as well, the weight is in
+    # parametrizations as the original and the adapter
+    if parametrize.is_parametrized(module):
+        for attr in module.parametrizations.keys():
+            state_dict.pop(prefix + attr, None)
+
+
+def add_lora(model, rank, alpha, parts=('encoder', 'decoder')):
+    """
+    freezes model and adds low rank adapters to the weights of
+    lora_targets, the adapters are the only parameters with gradients
+    """
+    model.requires_grad_(False)
+    for name, module, attr in lora_targets(model, parts):
+        weight = getattr(module, attr)
+        lora = LoRA(weight.shape[0], weight.shape[1], rank, alpha)
+        parametrize.register_parametrization(
+            module, attr, lora.to(weight.device)
+        )
+        module._register_state_dict_hook(drop_parametrized)
+    return model
+
+
+def adapter_state(model):
+    # the adapters of model by the name of their weights, no base weights
+    adapters = {}
+    for name, module, attr in lora_targets(model):
+        if parametrize.is_parametrized(module, attr):
+            lora = module.parametrizations[attr][0]
+            adapters[name] = {
+                'lora_A': lora.lora_A.detach(),
+                'lora_B': lora.lora_B.detach(), 'scale': lora.scale
+            }
+    return adapters
+
+
+def merge_lora(model):
+    # folds the adapters of add_lora into the weights and removes them
+    for name, module, attr in lora_targets(model):
+        if parametrize.is_parametrized(module, attr):
+            parametrize.remove_parametrizations(
+                module, attr, leave_parametrized=True
+            )
+    return model
+
+
+@torch.no_grad()
+def apply_adapter(model, adapters, sign=1):
+    """
+    adds the adapters saved from adapter_state into the weights of a
+    model without adapters. sign=-1 takes them out again, so that the
+    adapters of several fine-tunes are swapped on one base model, up to
+    the float rounding of the add and the subtract
+    """
+    targets = {name: (module, attr) for name, module, attr in
+               lora_targets(model)}
+    for name, lora in adapters.items():
+        module, attr = targets[name]
+        weight = getattr(module, attr)
+        delta = torch.matmul(lora['lora_B'], lora['lora_A']) * lora['scale']
+        weight.add_(delta.to(weight), alpha=sign)
+    return model
@@ -1,5 +1,8 @@
 import torch
+import functools
+from torch.utils.checkpoint import checkpoint
 from sparse_backBone import GATBase
+from typing import Optional
 import math
 
 
@@ -17,17 +20,138 @@ class PositionalEncoding(torch.nn.Module):
         self.dropout = torch.nn.Dropout(dropout)
         self.register_buffer('pos_embedding', pos_embedding)
 
-    def forward(self, token_embedding: torch.Tensor):
+    def forward(self, token_embedding: torch.Tensor, position=None):
+        if position is not None:
+            # packed sequences, the position of every row is given
+            return self.dropout(token_embedding + self.pos_embedding[position])
         token_len = token_embedding.shape[1]
         return self.dropout(token_embedding + self.pos_embedding[:token_len])
 
 
+def masked_scores(scores, mask):
+    # bool masks are True where attention is not allowed, others added
+    if mask.dtype == torch.bool:
+        return scores.masked_fill(mask, float('-inf'))
+    return scores + mask
+
+
+class PrunedMultiheadAttention(torch.nn.Module):
+    """
+    nn.MultiheadAttention with num_heads heads of head_dim, not bound to
+    num_heads * head_dim = embed_dim, so that the heads removed by
+    prune_utils take their rows of in_proj and columns of out_proj with
+    them, the parameters keep the names of nn.MultiheadAttention. the
+    inputs are batch first, as in the decoders of this repo
+    """
+    def __init__(self, embed_dim, num_heads, head_dim, dropout=0.0):
+        super(PrunedMultiheadAttention, self).__init__()
+        inner_dim = num_heads * head_dim
+        self.embed_dim, self.num_heads = embed_dim, num_heads
+        self.head_dim, self.dropout = head_dim, dropout
+        self.batch_first = True
+        self.in_proj_weight = torch.nn.Parameter(
+            torch.empty(3 * inner_dim, embed_dim)
+        )
+        self.in_proj_bias = torch.nn.Parameter(torch.zeros(3 * inner_dim))
+        self.out_proj = torch.nn.Linear(inner_dim, embed_dim)
+        torch.nn.init.xavier_uniform_(self.in_proj_weight)
+        torch.nn.init.zeros_(self.out_proj.bias)
+
+    def forward(
+        self, query, key, value, key_padding_mask=None, need_weights=False,
+        attn_mask=None, average_attn_weights=True, is_causal=False
+    ):
+        batch_size, tgt_len, src_len = query.shape[0], query.shape[1], \
+            key.shape[1]
+        weights = self.in_proj_weight.chunk(3)
+        biases = self.in_proj_bias.chunk(3)
+        q, k, v = [
+            torch.nn.functional.linear(x, w, b).view(
+                batch_size, -1, self.num_heads, self.head_dim
+            ).transpose(1, 2) for x, w, b in
+            zip([query, key, value], weights, biases)
+        ]
+        scores = torch.matmul(q * self.head_dim ** -0.5, k.transpose(2, 3))
+        if attn_mask is not None:
+            if attn_mask.dim() == 3:
+                # the masks of decode_packed are repeated for the heads of
+                # the first layer, the same for all heads
+                attn_mask = attn_mask.view(
+                    batch_size, -1, tgt_len, src_len
+                )[:, :1]
+            scores = masked_scores(scores, attn_mask)
+        if key_padding_mask is not None:
+            scores = masked_scores(scores, key_padding_mask.view(
+                batch_size, 1, 1, src_len
+            ))
+        attn = torch.nn.functional.dropout(
+            torch.softmax(scores, dim=-1), p=self.dropout,
+            training=self.training
+        )
+        output = torch.matmul(attn, v).transpose(1, 2)
+        output = output.reshape(batch_size, tgt_len, -1)
+        return self.out_proj(output), None
+
+
+def fill_model_sizes(args):
+    """
+    resolve the encoder and decoder sizes left as -1 on the command line
+    to the shared --n_layer, --dim and --heads in place, so the logged
+    args record the whole architecture
+    """
+    shared = {'layer': args.n_layer, 'dim': args.dim, 'heads': args.heads}
+    for part in ['enc', 'dec']:
+        for key, value in shared.items():
+            if getattr(args, f'{part}_{key}') < 0:
+                setattr(args, f'{part}_{key}', value)
+    if args.enc_ffn < 0:
+        args.enc_ffn = args.enc_dim * 3
+    if args.dec_ffn < 0:
+        args.dec_ffn = args.dec_dim * 2
+    return args
+
+
+def build_model(model_args, tokenizer, device, dropout):
+    # the model of the sizes of model_args after fill_model_sizes
+    GNN = GATBase(
+        num_layers=model_args.enc_layer, dropout=dropout,
+        embedding_dim=model_args.enc_dim, num_heads=model_args.enc_heads,
+        negative_slope=model_args.negative_slope,
+        n_class=11 if model_args.use_class else None,
+        backend=model_args.gnn_backend, dense_ratio=model_args.dense_ratio,
+        edge_hidden=model_args.enc_ffn
+    )
+    decode_layer = torch.nn.TransformerDecoderLayer(
+        d_model=model_args.dec_dim, nhead=model_args.dec_heads,
+        batch_first=True, dim_feedforward=model_args.dec_ffn,
+        dropout=dropout
+    )
+    Decoder = torch.nn.TransformerDecoder(decode_layer, model_args.dec_layer)
+    Pos_env = PositionalEncoding(model_args.dec_dim, dropout, maxlen=2000)
+    return PretrainModel(
+        token_size=tokenizer.get_token_size(), encoder=GNN,
+        decoder=Decoder, d_model=model_args.dec_dim, pos_enc=Pos_env,
+        memory_dim=model_args.enc_dim
+    ).to(device)
+
+
 class PretrainModel(torch.nn.Module):
-    def __init__(self, token_size, encoder, decoder, d_model, pos_enc):
+    def __init__(
+        self, token_size, encoder, decoder, d_model, pos_enc,
+        memory_dim=None, recompute=0
+    ):
         super(PretrainModel, self).__init__()
         self.word_emb = torch.nn.Embedding(token_size, d_model)
         self.encoder, self.decoder = encoder, decoder
         self.pos_enc = pos_enc
+        if memory_dim is not None and memory_dim != d_model:
+            # encoder of another width, projected to the decoder
+            self.memory_proj = torch.nn.Linear(memory_dim, d_model)
+        else:
+            self.memory_proj = None
+        # the first recompute decoder layers (all for -1) save no
+        # activations in training and are run again in backward
+        self.recompute = recompute
         self.output_layer = torch.nn.Sequential(
             torch.nn.Linear(d_model, d_model),
             torch.nn.ReLU(),
@@ -36,33 +160,109 @@ class PretrainModel(torch.nn.Module):
 
     def graph2batch(
         self, node_feat: torch.Tensor, batch_mask: torch.Tensor,
+        pad_index: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
+        # pad_index is the position of every node in the padded batch,
+        # built by the collate function, a single index_copy
         batch_size, max_node = batch_mask.shape
-        answer = torch.zeros(batch_size, max_node, node_feat.shape[-1])
-        answer = answer.to(node_feat)
-        answer[batch_mask] = node_feat
-        return answer
+        if pad_index is None:
+            pad_index = torch.nonzero(batch_mask.reshape(-1)).squeeze(-1)
+        answer = node_feat.new_zeros(
+            batch_size * max_node, node_feat.shape[-1]
+        )
+        answer.index_copy_(0, pad_index, node_feat)
+        return answer.view(batch_size, max_node, -1)
 
-    def encode(self, graphs):
+    def encode_nodes(self, graphs):
+        # the batches of Dataset.MemoryCacheDataset carry the node features
+        # of the frozen encoder, computed once by build_memory_cache
+        if 'cached_feat' in graphs:
+            return graphs.cached_feat
         node_feat, edge_feat = self.encoder(graphs)
-        memory = self.graph2batch(node_feat, graphs.batch_mask)
+        return node_feat
+
+    def encode(self, graphs):
+        node_feat = self.encode_nodes(graphs)
+        if self.memory_proj is not None:
+            node_feat = self.memory_proj(node_feat)
+        memory = self.graph2batch(
+            node_feat, graphs.batch_mask, graphs.get('pad_index', None)
+        )
         memory = self.pos_enc(memory)
 
         return memory, torch.logical_not(graphs.batch_mask)
 
+    def encode_packed(self, graphs):
+        """
+        the memory without padding, [num_nodes, dim] with the nodes of
+        graph b in rows ptr[b] to ptr[b + 1], for attention over packed
+        sequences
+        """
+        node_feat = self.encode_nodes(graphs)
+        if self.memory_proj is not None:
+            node_feat = self.memory_proj(node_feat)
+        position = torch.arange(node_feat.shape[0], device=node_feat.device)
+        position = position - graphs.ptr[graphs.batch]
+        return self.pos_enc(node_feat, position), graphs.ptr
+
+    def run_decoder(self, tgt, memory, **kwargs):
+        if self.recompute == 0 or not self.training or \
+                not torch.is_grad_enabled():
+            return self.decoder(tgt=tgt, memory=memory, **kwargs)
+        output = tgt
+        for idx, mod in enumerate(self.decoder.layers):
+            if idx < self.recompute or self.recompute < 0:
+                output = checkpoint(
+                    functools.partial(mod, **kwargs), output, memory,
+                    use_reentrant=False
+                )
+            else:
+                output = mod(output, memory, **kwargs)
+        if self.decoder.norm is not None:
+            output = self.decoder.norm(output)
+        return output
+
     def decode(
         self, tgt, memory, memory_padding_mask=None,
         tgt_mask=None, tgt_padding_mask=None
     ):
         tgt_emb = self.pos_enc(self.word_emb(tgt))
-        result = self.decoder(
+        result = self.run_decoder(
             tgt=tgt_emb, memory=memory, tgt_mask=tgt_mask,
             memory_key_padding_mask=memory_padding_mask,
             tgt_key_padding_mask=tgt_padding_mask
         )
         return self.output_layer(result)
 
-    def forward(self, graphs, tgt, tgt_mask, tgt_pad_mask):
+    def decode_packed(
+        self, tgt, position, memory, tgt_mask, memory_mask, out_index
+    ):
+        """
+        decode rows packing several sequences, the masks are per row
+        [rows, tgt_len, mem_len] and are repeated for the heads, the
+        output layer only runs on out_index, the flattened positions
+        of the real tokens
+        """
+        num_heads = self.decoder.layers[0].self_attn.num_heads
+        tgt_emb = self.pos_enc(self.word_emb(tgt), position)
+        result = self.run_decoder(
+            tgt=tgt_emb, memory=memory,
+            tgt_mask=tgt_mask.repeat_interleave(num_heads, dim=0),
+            memory_mask=memory_mask.repeat_interleave(num_heads, dim=0)
+        )
+        result = result.reshape(-1, result.shape[-1])
+        return self.output_layer(result.index_select(0, out_index))
+
+    def forward(self, graphs, tgt, tgt_mask, tgt_pad_mask, packing=None):
+        if packing is not None:
+            # packing comes from data_utils.generate_packed_batch
+            memory, ptr = self.encode_packed(graphs)
+            return self.decode_packed(
+                tgt=tgt, position=packing['position'],
+                memory=memory[packing['memory_index']], tgt_mask=tgt_mask,
+                memory_mask=packing['memory_mask'],
+                out_index=packing['out_index']
+            )
 
         memory, memory_pad = self.encode(graphs)
         result = self.decode(
@@ -5,28 +5,33 @@ import json
 import os
 import time
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
 from sparse_backBone import GATBase
-from Dataset import TransDataset, col_fn_pretrain
-from model import PositionalEncoding, PretrainModel
+from Dataset import TransDataset, SkipBatchSampler, col_fn_pretrain
+from model import PositionalEncoding, PretrainModel, fill_model_sizes
 from training import pretrain, preeval
 from data_utils import fix_seed, check_early_stop
 from tokenlizer import DEFAULT_SP, Tokenizer
 from torch.optim.lr_scheduler import ExponentialLR
 from utils.chemistry_parse import clear_map_number
+from checkpoint_utils import (
+    Checkpointer, checkpoint_run_id, get_rng_state, set_rng_state
+)
+import numpy as np
 import pandas
 
 from torch.nn import TransformerDecoderLayer, TransformerDecoder
 
 
-def create_log_model(args):
-    timestamp = time.time()
+def create_log_model(args, run_id=None):
+    timestamp = time.time() if run_id is None else run_id
     if not os.path.exists(args.base_log):
         os.makedirs(args.base_log)
     detail_log_dir = os.path.join(args.base_log, f'log-{timestamp}.json')
     detail_model_dir = os.path.join(args.base_log, f'mod-{timestamp}.pth')
     token_path = os.path.join(args.base_log, f'token-{timestamp}.pkl')
-    return detail_log_dir, detail_model_dir, token_path
+    ckpt_prefix = os.path.join(args.base_log, f'ckpt-{timestamp}')
+    return detail_log_dir, detail_model_dir, token_path, ckpt_prefix
 
 
 def load_moles(data_dir, part):
@@ -42,7 +47,8 @@ def load_moles(data_dir, part):
         moles.add(prd)
         if '.' in rea:
             reacts.add(rea)
-    return list(moles), list(reacts)
+    # sorted, the order of a set depends on the hash seed of the process
+    return sorted(moles), sorted(reacts)
 
 
 if __name__ == '__main__':
@@ -98,10 +104,53 @@ if __name__ == '__main__':
         '--heads', default=4, type=int,
         help='the number of heads for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
     parser.add_argument(
         '--negative_slope', type=float, default=0.2,
         help='negative slope for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention, auto chooses '
+        'between fused and dense by the shape of every batch'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense, '
+        'see benchmarks/dense_backend.py'
+    )
     parser.add_argument(
         '--token_path', type=str, default='',
         help='the path of json containing tokens'
@@ -115,6 +164,25 @@ if __name__ == '__main__':
         help='the path of token checkpoint, required while' +
         ' checkpoint is specified'
     )
+    parser.add_argument(
+        '--resume', type=str, default='',
+        help='the path of a full training state saved by this script, '
+        'the run goes on at the saved step with the same data order'
+    )
+    parser.add_argument(
+        '--ckpt_every', type=int, default=0,
+        help='save the full training state every this number of '
+        'optimizer steps, 0 for the end of every epoch only'
+    )
+    parser.add_argument(
+        '--keep_ckpt', type=int, default=2,
+        help='the number of newest training states kept'
+    )
+    parser.add_argument(
+        '--sync_ckpt', action='store_true',
+        help='write the training states in the training loop instead '
+        'of a background thread'
+    )
     parser.add_argument(
         '--lrgamma', type=float, default=1,
         help='the gamma for lr_scheduler weight decay'
@@ -131,15 +199,45 @@ if __name__ == '__main__':
         '--num_worker', type=int, default=0,
         help='the number of worker for dataloader'
     )
+    parser.add_argument(
+        '--pack_len', type=int, default=0,
+        help='pack several target sequences into training rows of this '
+        'length with block-diagonal causal masks, 0 for padded batches'
+    )
+    parser.add_argument(
+        '--enc_recompute', type=int, default=0,
+        help='the number of encoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--dec_recompute', type=int, default=0,
+        help='the number of decoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast, for cpus and gpus '
+        'with fast bf16 kernels'
+    )
 
     # training
 
-    args = parser.parse_args()
+    args = fill_model_sizes(parser.parse_args())
     print(args)
 
-    log_dir, model_dir, token_dir = create_log_model(args)
-
-    if args.checkpoint != '':
+    run_id = None
+    if args.resume != '':
+        # the resumed run goes on writing the log, model, tokenizer and
+        # training state files of the run that saved the state
+        args.base_log = os.path.dirname(os.path.abspath(args.resume))
+        run_id = checkpoint_run_id(args.resume)
+    log_dir, model_dir, token_dir, ckpt_prefix = \
+        create_log_model(args, run_id)
+
+    if args.resume != '':
+        with open(token_dir, 'rb') as Fin:
+            tokenizer = pickle.load(Fin)
+    elif args.checkpoint != '':
         assert args.token_ckpt != '', \
             'require token_ckpt when checkpoint is given'
         with open(args.token_ckpt, 'rb') as Fin:
@@ -164,9 +262,14 @@ if __name__ == '__main__':
     train_set = TransDataset(train_moles, train_reac, mode='train')
     test_set = TransDataset(test_moles, test_reac, mode='eval')
 
+    # reseeded with seed + epoch, the batches of an epoch can be replayed
+    train_gen = torch.Generator()
     train_loader = DataLoader(
-        train_set, collate_fn=col_fn_pretrain, shuffle=True,
-        batch_size=args.bs, num_workers=args.num_worker
+        train_set, collate_fn=col_fn_pretrain, num_workers=args.num_worker,
+        batch_sampler=SkipBatchSampler(BatchSampler(
+            RandomSampler(train_set, generator=train_gen),
+            batch_size=args.bs, drop_last=False
+        ))
     )
     test_loader = DataLoader(
         test_set, collate_fn=col_fn_pretrain, shuffle=False,
@@ -174,21 +277,24 @@ if __name__ == '__main__':
     )
 
     GNN = GATBase(
-        num_layers=args.n_layer, dropout=args.dropout,
-        embedding_dim=args.dim, num_heads=args.heads,
-        negative_slope=args.negative_slope, n_class=None
+        num_layers=args.enc_layer, dropout=args.dropout,
+        embedding_dim=args.enc_dim, num_heads=args.enc_heads,
+        negative_slope=args.negative_slope, n_class=None,
+        backend=args.gnn_backend, dense_ratio=args.dense_ratio,
+        edge_hidden=args.enc_ffn, recompute=args.enc_recompute
     )
 
     decode_layer = TransformerDecoderLayer(
-        d_model=args.dim, nhead=args.heads, batch_first=True,
-        dim_feedforward=args.dim * 2, dropout=args.dropout
+        d_model=args.dec_dim, nhead=args.dec_heads, batch_first=True,
+        dim_feedforward=args.dec_ffn, dropout=args.dropout
     )
-    Decoder = TransformerDecoder(decode_layer, args.n_layer)
-    Pos_env = PositionalEncoding(args.dim, args.dropout, maxlen=2000)
+    Decoder = TransformerDecoder(decode_layer, args.dec_layer)
+    Pos_env = PositionalEncoding(args.dec_dim, args.dropout, maxlen=2000)
 
     model = PretrainModel(
         token_size=tokenizer.get_token_size(), encoder=GNN,
-        decoder=Decoder, d_model=args.dim, pos_enc=Pos_env
+        decoder=Decoder, d_model=args.dec_dim, pos_enc=Pos_env,
+        memory_dim=args.enc_dim, recompute=args.dec_recompute
     ).to(device)
 
     if args.checkpoint != '':
@@ -204,25 +310,63 @@ if __name__ == '__main__':
         'test_metric': []
     }
 
+    def save_state(epoch, step, losses):
+        checkpointer.save({
+            'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+            'lr_sh': lr_scher.state_dict(), 'epoch': epoch, 'step': step,
+            'log_info': log_info, 'best_perf': best_cov, 'best_ep': best_ep,
+            'ranks': [{'rng': get_rng_state(), 'data': {}, 'losses': losses}]
+        }, epoch, step)
+
+    def on_step(step, losses):
+        if checkpointer.step():
+            save_state(ep, step, losses)
+
+    checkpointer = Checkpointer(
+        ckpt_prefix, args.ckpt_every, args.keep_ckpt, not args.sync_ckpt
+    )
+    start_ep, resume = 0, None
+    if args.resume != '':
+        print(f'[INFO] Resuming from {args.resume}')
+        state = torch.load(args.resume, map_location='cpu')
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        lr_scher.load_state_dict(state['lr_sh'])
+        log_info, start_ep = state['log_info'], state['epoch']
+        best_cov, best_ep = state['best_perf'], state['best_ep']
+        rank_state = state['ranks'][0]
+        train_loader.batch_sampler.skip = state['step']
+        if state['step'] > 0:
+            resume = {
+                'step': state['step'], 'losses': rank_state['losses'],
+                'rng': rank_state['rng']
+            }
+        else:
+            set_rng_state(rank_state['rng'])
+
     with open(log_dir, 'w') as Fout:
         json.dump(log_info, Fout, indent=4)
     with open(token_dir, 'wb') as Fout:
         pickle.dump(tokenizer, Fout)
 
-    for ep in range(args.epoch):
+    for ep in range(start_ep, args.epoch):
         print(f'[INFO] traing at epoch {ep + 1}')
+        train_gen.manual_seed(args.seed + ep)
         loss = pretrain(
             loader=train_loader, model=model, optimizer=optimizer,
             tokenizer=tokenizer, device=device, pad_token='<PAD>',
-            warmup=(ep < args.warmup), accu=args.accu
+            warmup=(ep < args.warmup), accu=args.accu,
+            pack_len=args.pack_len, bf16=args.bf16, resume=resume,
+            on_step=on_step
         )
+        resume = None
         log_info['train_loss'].append(loss)
 
         print('[TRAIN]', log_info['train_loss'][-1])
 
         test_results = preeval(
             loader=test_loader, model=model, tokenizer=tokenizer,
-            pad_token='<PAD>', end_token='<END>', device=device
+            pad_token='<PAD>', end_token='<END>', device=device, bf16=args.bf16
         )
         log_info['test_metric'].append(test_results)
 
@@ -238,10 +382,16 @@ if __name__ == '__main__':
             best_cov, best_ep = test_results, ep
             torch.save(model.state_dict(), model_dir)
 
+        save_state(ep + 1, 0, None)
+
         if args.early_stop >= 5 and ep > max(20, args.early_stop):
             val_his = log_info['test_metric'][-args.early_stop:]
             if check_early_stop(val_his):
                 break
 
+    checkpointer.wait()
+    if len(checkpointer.blocked) > 0:
+        blocked = np.mean(checkpointer.blocked) * 1e3
+        print(f'[INFO] training blocked {blocked:.1f} ms per checkpoint')
     print('[BEST EP]', best_ep)
     print('[BEST TEST]', log_info['test_metric'][best_ep])
@@ -0,0 +1,421 @@
+import torch
+import argparse
+import copy
+import os
+import time
+import pickle
+import random
+import shutil
+
+from torch.utils.data import DataLoader
+from model import fill_model_sizes, build_model
+from Dataset import RetroDataset, col_fn_retro
+from data_utils import load_data, fix_seed
+from training import pretrain, preeval
+from checkpoint_utils import dump_json_atomic
+from prune_utils import (
+    ATTENTIONS, full_arch, remove_units, pruned_copy, head_importance,
+    layer_importance, decode_latency
+)
+
+
+def create_log_model(args):
+    timestamp = time.time()
+    if not os.path.exists(args.base_log):
+        os.makedirs(args.base_log)
+    return {
+        x: os.path.join(args.base_log, f'{x}-{timestamp}.{y}')
+        for x, y in [('log', 'json'), ('pruned', 'pth'), ('token', 'pkl')]
+    }
+
+
+def unit_costs(model, arch, graphs, device, args, base):
+    """
+    the ms per molecule saved by removing one unit of each kind, measured
+    once with decode_latency, an encoder or decoder layer and a self or
+    cross attention head of the decoder, the cost of a head is that of
+    half the heads of every layer over their number
+    """
+    def saved(units):
+        latency = decode_latency(
+            pruned_copy(model, remove_units(arch, units)), graphs, device,
+            args.beams, args.latency_len, args.bf16
+        )
+        return max(base - latency, 1e-3)
+
+    costs = {
+        'enc': saved([('enc', arch['enc_layers'][-1])]),
+        'dec': saved([('dec', arch['dec_layers'][-1])])
+    }
+    heads = arch['dec_heads']
+    for name in ATTENTIONS:
+        units = [
+            (name, layer, head) for layer in arch['dec_layers']
+            for head in range(heads // 2, heads)
+        ]
+        costs[name] = saved(units) / len(units) if units else base
+    return costs
+
+
+def search(arch, scores, costs, base, target):
+    """
+    removes the units of the least importance per ms saved from arch
+    until the predicted latency is below target, a layer saves its cost
+    minus the cost of its heads removed before, one layer of encoder and
+    decoder and one head of every attention are kept
+    :return: the pruned arch and its predicted latency
+    """
+    removed, predict = [], base
+    order = sorted(scores, key=lambda x: scores[x] / costs[x[0]])
+    for unit in order:
+        if predict <= target:
+            break
+        if unit[0] in ATTENTIONS:
+            if ('dec', unit[1]) in removed:
+                continue
+            idx = arch['dec_layers'].index(unit[1])
+            if len(arch[unit[0]][idx]) == 1:
+                continue
+            saving = costs[unit[0]]
+        else:
+            key = 'enc_layers' if unit[0] == 'enc' else 'dec_layers'
+            if len(arch[key]) == 1:
+                continue
+            saving = costs[unit[0]]
+            if unit[0] == 'dec':
+                idx = arch['dec_layers'].index(unit[1])
+                saving -= sum(
+                    costs[x] * (arch['dec_heads'] - len(arch[x][idx]))
+                    for x in ATTENTIONS
+                )
+        arch = remove_units(arch, [unit])
+        removed.append(unit)
+        predict -= saving
+    return arch, predict
+
+
+def count_params(model):
+    return sum(x.numel() for x in model.parameters())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Structured pruning')
+    parser.add_argument(
+        '--dim', default=256, type=int,
+        help='the hidden dim of model'
+    )
+    parser.add_argument(
+        '--n_layer', default=8, type=int,
+        help='the layer of backbones'
+    )
+    parser.add_argument(
+        '--heads', default=4, type=int,
+        help='the number of heads for attention, only useful for gat'
+    )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
+    parser.add_argument(
+        '--negative_slope', type=float, default=0.2,
+        help='negative slope for attention, only useful for gat'
+    )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense'
+    )
+    parser.add_argument(
+        '--checkpoint', type=str, required=True,
+        help='the path of the weights of the unpruned model'
+    )
+    parser.add_argument(
+        '--token_ckpt', type=str, required=True,
+        help='the path of the tokenizer of the model'
+    )
+    parser.add_argument(
+        '--data_path', required=True, type=str,
+        help='the path containing dataset'
+    )
+    parser.add_argument(
+        '--use_class', action='store_true',
+        help='use rxn_class for training or not'
+    )
+    parser.add_argument(
+        '--latency_budget', type=float, default=0,
+        help='the ms per molecule of the pruned model, 0 for '
+        'latency_ratio of the unpruned one'
+    )
+    parser.add_argument(
+        '--latency_ratio', type=float, default=0.5,
+        help='the latency of the pruned model over that of the unpruned '
+        'one, used when latency_budget is 0'
+    )
+    parser.add_argument(
+        '--latency_size', default=5, type=int,
+        help='the number of validation molecules timed one by one'
+    )
+    parser.add_argument(
+        '--latency_len', default=100, type=int,
+        help='the tokens decoded per molecule in timing'
+    )
+    parser.add_argument(
+        '--beams', default=10, type=int,
+        help='the beams of beam search in timing'
+    )
+    parser.add_argument(
+        '--search_rounds', default=3, type=int,
+        help='the searches at most, at least 1, each one aiming lower by '
+        'the measured latency above the budget'
+    )
+    parser.add_argument(
+        '--score_size', default=1000, type=int,
+        help='the number of validation reactions for the importance '
+        'of heads and layers, 0 for the whole validation set'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=2023,
+        help='the seed for training'
+    )
+    parser.add_argument(
+        '--bs', type=int, default=64,
+        help='the batch size for scoring and fine-tuning'
+    )
+    parser.add_argument(
+        '--epoch', type=int, default=2,
+        help='the epochs of fine-tuning after pruning, 0 for none'
+    )
+    parser.add_argument(
+        '--lr', type=float, default=1e-4,
+        help='the learning rate for fine-tuning'
+    )
+    parser.add_argument(
+        '--dropout', type=float, default=0.1,
+        help='the dropout rate for fine-tuning'
+    )
+    parser.add_argument(
+        '--aug_prob', default=0.5, type=float,
+        help='the probability of performing data augumentation'
+    )
+    parser.add_argument(
+        '--device', type=int, default=-1,
+        help='the device for pruning, -1 for cpu, latency is always '
+        'timed on cpu'
+    )
+    parser.add_argument(
+        '--threads', default=0, type=int,
+        help='the intra-op threads on cpu, 0 for the torch default'
+    )
+    parser.add_argument(
+        '--num_workers', default=0, type=int,
+        help='the number of workers for data loader'
+    )
+    parser.add_argument(
+        '--base_log', default='log_prune', type=str,
+        help='the base dir of logging'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast'
+    )
+    args = fill_model_sizes(parser.parse_args())
+    print(args)
+    assert args.search_rounds >= 1, 'At least one search round is required'
+    paths = create_log_model(args)
+
+    if not torch.cuda.is_available() or args.device < 0:
+        device = torch.device('cpu')
+    else:
+        device = torch.device(f'cuda:{args.device}')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    fix_seed(args.seed)
+
+    with open(args.token_ckpt, 'rb') as Fin:
+        tokenizer = pickle.load(Fin)
+    shutil.copyfile(args.token_ckpt, paths['token'])
+
+    train_rec, train_prod, train_rxn = load_data(args.data_path, 'train')
+    val_rec, val_prod, val_rxn = load_data(args.data_path, 'val')
+    print('[INFO] Data Loaded')
+
+    # the importance comes from a fixed subset of the validation set
+    keep = list(range(len(val_rec)))
+    if 0 < args.score_size < len(keep):
+        keep = sorted(random.Random(args.seed).sample(keep, args.score_size))
+    score_set = RetroDataset(
+        prod_sm=[val_prod[x] for x in keep],
+        reat_sm=[val_rec[x] for x in keep], aug_prob=0,
+        rxn_cls=[val_rxn[x] for x in keep] if args.use_class else None
+    )
+    valid_set = RetroDataset(
+        prod_sm=val_prod, reat_sm=val_rec, aug_prob=0,
+        rxn_cls=val_rxn if args.use_class else None
+    )
+    train_set = RetroDataset(
+        prod_sm=train_prod, reat_sm=train_rec, aug_prob=args.aug_prob,
+        rxn_cls=train_rxn if args.use_class else None
+    )
+    score_loader, valid_loader = [DataLoader(
+        x, collate_fn=col_fn_retro, batch_size=args.bs, shuffle=False,
+        num_workers=args.num_workers
+    ) for x in [score_set, valid_set]]
+    train_loader = DataLoader(
+        train_set, collate_fn=col_fn_retro, batch_size=args.bs,
+        shuffle=True, num_workers=args.num_workers
+    )
+
+    model = build_model(args, tokenizer, device, args.dropout)
+    print(f'[INFO] Loading model weight in {args.checkpoint}')
+    weight = torch.load(args.checkpoint, map_location=device)
+    if 'arch' in weight:
+        raise ValueError('The checkpoint is pruned already')
+    model.load_state_dict(weight, strict=True)
+    arch = full_arch(model)
+
+    print('[INFO] Scoring heads and layers')
+    scores = head_importance(
+        model, score_loader, device, tokenizer, '<PAD>', args.bf16
+    )
+    scores = {
+        (name, layer, head): value
+        for name in ATTENTIONS for layer, values in
+        zip(arch['dec_layers'], scores[name])
+        for head, value in enumerate(values)
+    }
+    scores.update(layer_importance(
+        model, arch, score_loader, device, tokenizer, '<PAD>', args.bf16
+    ))
+
+    # timed one by one on cpu as beam_search_one serves them
+    cpu_model = copy.deepcopy(model).cpu()
+    graphs = [
+        col_fn_retro([valid_set[x % len(valid_set)]])[0]
+        for x in range(args.latency_size)
+    ]
+    print('[INFO] Timing the units on cpu')
+    base = decode_latency(
+        cpu_model, graphs, 'cpu', args.beams, args.latency_len, args.bf16
+    )
+    # the pruned models run PrunedMultiheadAttention, the savings are
+    # measured against the unpruned model converted to it
+    converted = decode_latency(
+        pruned_copy(cpu_model, arch), graphs, 'cpu', args.beams,
+        args.latency_len, args.bf16
+    )
+    costs = unit_costs(cpu_model, arch, graphs, 'cpu', args, converted)
+    budget = args.latency_budget or base * args.latency_ratio
+    print(f'[INFO] latency {base:.1f} ms, converted {converted:.1f} ms, '
+          f'budget {budget:.1f} ms, saved per unit {costs}')
+
+    target, rounds, pruned_arch = budget, [], None
+    for _ in range(args.search_rounds):
+        last_arch = pruned_arch
+        pruned_arch, predict = search(
+            arch, scores, costs, converted, target
+        )
+        if pruned_arch == last_arch:
+            print('[INFO] no unit left to remove for the budget')
+            break
+        latency = decode_latency(
+            pruned_copy(cpu_model, pruned_arch), graphs, 'cpu', args.beams,
+            args.latency_len, args.bf16
+        )
+        rounds.append({
+            'target': target, 'predict': predict, 'latency': latency
+        })
+        print('[SEARCH]', rounds[-1])
+        if latency <= budget:
+            break
+        target -= latency - budget
+    del cpu_model
+
+    valid_acc = preeval(
+        loader=valid_loader, model=model, tokenizer=tokenizer,
+        pad_token='<PAD>', end_token='<END>', device=device, bf16=args.bf16
+    )
+    log_info = {
+        'args': args.__dict__, 'arch': pruned_arch,
+        'scores': [[list(k), v] for k, v in scores.items()],
+        'costs': costs, 'budget': budget, 'search': rounds,
+        'unpruned': {
+            'params': count_params(model), 'latency_ms': base,
+            'valid_acc': valid_acc
+        }
+    }
+    model = pruned_copy(model, pruned_arch)
+    del weight
+
+    # the fine-tune keeps the weights of the best validation accuracy,
+    # the pruned weights before it included
+    best_perf = preeval(
+        loader=valid_loader, model=model, tokenizer=tokenizer,
+        pad_token='<PAD>', end_token='<END>', device=device, bf16=args.bf16
+    )
+    best_state = copy.deepcopy(model.state_dict())
+    log_info['valid_metric'] = [best_perf]
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    for ep in range(args.epoch):
+        print(f'[INFO] fine-tuning at epoch {ep + 1}')
+        loss = pretrain(
+            loader=train_loader, model=model, optimizer=optimizer,
+            tokenizer=tokenizer, device=device, pad_token='<PAD>',
+            warmup=False, bf16=args.bf16
+        )
+        valid_result = preeval(
+            loader=valid_loader, model=model, tokenizer=tokenizer,
+            pad_token='<PAD>', end_token='<END>', device=device,
+            bf16=args.bf16
+        )
+        log_info['valid_metric'].append(valid_result)
+        print('[TRAIN]', loss, '[VALID]', valid_result)
+        if valid_result > best_perf:
+            best_perf = valid_result
+            best_state = copy.deepcopy(model.state_dict())
+
+    torch.save({'arch': pruned_arch, 'model': best_state}, paths['pruned'])
+    log_info['pruned'] = {
+        'params': count_params(model), 'latency_ms': rounds[-1]['latency'],
+        'valid_acc': best_perf
+    }
+    dump_json_atomic(log_info, paths['log'])
+
+    print('| model | params | latency_ms | valid_acc |')
+    print('|---' * 4 + '|')
+    for name in ['unpruned', 'pruned']:
+        result = log_info[name]
+        print(f'| {name} | {result["params"]} | '
+              f'{result["latency_ms"]:.1f} | {result["valid_acc"]:.4f} |')
+    print(f'[INFO] pruned model {paths["pruned"]} and {paths["token"]}')
@@ -0,0 +1,234 @@
+import copy
+import time
+import torch
+from tqdm import tqdm
+from model import PrunedMultiheadAttention
+from data_utils import (
+    generate_tgt_mask, generate_square_subsequent_mask, bf16_autocast
+)
+from training import calc_trans_loss
+
+
+ATTENTIONS = ['self_attn', 'multihead_attn']
+
+
+def full_arch(model):
+    """
+    the architecture of an unpruned model in the metadata of prune_model,
+    the kept layers of encoder and decoder and the kept heads of the self
+    and cross attention of every kept decoder layer, all indices of the
+    unpruned model
+    """
+    dec_layer = len(model.decoder.layers)
+    dec_heads = model.decoder.layers[0].self_attn.num_heads
+    return {
+        'enc_layer': model.encoder.num_layers, 'dec_layer': dec_layer,
+        'dec_heads': dec_heads,
+        'enc_layers': list(range(model.encoder.num_layers)),
+        'dec_layers': list(range(dec_layer)),
+        'self_attn': [list(range(dec_heads)) for _ in range(dec_layer)],
+        'multihead_attn': [list(range(dec_heads)) for _ in range(dec_layer)]
+    }
+
+
+def prune_heads(attn, heads):
+    """
+    an attention of the heads given from nn.MultiheadAttention, the rows
+    of in_proj and the columns of out_proj of the other heads removed
+    """
+    head_dim, inner_dim = attn.head_dim, attn.num_heads * attn.head_dim
+    index = torch.arange(head_dim).repeat(len(heads))
+    index = index + torch.LongTensor(heads).repeat_interleave(head_dim) \
+        * head_dim
+    index = index.to(attn.in_proj_weight.device)
+    rows = torch.cat([index + x * inner_dim for x in range(3)])
+    answer = PrunedMultiheadAttention(
+        attn.embed_dim, len(heads), head_dim, attn.dropout
+    ).to(attn.in_proj_weight)
+    with torch.no_grad():
+        answer.in_proj_weight.copy_(attn.in_proj_weight[rows])
+        answer.in_proj_bias.copy_(attn.in_proj_bias[rows])
+        answer.out_proj.weight.copy_(attn.out_proj.weight[:, index])
+        answer.out_proj.bias.copy_(attn.out_proj.bias)
+    return answer
+
+
+def prune_model(model, arch):
+    """
+    cuts an unpruned model in place to the layers and heads of arch, the
+    metadata saved by prune.py, the weights of the removed parts are gone
+    so that the layers left are smaller matrices. a random model cut to
+    arch takes the state dict of the pruned model
+    """
+    encoder, decoder = model.encoder, model.decoder
+    sizes = (encoder.num_layers, len(decoder.layers),
+             decoder.layers[0].self_attn.num_heads)
+    if sizes != (arch['enc_layer'], arch['dec_layer'], arch['dec_heads']):
+        raise ValueError(
+            f'The layers and heads {sizes} differ from those of the '
+            'unpruned model of arch'
+        )
+    for name in ['convs', 'batch_norms', 'edge_update']:
+        layers = getattr(encoder, name)
+        setattr(encoder, name, torch.nn.ModuleList(
+            layers[x] for x in arch['enc_layers']
+        ))
+    encoder.num_layers = len(arch['enc_layers'])
+
+    layers = torch.nn.ModuleList()
+    for idx, layer in enumerate(arch['dec_layers']):
+        layer = decoder.layers[layer]
+        # all the attentions are converted, the masks of decode_packed
+        # are repeated for the heads of the first layer only
+        for name in ATTENTIONS:
+            heads = arch[name][idx]
+            setattr(layer, name, prune_heads(getattr(layer, name), heads))
+        layers.append(layer)
+    decoder.layers, decoder.num_layers = layers, len(layers)
+    return model
+
+
+def remove_units(arch, units):
+    """
+    the arch without units, ('enc', layer), ('dec', layer) or
+    (attention, layer, head) in indices of the unpruned model
+    """
+    arch = copy.deepcopy(arch)
+    for unit in units:
+        if unit[0] in ATTENTIONS:
+            idx = arch['dec_layers'].index(unit[1])
+            heads = arch[unit[0]][idx]
+            arch[unit[0]][idx] = [x for x in heads if x != unit[2]]
+        elif unit[0] == 'dec':
+            idx = arch['dec_layers'].index(unit[1])
+            for key in ['dec_layers'] + ATTENTIONS:
+                arch[key] = arch[key][:idx] + arch[key][idx + 1:]
+        else:
+            layers = arch['enc_layers']
+            arch['enc_layers'] = [x for x in layers if x != unit[1]]
+    return arch
+
+
+def pruned_copy(model, arch):
+    # a pruned copy of an unpruned model, model is left as is
+    return prune_model(copy.deepcopy(model), arch)
+
+
+def load_pruned(model, weight):
+    """
+    the state dict of a checkpoint, the checkpoints of prune.py are
+    {'arch', 'model'} and model is cut to arch first
+    """
+    if 'arch' in weight:
+        print('[INFO] Pruning model to the saved architecture')
+        prune_model(model, weight['arch'])
+        return weight['model']
+    return weight
+
+
+def batch_loss(model, graph, tran, tokenizer, device, pad_token, bf16=False):
+    # the loss of calc_trans_loss on a batch of col_fn_retro
+    graph = graph.to(device)
+    tops = torch.LongTensor(tokenizer.encode2d(tran)).to(device)
+    trans_op_mask, diag_mask = generate_tgt_mask(
+        tops[:, :-1], tokenizer, pad_token, device=device
+    )
+    with bf16_autocast(device, bf16):
+        trans_logs = model(
+            graphs=graph, tgt=tops[:, :-1], tgt_mask=diag_mask,
+            tgt_pad_mask=trans_op_mask
+        )
+    return calc_trans_loss(
+        trans_logs, tops[:, 1:], tokenizer.token2idx[pad_token]
+    )
+
+
+def eval_loss(model, loader, device, tokenizer, pad_token, bf16=False):
+    model, losses = model.eval(), []
+    with torch.no_grad():
+        for graph, tran in loader:
+            losses.append(batch_loss(
+                model, graph, tran, tokenizer, device, pad_token, bf16
+            ).item())
+    return sum(losses) / len(losses)
+
+
+def head_importance(model, loader, device, tokenizer, pad_token, bf16=False):
+    """
+    the first order estimate of the loss increase by removing each head
+    of the decoder, |sum(W * dL/dW)| over the columns of out_proj taking
+    the output of the head, averaged over the batches. the same as the
+    gradient of a gate on the output of the head, with no gates added.
+    :return: {attention: [layers, heads]} in the layers of model
+    """
+    model = model.eval()
+    scores = {x: [] for x in ATTENTIONS}
+    layers = model.decoder.layers
+    for name in ATTENTIONS:
+        for layer in layers:
+            attn = getattr(layer, name)
+            scores[name].append(torch.zeros(attn.num_heads))
+    for graph, tran in tqdm(loader):
+        model.zero_grad(set_to_none=True)
+        batch_loss(
+            model, graph, tran, tokenizer, device, pad_token, bf16
+        ).backward()
+        for name in ATTENTIONS:
+            for idx, layer in enumerate(layers):
+                out_proj = getattr(layer, name).out_proj
+                gate = (out_proj.weight * out_proj.weight.grad).sum(dim=0)
+                gate = gate.view(-1, getattr(layer, name).head_dim).sum(-1)
+                scores[name][idx] += gate.abs().detach().cpu()
+    model.zero_grad(set_to_none=True)
+    return {
+        k: [(x / len(loader)).tolist() for x in v] for k, v in scores.items()
+    }
+
+
+def layer_importance(
+    model, arch, loader, device, tokenizer, pad_token, bf16=False
+):
+    """
+    the increase of the loss on loader with each layer of the encoder and
+    decoder removed, {('enc' or 'dec', layer): increase}
+    """
+    base = eval_loss(model, loader, device, tokenizer, pad_token, bf16)
+    units = [('enc', x) for x in arch['enc_layers']] + \
+        [('dec', x) for x in arch['dec_layers']]
+    scores = {}
+    for unit in tqdm(units):
+        pruned = pruned_copy(model, remove_units(arch, [unit]))
+        scores[unit] = eval_loss(
+            pruned, loader, device, tokenizer, pad_token, bf16
+        ) - base
+    return scores
+
+
+def decode_latency(
+    model, graphs, device, beams=10, steps=100, bf16=False, repeat=2
+):
+    """
+    ms per molecule of the model calls of beam search, the encoder once
+    and the decoder over the beams for steps tokens, one molecule at a
+    time. the tokens are fixed so the cost does not hang on where the
+    beams of a model end, the best of repeat runs
+    """
+    model, best = model.eval(), None
+    tgt = torch.randint(0, model.word_emb.num_embeddings, (beams, steps))
+    tgt = tgt.to(device)
+    with torch.no_grad(), bf16_autocast(device, bf16):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for graph in graphs:
+                memory, mem_pad_mask = model.encode(graph.to(device))
+                memory = memory.repeat(beams, 1, 1)
+                mem_pad_mask = mem_pad_mask.repeat(beams, 1)
+                for idx in range(1, steps + 1):
+                    model.decode(
+                        tgt=tgt[:, :idx], memory=memory,
+                        memory_padding_mask=mem_pad_mask,
+                        tgt_mask=generate_square_subsequent_mask(idx, device)
+                    )
+            elapsed = (time.perf_counter() - start) / len(graphs) * 1e3
+            best = elapsed if best is None else min(best, elapsed)
+    return best
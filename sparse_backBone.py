@@ -1,40 +1,75 @@
 import torch
+import functools
+from torch.utils.checkpoint import checkpoint
 from typing import Any, Dict, List, Tuple, Optional, Union
 from ogb.graphproppred.mol_encoder import AtomEncoder, BondEncoder
 from GATconv import SelfLoopGATConv as MyGATConv
+from GATconv import add_self_loops, to_csr, dense_index
 import numpy as np
 
 
 class SparseEdgeUpdateLayer(torch.nn.Module):
-    def __init__(self, edge_dim: int = 64, node_dim: int = 64):
+    def __init__(
+        self, edge_dim: int = 64, node_dim: int = 64,
+        decomposed: bool = True, hidden_dim: Optional[int] = None
+    ):
         super(SparseEdgeUpdateLayer, self).__init__()
         input_dim = node_dim * 2 + edge_dim
+        if hidden_dim is None:
+            hidden_dim = input_dim
+        self.node_dim, self.edge_dim = node_dim, edge_dim
+        self.decomposed = decomposed
         self.mlp = torch.nn.Sequential(
-            torch.nn.Linear(input_dim, input_dim),
-            torch.nn.LayerNorm(input_dim),
+            torch.nn.Linear(input_dim, hidden_dim),
+            torch.nn.LayerNorm(hidden_dim),
             torch.nn.ReLU(),
-            torch.nn.Linear(input_dim, edge_dim)
+            torch.nn.Linear(hidden_dim, edge_dim)
         )
 
     def forward(
         self, node_feats: torch.Tensor, edge_feats: torch.Tensor,
         edge_index: torch.Tensor,
     ) -> torch.Tensor:
-        node_i = node_feats[edge_index[0]]
-        node_j = node_feats[edge_index[1]]
-        x = torch.cat([node_i, node_j, edge_feats], dim=-1)
-        return self.mlp(x) + edge_feats
+        if not self.decomposed:
+            node_i = node_feats[edge_index[0]]
+            node_j = node_feats[edge_index[1]]
+            x = torch.cat([node_i, node_j, edge_feats], dim=-1)
+            return self.mlp(x) + edge_feats
+
+        # mlp[0](cat(x_i, x_j, e)) = W_i x_i + W_j x_j + W_e e + b, the
+        # node parts are projected once per node and gathered per edge,
+        # so the [E, 2 * node_dim + edge_dim] input is never built
+        lin = self.mlp[0]
+        w_i, w_j, w_e = torch.split(
+            lin.weight, [self.node_dim, self.node_dim, self.edge_dim], dim=1
+        )
+        proj_i = torch.nn.functional.linear(node_feats, w_i)
+        proj_j = torch.nn.functional.linear(node_feats, w_j)
+        x = torch.addmm(lin.bias, edge_feats, w_e.t())
+        x = x + proj_i[edge_index[0]] + proj_j[edge_index[1]]
+        for module in self.mlp[1:]:
+            x = module(x)
+        return x + edge_feats
 
 
 class GATBase(torch.nn.Module):
     def __init__(
         self, num_layers: int = 4, num_heads: int = 4, embedding_dim: int = 64,
         dropout: float = 0.7, negative_slope: float = 0.2,
-        n_class: Optional[int] = None
+        n_class: Optional[int] = None, backend: str = 'pyg',
+        dense_ratio: float = 0, edge_hidden: Optional[int] = None,
+        recompute: int = 0
     ):
         super(GATBase, self).__init__()
         if num_layers < 2:
             raise ValueError("Number of GNN layers must be greater than 1.")
+        if backend not in ['pyg', 'fused', 'dense', 'auto']:
+            raise ValueError(f'Invalid backend {backend}')
+        self.backend, self.dense_ratio = backend, dense_ratio
+        # the first recompute layers (all for -1) save no activations
+        # in training and are run again in backward
+        self.recompute = recompute
+        self.embedding_dim = embedding_dim
         self.convs = torch.nn.ModuleList()
         self.batch_norms = torch.nn.ModuleList()
         self.edge_update = torch.nn.ModuleList()
@@ -51,28 +86,132 @@ class GATBase(torch.nn.Module):
             ))
             self.batch_norms.append(torch.nn.LayerNorm(embedding_dim))
             self.edge_update.append(SparseEdgeUpdateLayer(
-                embedding_dim, embedding_dim
+                embedding_dim, embedding_dim, hidden_dim=edge_hidden
             ))
         self.atom_encoder = SparseAtomEncoder(embedding_dim, n_class)
         self.bond_encoder = SparseBondEncoder(embedding_dim, n_class)
 
+    def select_backend(self, G) -> str:
+        """
+        auto runs the dense backend when the padded attention logits
+        [batch, heads, max_node, max_node] are small compared with the
+        per edge features the sparse backend gathers, otherwise fused
+        """
+        if self.backend != 'auto':
+            return self.backend
+        batch_size, max_node = G.batch_mask.shape
+        padded = batch_size * max_node * max_node * self.num_heads
+        sparse = (G.edge_index.shape[1] + G.x.shape[0]) * self.embedding_dim
+        return 'dense' if padded <= self.dense_ratio * sparse else 'fused'
+
+    def layer_forward(
+        self, layer, node_feats, edge_feats, edge_index, conv_index,
+        batch_mask, backend
+    ):
+        """
+        one layer of graph attention and edge update, conv_index is the
+        degree for fused, the dense index for dense and the edges with
+        self loops for pyg
+        """
+        if backend == 'fused':
+            conv_res = self.convs[layer].fused_forward(
+                x=node_feats, edge_index=edge_index,
+                edge_attr=edge_feats, degree=conv_index
+            )
+        elif backend == 'dense':
+            conv_res = self.convs[layer].dense_forward(
+                x=node_feats, edge_index=edge_index,
+                edge_attr=edge_feats, batch_mask=batch_mask,
+                index=conv_index
+            )
+        else:
+            conv_res = self.convs[layer](
+                x=node_feats, edge_attr=edge_feats,
+                edge_index=conv_index, self_loop_added=True
+            )
+        conv_res = self.batch_norms[layer](conv_res)
+        node_feats = self.dropout_fun(torch.relu(conv_res)) + node_feats
+
+        edge_feats = torch.relu(self.edge_update[layer](
+            edge_feats=edge_feats, node_feats=node_feats,
+            edge_index=edge_index
+        ))
+        return node_feats, edge_feats
+
     def forward(self, G) -> torch.Tensor:
-        node_feats = self.atom_encoder(G.x, G.get('node_rxn', None))
-        edge_feats = self.bond_encoder(G.edge_attr, G.get('edge_rxn', None))
+        backend = self.select_backend(G)
+        # batches carry int32 edge_index, scatter ops need int64
+        edge_index = G.edge_index.long()
+        edge_attr = G.edge_attr
+        if backend == 'fused':
+            # edges sorted by target once per batch for all the layers
+            edge_index, perm, conv_index = to_csr(edge_index, G.x.shape[0])
+            edge_attr = edge_attr[perm]
+        elif backend == 'dense':
+            # positions in the padded batch shared by all the layers
+            conv_index = dense_index(
+                edge_index, G.batch_mask, G.get('pad_index', None)
+            )
+        else:
+            # the self loops are shared by all the layers
+            conv_index = add_self_loops(edge_index, G.x.shape[0])
+        # the reaction class is given per graph and broadcast by the
+        # graph of every node and edge
+        rxn_class = G.get('rxn_class', None)
+        edge_batch = None if rxn_class is None else G.batch[edge_index[0]]
+        node_feats = self.atom_encoder(G.x, rxn_class, G.batch)
+        edge_feats = self.bond_encoder(edge_attr, rxn_class, edge_batch)
         for layer in range(self.num_layers):
-            conv_res = self.batch_norms[layer](self.convs[layer](
-                x=node_feats, edge_attr=edge_feats, edge_index=G.edge_index,
-            ))
-            node_feats = self.dropout_fun(torch.relu(conv_res)) + node_feats
-
-            edge_feats = torch.relu(self.edge_update[layer](
-                edge_feats=edge_feats, node_feats=node_feats,
-                edge_index=G.edge_index
-            ))
+            fun = functools.partial(
+                self.layer_forward, layer, edge_index=edge_index,
+                conv_index=conv_index, batch_mask=G.batch_mask,
+                backend=backend
+            )
+            if self.training and torch.is_grad_enabled() and \
+                    (layer < self.recompute or self.recompute < 0):
+                node_feats, edge_feats = checkpoint(
+                    fun, node_feats, edge_feats, use_reentrant=False
+                )
+            else:
+                node_feats, edge_feats = fun(node_feats, edge_feats)
 
+        if backend == 'fused':
+            # back to the order of the edges in the batch
+            edge_feats = torch.empty_like(edge_feats).index_copy_(
+                0, perm, edge_feats
+            )
         return node_feats, edge_feats
 
 
+def fused_embedding(feat, offsets, embedding_list):
+    """
+    the sum of the embeddings of all the columns of feat, computed as
+    a single embedding_bag over the concatenated tables, offsets are the
+    first rows of every table in the concatenation
+    """
+    weight = torch.cat([x.weight for x in embedding_list], dim=0)
+    return torch.nn.functional.embedding_bag(
+        feat.long() + offsets, weight, mode='sum'
+    )
+
+
+def class_conditioning(feat, rxn_class, index, class_emb, lin):
+    """
+    lin(cat([class_emb(rxn_class[index]), feat])) without concatenating,
+    the class half of lin is computed once per class and gathered by
+    index, the graph of every row, rxn_class is per row if index is None
+    """
+    dim = class_emb.embedding_dim
+    class_part = torch.nn.functional.linear(
+        class_emb.weight, lin.weight[:, :dim], lin.bias
+    )
+    rxn_class = rxn_class.long()
+    if index is not None:
+        rxn_class = rxn_class[index]
+    result = torch.nn.functional.linear(feat, lin.weight[:, dim:])
+    return result + class_part.index_select(0, rxn_class)
+
+
 class SparseAtomEncoder(torch.nn.Module):
     def __init__(self, dim, n_class=None):
         super(SparseAtomEncoder, self).__init__()
@@ -82,16 +221,22 @@ class SparseAtomEncoder(torch.nn.Module):
             self.rxn_class_emb = torch.nn.Embedding(n_class, dim)
             self.lin = torch.nn.Linear(dim + dim, dim)
         self.dim = dim
+        tables = self.atom_encoder.atom_embedding_list
+        sizes = [x.num_embeddings for x in tables]
+        offsets = torch.LongTensor([0] + sizes[:-1]).cumsum(dim=0)
+        self.register_buffer('offsets', offsets, persistent=False)
 
-    def forward(self, node_feat, rxn_class=None):
-        result = self.atom_encoder(node_feat)
+    def forward(self, node_feat, rxn_class=None, batch=None):
+        result = fused_embedding(
+            node_feat, self.offsets, self.atom_encoder.atom_embedding_list
+        )
         if self.n_class is not None:
             if rxn_class is None:
                 raise ValueError('missing reaction class information')
             else:
-                rxn_class_emb = self.rxn_class_emb(rxn_class)
-                result = torch.cat([rxn_class_emb, result], dim=-1)
-                result = self.lin(result)
+                result = class_conditioning(
+                    result, rxn_class, batch, self.rxn_class_emb, self.lin
+                )
         return result
 
 
@@ -104,14 +249,20 @@ class SparseBondEncoder(torch.nn.Module):
             self.rxn_class_emb = torch.nn.Embedding(n_class, dim)
             self.lin = torch.nn.Linear(dim + dim, dim)
         self.dim = dim
+        tables = self.bond_encoder.bond_embedding_list
+        sizes = [x.num_embeddings for x in tables]
+        offsets = torch.LongTensor([0] + sizes[:-1]).cumsum(dim=0)
+        self.register_buffer('offsets', offsets, persistent=False)
 
-    def forward(self, edge_feat, rxn_class=None):
-        result = self.bond_encoder(edge_feat)
+    def forward(self, edge_feat, rxn_class=None, batch=None):
+        result = fused_embedding(
+            edge_feat, self.offsets, self.bond_encoder.bond_embedding_list
+        )
         if self.n_class is not None:
             if rxn_class is None:
                 raise ValueError('missing reaction class information')
             else:
-                rxn_class_emb = self.rxn_class_emb(rxn_class)
-                result = torch.cat([rxn_class_emb, result], dim=-1)
-                result = self.lin(result)
+                result = class_conditioning(
+                    result, rxn_class, batch, self.rxn_class_emb, self.lin
+                )
         return result
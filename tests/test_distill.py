@@ -0,0 +1,36 @@
+import argparse
+import json
+import pytest
+
+from distill import teacher_args
+
+
+def write_log(path, use_class):
+    log_args = {
+        'dim': 64, 'n_layer': 2, 'heads': 4, 'negative_slope': 0.2,
+        'use_class': use_class
+    }
+    with open(path, 'w') as Fout:
+        json.dump({'args': log_args}, Fout)
+    return str(path)
+
+
+@pytest.mark.parametrize('teacher_class', [True, False])
+def test_teacher_args_rejects_other_use_class(tmp_path, teacher_class):
+    log_path = write_log(tmp_path / 'log.json', teacher_class)
+    args = argparse.Namespace(
+        teacher_log=log_path, use_class=not teacher_class
+    )
+    with pytest.raises(ValueError, match='use_class'):
+        teacher_args(args)
+
+
+def test_teacher_args_fills_old_logs(tmp_path):
+    log_path = write_log(tmp_path / 'log.json', True)
+    args = argparse.Namespace(teacher_log=log_path, use_class=True)
+    teacher = teacher_args(args)
+    assert teacher.use_class
+    assert (teacher.enc_layer, teacher.dec_dim, teacher.dec_heads) == \
+        (2, 64, 4)
+    assert (teacher.enc_ffn, teacher.dec_ffn) == (192, 128)
+    assert teacher.gnn_backend == 'pyg'
@@ -4,27 +4,46 @@ import json
 import os
 import time
 import pickle
+import glob
 
 
 from tokenlizer import DEFAULT_SP, Tokenizer
-from torch.utils.data import DataLoader
-from model import PretrainModel, PositionalEncoding
-from training import pretrain, preeval
-from data_utils import load_data, fix_seed, check_early_stop
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
+from model import PretrainModel, PositionalEncoding, fill_model_sizes
+from training import pretrain, preeval, build_memory_cache
+from data_utils import (
+    load_data, load_data_columnar, fix_seed, check_early_stop
+)
 from torch.nn import TransformerDecoderLayer, TransformerDecoder
 from torch.optim.lr_scheduler import ExponentialLR
-from Dataset import RetroDataset, col_fn_retro
+from Dataset import (
+    RetroDataset, StreamingRetroDataset, StreamCollate, col_fn_retro,
+    SizeSortedBatchSampler, SkipBatchSampler, MemoryCacheDataset,
+    col_fn_cached
+)
+from checkpoint_utils import (
+    Checkpointer, checkpoint_run_id, get_rng_state, set_rng_state,
+    dump_json_atomic, sidecar_path
+)
 from sparse_backBone import GATBase
+from lora_utils import add_lora, adapter_state
+from utils.chemistry_parse import count_atoms
+import numpy as np
 
 
-def create_log_model(args):
-    timestamp = time.time()
+def create_log_model(args, run_id=None):
+    timestamp = time.time() if run_id is None else run_id
     if not os.path.exists(args.base_log):
         os.makedirs(args.base_log)
     detail_log_dir = os.path.join(args.base_log, f'log-{timestamp}.json')
-    detail_model_dir = os.path.join(args.base_log, f'mod-{timestamp}.pth')
+    # the adapters only when training low rank adapters
+    model_name = 'adapter' if args.lora_rank > 0 else 'mod'
+    detail_model_dir = os.path.join(
+        args.base_log, f'{model_name}-{timestamp}.pth'
+    )
     token_path = os.path.join(args.base_log, f'token-{timestamp}.pkl')
-    return detail_log_dir, detail_model_dir, token_path
+    ckpt_prefix = os.path.join(args.base_log, f'ckpt-{timestamp}')
+    return detail_log_dir, detail_model_dir, token_path, ckpt_prefix
 
 
 if __name__ == '__main__':
@@ -50,6 +69,38 @@ if __name__ == '__main__':
         '--heads', default=4, type=int,
         help='the number of heads for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--enc_layer', default=-1, type=int,
+        help='the layer of encoder gnn, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--dec_layer', default=-1, type=int,
+        help='the layer of transformer decoder, -1 for n_layer'
+    )
+    parser.add_argument(
+        '--enc_dim', default=-1, type=int,
+        help='the hidden dim of encoder gnn, -1 for dim'
+    )
+    parser.add_argument(
+        '--dec_dim', default=-1, type=int,
+        help='the hidden dim of transformer decoder, -1 for dim'
+    )
+    parser.add_argument(
+        '--enc_heads', default=-1, type=int,
+        help='the number of heads of encoder gnn, -1 for heads'
+    )
+    parser.add_argument(
+        '--dec_heads', default=-1, type=int,
+        help='the number of heads of transformer decoder, -1 for heads'
+    )
+    parser.add_argument(
+        '--enc_ffn', default=-1, type=int,
+        help='the hidden dim of edge update mlp, -1 for 3 * enc_dim'
+    )
+    parser.add_argument(
+        '--dec_ffn', default=-1, type=int,
+        help='the feedforward dim of decoder, -1 for 2 * dec_dim'
+    )
     parser.add_argument(
         '--warmup', default=1, type=int,
         help='the epoch of warmup'
@@ -66,6 +117,17 @@ if __name__ == '__main__':
         '--negative_slope', type=float, default=0.2,
         help='negative slope for attention, only useful for gat'
     )
+    parser.add_argument(
+        '--gnn_backend', type=str, default='pyg',
+        choices=['pyg', 'fused', 'dense', 'auto'],
+        help='the implementation of graph attention, auto chooses '
+        'between fused and dense by the shape of every batch'
+    )
+    parser.add_argument(
+        '--dense_ratio', type=float, default=0,
+        help='the padded size ratio below which auto uses dense, '
+        'see benchmarks/dense_backend.py'
+    )
     parser.add_argument(
         '--data_path', required=True, type=str,
         help='the path containing dataset'
@@ -115,6 +177,26 @@ if __name__ == '__main__':
         '--token_ckpt', type=str, default='',
         help='the path of tokenizer, when ckpt is loaded, necessary'
     )
+    parser.add_argument(
+        '--resume', type=str, default='',
+        help='the path of a full training state saved by this script, '
+        'the run goes on at the saved step with the same data order'
+    )
+    parser.add_argument(
+        '--ckpt_every', type=int, default=0,
+        help='save the full training state every this number of '
+        'optimizer steps, 0 for the end of every epoch only'
+    )
+    parser.add_argument(
+        '--keep_ckpt', type=int, default=2,
+        help='the number of newest training states kept, the states '
+        'eval_sidecar.py has yet to evaluate are kept as well'
+    )
+    parser.add_argument(
+        '--sync_ckpt', action='store_true',
+        help='write the training states in the training loop instead '
+        'of a background thread'
+    )
     parser.add_argument(
         '--use_class', action='store_true',
         help='use class for model or not'
@@ -127,10 +209,93 @@ if __name__ == '__main__':
         '--num_workers', type=int, default=0,
         help='the num of worker for dataloader'
     )
+    parser.add_argument(
+        '--train_shards', type=str, default='',
+        help='glob of csv shards streamed as training set instead of '
+        'the train split in data_path, for corpora larger than memory'
+    )
+    parser.add_argument(
+        '--shuffle_buffer', type=int, default=10000,
+        help='the size of shuffle buffer for streamed training shards'
+    )
+    parser.add_argument(
+        '--columnar', action='store_true',
+        help='store the dataset as memory-mapped columnar files, shared '
+        'by all the dataloader workers'
+    )
+    parser.add_argument(
+        '--size_sort', action='store_true',
+        help='make training batches of molecules with similar sizes, '
+        'less padding in the encoder memory'
+    )
+    parser.add_argument(
+        '--sort_pool', type=int, default=100,
+        help='the number of batches sorted together for --size_sort'
+    )
+    parser.add_argument(
+        '--pack_len', type=int, default=0,
+        help='pack several target sequences into training rows of this '
+        'length with block-diagonal causal masks, 0 for padded batches'
+    )
+    parser.add_argument(
+        '--enc_recompute', type=int, default=0,
+        help='the number of encoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--dec_recompute', type=int, default=0,
+        help='the number of decoder layers recomputed in backward '
+        'instead of saving activations, -1 for all'
+    )
+    parser.add_argument(
+        '--bf16', action='store_true',
+        help='run the model under bfloat16 autocast, for cpus and gpus '
+        'with fast bf16 kernels'
+    )
+    parser.add_argument(
+        '--no_test_eval', action='store_true',
+        help='skip the teacher forcing evaluation on the test set after '
+        'every epoch, leaving the test set to eval_sidecar.py'
+    )
+    parser.add_argument(
+        '--lora_rank', type=int, default=0,
+        help='freeze the model of checkpoint and train low rank adapters '
+        'of this rank only, 0 for training the whole model'
+    )
+    parser.add_argument(
+        '--lora_alpha', type=float, default=16,
+        help='the adapters are scaled by lora_alpha / lora_rank'
+    )
+    parser.add_argument(
+        '--lora_parts', type=str, default=['encoder', 'decoder'],
+        nargs='+', choices=['encoder', 'decoder'],
+        help='the parts of model getting adapters'
+    )
+    parser.add_argument(
+        '--memory_cache', type=str, default='',
+        help='freeze the encoder, cache its node features of the training '
+        'set in this folder once and train the rest from the cache'
+    )
+    parser.add_argument(
+        '--cache_fp16', action='store_true',
+        help='keep the cached node features in float16'
+    )
+    parser.add_argument(
+        '--cache_bank', type=int, default=0,
+        help='the number of randomized products cached per reaction, '
+        'the augmentation of --aug_prob draws from them'
+    )
 
-    args = parser.parse_args()
+    args = fill_model_sizes(parser.parse_args())
     print(args)
-    log_dir, model_dir, token_dir = create_log_model(args)
+    run_id = None
+    if args.resume != '':
+        # the resumed run goes on writing the log, model, tokenizer and
+        # training state files of the run that saved the state
+        args.base_log = os.path.dirname(os.path.abspath(args.resume))
+        run_id = checkpoint_run_id(args.resume)
+    log_dir, model_dir, token_dir, ckpt_prefix = \
+        create_log_model(args, run_id)
 
     if not torch.cuda.is_available() or args.device < 0:
         device = torch.device('cpu')
@@ -139,7 +304,10 @@ if __name__ == '__main__':
 
     fix_seed(args.seed)
 
-    if args.checkpoint != '':
+    if args.resume != '':
+        with open(token_dir, 'rb') as Fin:
+            tokenizer = pickle.load(Fin)
+    elif args.checkpoint != '':
         assert args.token_ckpt != '', \
             'require token_ckpt when checkpoint is given'
         with open(args.token_ckpt, 'rb') as Fin:
@@ -151,16 +319,15 @@ if __name__ == '__main__':
         with open(args.token_path) as Fin:
             tokenizer = Tokenizer(json.load(Fin), SP_TOKEN)
 
-    train_rec, train_prod, train_rxn = load_data(args.data_path, 'train')
-    val_rec, val_prod, val_rxn = load_data(args.data_path, 'val')
-    test_rec, test_prod, test_rxn = load_data(args.data_path, 'test')
+    data_loader_fn = load_data_columnar if args.columnar else load_data
+    if args.train_shards == '':
+        train_rec, train_prod, train_rxn = \
+            data_loader_fn(args.data_path, 'train')
+    val_rec, val_prod, val_rxn = data_loader_fn(args.data_path, 'val')
+    test_rec, test_prod, test_rxn = data_loader_fn(args.data_path, 'test')
 
     print('[INFO] Data Loaded')
 
-    train_set = RetroDataset(
-        prod_sm=train_prod, reat_sm=train_rec, aug_prob=args.aug_prob,
-        rxn_cls=train_rxn if args.use_class else None
-    )
     valid_set = RetroDataset(
         prod_sm=val_prod, reat_sm=val_rec, aug_prob=0,
         rxn_cls=val_rxn if args.use_class else None
@@ -170,10 +337,41 @@ if __name__ == '__main__':
         rxn_cls=test_rxn if args.use_class else None
     )
 
-    train_loader = DataLoader(
-        train_set, collate_fn=col_fn_retro, batch_size=args.bs,
-        shuffle=True, num_workers=args.num_workers
-    )
+    if args.train_shards != '':
+        train_set = StreamingRetroDataset(
+            shards=glob.glob(args.train_shards), aug_prob=args.aug_prob,
+            use_class=args.use_class, buffer_size=args.shuffle_buffer,
+            seed=args.seed, num_workers=args.num_workers
+        )
+        train_loader = DataLoader(
+            train_set, collate_fn=StreamCollate(train_set),
+            batch_size=args.bs, num_workers=args.num_workers
+        )
+    else:
+        train_set = RetroDataset(
+            prod_sm=train_prod, reat_sm=train_rec, aug_prob=args.aug_prob,
+            rxn_cls=train_rxn if args.use_class else None
+        )
+        # reseeded with seed + epoch, the permutation of DistributedSampler,
+        # ddp_train_trans with bs / num_gpus per rank sees the same batches
+        train_gen = torch.Generator()
+        if args.size_sort:
+            batch_sampler = SizeSortedBatchSampler(
+                sampler=RandomSampler(train_set, generator=train_gen),
+                batch_size=args.bs,
+                sizes=np.array([count_atoms(x) for x in train_prod]),
+                pool_size=args.sort_pool, seed=args.seed
+            )
+        else:
+            batch_sampler = BatchSampler(
+                RandomSampler(train_set, generator=train_gen),
+                batch_size=args.bs, drop_last=False
+            )
+        train_loader = DataLoader(
+            train_set, collate_fn=col_fn_retro,
+            batch_sampler=SkipBatchSampler(batch_sampler),
+            num_workers=args.num_workers
+        )
     valid_loader = DataLoader(
         valid_set, collate_fn=col_fn_retro, batch_size=args.bs,
         shuffle=False, num_workers=args.num_workers
@@ -184,21 +382,25 @@ if __name__ == '__main__':
     )
 
     GNN = GATBase(
-        num_layers=args.n_layer, dropout=args.dropout, num_heads=args.heads,
-        embedding_dim=args.dim, negative_slope=args.negative_slope,
-        n_class=11 if args.use_class else None
+        num_layers=args.enc_layer, dropout=args.dropout,
+        embedding_dim=args.enc_dim, num_heads=args.enc_heads,
+        negative_slope=args.negative_slope,
+        n_class=11 if args.use_class else None,
+        backend=args.gnn_backend, dense_ratio=args.dense_ratio,
+        edge_hidden=args.enc_ffn, recompute=args.enc_recompute
     )
 
     decode_layer = TransformerDecoderLayer(
-        d_model=args.dim, nhead=args.heads, batch_first=True,
-        dim_feedforward=args.dim * 2, dropout=args.dropout
+        d_model=args.dec_dim, nhead=args.dec_heads, batch_first=True,
+        dim_feedforward=args.dec_ffn, dropout=args.dropout
     )
-    Decoder = TransformerDecoder(decode_layer, args.n_layer)
-    Pos_env = PositionalEncoding(args.dim, args.dropout, maxlen=2000)
+    Decoder = TransformerDecoder(decode_layer, args.dec_layer)
+    Pos_env = PositionalEncoding(args.dec_dim, args.dropout, maxlen=2000)
 
     model = PretrainModel(
         token_size=tokenizer.get_token_size(), encoder=GNN,
-        decoder=Decoder, d_model=args.dim, pos_enc=Pos_env
+        decoder=Decoder, d_model=args.dec_dim, pos_enc=Pos_env,
+        memory_dim=args.enc_dim, recompute=args.dec_recompute
     ).to(device)
 
     if args.checkpoint != '':
@@ -207,6 +409,42 @@ if __name__ == '__main__':
         weight = torch.load(args.checkpoint, map_location=device)
         model.load_state_dict(weight, strict=False)
 
+    if args.lora_rank > 0:
+        assert args.checkpoint != '', \
+            'adapters are trained on the model of checkpoint'
+        assert args.memory_cache == '' or 'encoder' not in args.lora_parts, \
+            'the encoder is frozen with memory cache'
+        add_lora(model, args.lora_rank, args.lora_alpha, args.lora_parts)
+
+    if args.memory_cache != '':
+        assert args.train_shards == '', \
+            'the memory cache is built from the training split'
+        assert args.aug_prob == 0 or args.cache_bank > 0, \
+            'augmentation with memory cache needs a bank of cache_bank'
+        # the frozen encoder runs once over the training set, the batches
+        # of the cache carry its node features, adam skips the encoder
+        # parameters without gradients
+        model.encoder.requires_grad_(False)
+        # a cache of another encoder or dataset is rebuilt
+        cache_key = {
+            'data_path': os.path.abspath(args.data_path),
+            'use_class': args.use_class, 'checkpoint': args.checkpoint,
+            'encoder': os.path.getmtime(args.checkpoint)
+            if args.checkpoint != '' else args.seed
+        }
+        build_memory_cache(
+            model, train_rec, train_prod,
+            train_rxn if args.use_class else None, args.memory_cache,
+            device, bank=args.cache_bank, fp16=args.cache_fp16, bs=args.bs,
+            num_workers=args.num_workers, key=cache_key
+        )
+        train_set = MemoryCacheDataset(args.memory_cache, args.aug_prob)
+        train_loader = DataLoader(
+            train_set, collate_fn=col_fn_cached,
+            batch_sampler=train_loader.batch_sampler,
+            num_workers=args.num_workers
+        )
+
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
     lr_sh = ExponentialLR(optimizer, gamma=args.gamma, verbose=True)
     best_perf, best_ep = None, None
@@ -218,48 +456,110 @@ if __name__ == '__main__':
         'valid_metric': [], 'test_metric': []
     }
 
+    def train_data_state():
+        if args.train_shards != '':
+            return train_set.state_dict()
+        return train_loader.batch_sampler.state_dict()
+
+    def save_state(epoch, step, losses, data_state):
+        checkpointer.save({
+            'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+            'lr_sh': lr_sh.state_dict(), 'epoch': epoch, 'step': step,
+            'log_info': log_info, 'best_perf': best_perf, 'best_ep': best_ep,
+            'ranks': [{
+                'rng': get_rng_state(), 'data': data_state, 'losses': losses
+            }]
+        }, epoch, step)
+
+    def on_step(step, losses):
+        # the stream goes on from its cursor, the sampler replays the
+        # epoch from its state at the start of the epoch
+        if checkpointer.step():
+            data_state = epoch_data_state if args.train_shards == '' \
+                else train_set.state_dict()
+            save_state(ep, step, losses, data_state)
+
+    checkpointer = Checkpointer(
+        ckpt_prefix, args.ckpt_every, args.keep_ckpt, not args.sync_ckpt,
+        sidecar=sidecar_path(ckpt_prefix)
+    )
+    start_ep, resume = 0, None
+    if args.resume != '':
+        print(f'[INFO] Resuming from {args.resume}')
+        state = torch.load(args.resume, map_location='cpu')
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        lr_sh.load_state_dict(state['lr_sh'])
+        log_info, start_ep = state['log_info'], state['epoch']
+        best_perf, best_ep = state['best_perf'], state['best_ep']
+        rank_state = state['ranks'][0]
+        if args.train_shards != '':
+            train_set.load_state_dict(rank_state['data'])
+        else:
+            train_loader.batch_sampler.load_state_dict(rank_state['data'])
+            train_loader.batch_sampler.skip = state['step']
+        if state['step'] > 0:
+            resume = {
+                'step': state['step'], 'losses': rank_state['losses'],
+                'rng': rank_state['rng']
+            }
+        else:
+            set_rng_state(rank_state['rng'])
+
     with open(token_dir, 'wb') as Fout:
         pickle.dump(tokenizer, Fout)
 
-    with open(log_dir, 'w') as Fout:
-        json.dump(log_info, Fout, indent=4)
+    dump_json_atomic(log_info, log_dir)
 
-    for ep in range(args.epoch):
+    for ep in range(start_ep, args.epoch):
         print(f'[INFO] traing at epoch {ep + 1}')
+        if args.train_shards != '':
+            train_set.set_epoch(ep)
+        else:
+            train_gen.manual_seed(args.seed + ep)
+        epoch_data_state = train_data_state()
         loss = pretrain(
             loader=train_loader, model=model, optimizer=optimizer,
             tokenizer=tokenizer, device=device, pad_token='<PAD>',
             warmup=(ep < args.warmup), accu=args.accu,
-            label_smoothing=args.label_smoothing
+            label_smoothing=args.label_smoothing, pack_len=args.pack_len,
+            bf16=args.bf16, resume=resume, on_step=on_step
         )
+        resume = None
         log_info['train_loss'].append({'trans': loss})
 
         valid_result = preeval(
             loader=valid_loader, model=model, tokenizer=tokenizer,
-            pad_token='<PAD>', end_token='<END>', device=device
+            pad_token='<PAD>', end_token='<END>', device=device, bf16=args.bf16
         )
         log_info['valid_metric'].append({'trans': valid_result})
 
-        test_result = preeval(
-            loader=test_loader, model=model, tokenizer=tokenizer,
-            pad_token='<PAD>', end_token='<END>', device=device
-        )
-
-        log_info['test_metric'].append({'trans': test_result})
+        if not args.no_test_eval:
+            test_result = preeval(
+                loader=test_loader, model=model, tokenizer=tokenizer,
+                pad_token='<PAD>', end_token='<END>', device=device,
+                bf16=args.bf16
+            )
+            log_info['test_metric'].append({'trans': test_result})
 
         print('[TRAIN]', log_info['train_loss'][-1])
         print('[VALID]', log_info['valid_metric'][-1])
-        print('[TEST]', log_info['test_metric'][-1])
+        if not args.no_test_eval:
+            print('[TEST]', log_info['test_metric'][-1])
 
         if ep >= args.warmup and ep >= args.step_start:
             lr_sh.step()
 
-        with open(log_dir, 'w') as Fout:
-            json.dump(log_info, Fout, indent=4)
+        dump_json_atomic(log_info, log_dir)
 
         if best_perf is None or valid_result > best_perf:
             best_perf, best_ep = valid_result, ep
-            torch.save(model.state_dict(), model_dir)
+            torch.save(
+                adapter_state(model) if args.lora_rank > 0
+                else model.state_dict(), model_dir
+            )
+
+        save_state(ep + 1, 0, [], train_data_state())
 
         if args.early_stop > 3 and ep > max(10, args.early_stop):
             tx = log_info['valid_metric'][-args.early_stop:]
@@ -267,6 +567,14 @@ if __name__ == '__main__':
             if check_early_stop(tx):
                 break
 
+    checkpointer.wait()
+    # eval_sidecar.py exits once the states before it are evaluated
+    log_info['finished'] = True
+    dump_json_atomic(log_info, log_dir)
+    if len(checkpointer.blocked) > 0:
+        blocked = np.mean(checkpointer.blocked) * 1e3
+        print(f'[INFO] training blocked {blocked:.1f} ms per checkpoint')
     print(f'[INFO] best acc epoch: {best_ep}')
     print(f'[INFO] best valid loss: {log_info["valid_metric"][best_ep]}')
-    print(f'[INFO] best test loss: {log_info["test_metric"][best_ep]}')
+    if not args.no_test_eval:
+        print(f'[INFO] best test loss: {log_info["test_metric"][best_ep]}')
@@ -1,28 +1,37 @@
 from tqdm import tqdm
+import json
+import os
 import numpy as np
 import torch
+from torch.utils.data import DataLoader
 from torch.nn.functional import cross_entropy
 from data_utils import (
     generate_tgt_mask, correct_trans_output,
-    convert_log_into_label
+    convert_log_into_label, generate_packed_batch, bf16_autocast
 )
 
 from data_utils import eval_trans as data_eval_trans
+from data_utils import write_string_column
+from checkpoint_utils import set_rng_state, dump_json_atomic
+from Dataset import RetroDataset, col_fn_retro
 
 
-def warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor):
+def warmup_lr_scheduler(
+    optimizer, warmup_iters, warmup_factor, last_iter=-1
+):
     def f(x):
         if x >= warmup_iters:
             return 1
         alpha = float(x) / warmup_iters
         return warmup_factor * (1 - alpha) + alpha
 
-    return torch.optim.lr_scheduler.LambdaLR(optimizer, f)
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, f, last_iter)
 
 
 def calc_trans_loss(trans_pred, trans_lb, ignore_index, lbsm=0.0):
     batch_size, maxl, num_c = trans_pred.shape
-    trans_pred = trans_pred.reshape(-1, num_c)
+    # float32 even if the logits come from bf16 autocast
+    trans_pred = trans_pred.float().reshape(-1, num_c)
     trans_lb = trans_lb.reshape(-1)
 
     losses = cross_entropy(
@@ -34,54 +43,138 @@ def calc_trans_loss(trans_pred, trans_lb, ignore_index, lbsm=0.0):
     return loss
 
 
+def calc_packed_loss(trans_pred, trans_lb, batch_size, lbsm=0.0):
+    # trans_pred only holds the real tokens, same value as calc_trans_loss
+    loss = cross_entropy(
+        trans_pred.float(), trans_lb, reduction='sum', label_smoothing=lbsm
+    )
+    return loss / batch_size
+
+
+def calc_kd_loss(
+    trans_pred, teacher_pred, trans_lb, ignore_index, temperature=1.0,
+    batch_size=None
+):
+    """
+    kl(teacher || student) of the token distributions softened by
+    temperature, summed over the tokens and averaged over the batch as
+    calc_trans_loss, times temperature ** 2 to keep the gradient scale.
+    the logits of packed batches are [tokens, classes] as in
+    calc_packed_loss and batch_size is given
+    """
+    num_c = trans_pred.shape[-1]
+    if batch_size is None:
+        batch_size = trans_pred.shape[0]
+    log_p = torch.log_softmax(
+        trans_pred.float().reshape(-1, num_c) / temperature, dim=-1
+    )
+    log_q = torch.log_softmax(
+        teacher_pred.float().reshape(-1, num_c) / temperature, dim=-1
+    )
+    losses = torch.sum(log_q.exp() * (log_q - log_p), dim=-1)
+    losses = losses.masked_fill(trans_lb.reshape(-1) == ignore_index, 0)
+    return losses.sum() / batch_size * temperature ** 2
+
+
 def pretrain(
     loader, model, optimizer, device, tokenizer,
-    pad_token, warmup, accu=1, label_smoothing=0
+    pad_token, warmup, accu=1, label_smoothing=0, pack_len=0, bf16=False,
+    resume=None, on_step=None, teacher=None, kd_alpha=0.5, kd_temp=1.0
 ):
+    # resume holds the step, losses and rng state saved in the middle of
+    # this epoch, the loader skips the batches trained before it, on_step
+    # gets the number of trained batches and the losses after every
+    # optimizer step but the last one of the epoch. with teacher, the
+    # loss is (1 - kd_alpha) times the loss on the targets plus kd_alpha
+    # times calc_kd_loss to the distributions of teacher on the same batch
     model, losses = model.train(), []
+    if teacher is not None:
+        teacher = teacher.eval()
     ignore_idx = tokenizer.token2idx[pad_token]
-    its, total_len = 1, len(loader)
+    start = 0 if resume is None else resume['step']
+    its, total_len = start + 1, start + len(loader)
     if warmup:
-        warmup_iters = len(loader) - 1
-        warmup_sher = warmup_lr_scheduler(optimizer, warmup_iters, 5e-2)
-    for graph, tran in tqdm(loader):
+        warmup_iters = total_len - 1
+        warmup_sher = warmup_lr_scheduler(
+            optimizer, warmup_iters, 5e-2, last_iter=start - 1
+        )
+    # creating the iterator draws from the torch generator, the rng state
+    # of the checkpoint is restored after it
+    batches = iter(loader)
+    if resume is not None:
+        losses = list(resume['losses'])
+        set_rng_state(resume['rng'])
+    for graph, tran in tqdm(batches, total=total_len - start):
         graph = graph.to(device)
 
-        tops = torch.LongTensor(tokenizer.encode2d(tran)).to(device)
-        trans_dec_ip = tops[:, :-1]
-        trans_dec_op = tops[:, 1:]
-
-        trans_op_mask, diag_mask = generate_tgt_mask(
-            trans_dec_ip, tokenizer, pad_token, device=device
-        )
+        tops = torch.LongTensor(tokenizer.encode2d(tran))
+        if pack_len > 0:
+            trans_dec_ip, trans_dec_op, diag_mask, packing = \
+                generate_packed_batch(tops, graph.ptr, ignore_idx, pack_len)
+            trans_dec_op = trans_dec_op.to(device)
+            inputs = {
+                'graphs': graph, 'tgt': trans_dec_ip.to(device),
+                'tgt_mask': diag_mask.to(device), 'tgt_pad_mask': None,
+                'packing': {k: v.to(device) for k, v in packing.items()}
+            }
+        else:
+            tops = tops.to(device)
+            trans_dec_ip = tops[:, :-1]
+            trans_dec_op = tops[:, 1:]
 
-        trans_logs = model(
-            graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
-            tgt_pad_mask=trans_op_mask
-        )
+            trans_op_mask, diag_mask = generate_tgt_mask(
+                trans_dec_ip, tokenizer, pad_token, device=device
+            )
+            inputs = {
+                'graphs': graph, 'tgt': trans_dec_ip, 'tgt_mask': diag_mask,
+                'tgt_pad_mask': trans_op_mask
+            }
 
-        loss = calc_trans_loss(
-            trans_logs, trans_dec_op, ignore_idx, label_smoothing
-        )
+        with bf16_autocast(device, bf16):
+            trans_logs = model(**inputs)
+        if pack_len > 0:
+            loss = calc_packed_loss(
+                trans_logs, trans_dec_op, len(tran), label_smoothing
+            )
+        else:
+            loss = calc_trans_loss(
+                trans_logs, trans_dec_op, ignore_idx, label_smoothing
+            )
+        if teacher is not None:
+            with torch.no_grad(), bf16_autocast(device, bf16):
+                teacher_logs = teacher(**inputs)
+            loss = (1 - kd_alpha) * loss + kd_alpha * calc_kd_loss(
+                trans_logs, teacher_logs, trans_dec_op, ignore_idx,
+                kd_temp, batch_size=len(tran)
+            )
 
         if not warmup and accu > 1:
             loss = loss / accu
         loss.backward()
 
-        if its % accu == 0 or its == total_len or warmup:
+        step = its % accu == 0 or its == total_len or warmup
+        if step:
             optimizer.step()
             optimizer.zero_grad()
         its += 1
 
         losses.append(loss.item())
 
+        if hasattr(loader.dataset, 'update_cursor'):
+            loader.dataset.update_cursor(graph)
+
         if warmup:
             warmup_sher.step()
 
-    return np.mean(losses)
+        if on_step is not None and step and its <= total_len:
+            on_step(its - 1, losses)
 
+    return float(np.mean(losses))
 
-def preeval(model, loader, device, tokenizer, pad_token, end_token):
+
+def preeval(
+    model, loader, device, tokenizer, pad_token, end_token, bf16=False
+):
     model, trans_accs = model.eval(), []
     end_idx = tokenizer.token2idx[end_token]
     pad_idx = tokenizer.token2idx[pad_token]
@@ -95,7 +188,7 @@ def preeval(model, loader, device, tokenizer, pad_token, end_token):
         trans_op_mask, diag_mask = generate_tgt_mask(
             trans_dec_ip, tokenizer, pad_token, device=device
         )
-        with torch.no_grad():
+        with torch.no_grad(), bf16_autocast(device, bf16):
             trans_logs = model(
                 graphs=graph, tgt=trans_dec_ip, tgt_mask=diag_mask,
                 tgt_pad_mask=trans_op_mask
@@ -107,3 +200,64 @@ def preeval(model, loader, device, tokenizer, pad_token, end_token):
 
     trans_accs = torch.cat(trans_accs, dim=0).float()
     return trans_accs.mean().item()
+
+
+def build_memory_cache(
+    model, reacts, prods, rxn_cls, path, device, bank=0, fp16=False,
+    bs=64, num_workers=0, key=None
+):
+    """
+    Runs the frozen encoder of model once over the reactions and writes
+    the node features and the target tokens for MemoryCacheDataset into
+    path, the canonical products first and then bank variants with
+    randomized products. The cache in path is reused when it was built
+    with the same key, e.g. the encoder checkpoint and the data.
+    :return: the meta of the cache
+    """
+    meta = {
+        'num': len(reacts), 'bank': bank, 'key': key,
+        'dtype': 'float16' if fp16 else 'float32'
+    }
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as Fin:
+            old_meta = json.load(Fin)
+        if all(old_meta.get(k) == v for k, v in meta.items()):
+            print(f'[INFO] reuse the memory cache in {path}')
+            return old_meta
+        # the meta is written last and marks a finished cache
+        os.remove(meta_file)
+
+    os.makedirs(path, exist_ok=True)
+    model, offset, tokens = model.eval(), [0], []
+    with open(os.path.join(path, 'feat.bin.tmp'), 'wb') as Fout:
+        for variant in range(bank + 1):
+            dataset = RetroDataset(
+                prod_sm=prods, reat_sm=reacts, rxn_cls=rxn_cls,
+                aug_prob=0 if variant == 0 else 1
+            )
+            loader = DataLoader(
+                dataset, collate_fn=col_fn_retro, batch_size=bs,
+                shuffle=False, num_workers=num_workers
+            )
+            for graph, tran in tqdm(loader):
+                with torch.no_grad():
+                    node_feat = model.encode_nodes(graph.to(device))
+                node_feat = node_feat.float().cpu().numpy()
+                Fout.write(node_feat.astype(meta['dtype']).tobytes())
+                offset.extend((graph.ptr[1:].cpu() + offset[-1]).tolist())
+                tokens.extend(' '.join(x) for x in tran)
+    meta['dim'] = node_feat.shape[1]
+
+    os.replace(
+        os.path.join(path, 'feat.bin.tmp'), os.path.join(path, 'feat.bin')
+    )
+    with open(os.path.join(path, 'feat_offset.npy.tmp'), 'wb') as Fout:
+        np.save(Fout, np.array(offset, dtype=np.int64))
+    os.replace(
+        os.path.join(path, 'feat_offset.npy.tmp'),
+        os.path.join(path, 'feat_offset.npy')
+    )
+    write_string_column(os.path.join(path, 'tokens'), tokens)
+    dump_json_atomic(meta, meta_file)
+    return meta
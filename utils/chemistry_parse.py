@@ -52,3 +52,8 @@ def remove_am_wo_cano(smi):
 
 def find_all_amap(smi):
     return list(map(int, re.findall(r"(?<=:)\d+", smi)))
+
+
+def count_atoms(smi):
+    """Count the heavy atoms of a SMILES without parsing it"""
+    return len(re.findall(r"\[[^\]]+]|Br|Cl|[BCNOSPFI]|[bcnops]", smi))
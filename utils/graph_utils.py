@@ -6,6 +6,7 @@ import torch
 import rdkit
 from rdkit import Chem
 import numpy as np
+from collections import OrderedDict
 
 
 def smiles2graph(smiles_string, with_amap=False):
@@ -79,3 +80,146 @@ def smiles2graph(smiles_string, with_amap=False):
         return graph, amap_idx
     else:
         return graph
+
+
+def _feature_lookup(name, enum_type=None):
+    # dict version of ogb's safe_index, unknown values fall back to 'misc'
+    # rdkit enums are keyed by themselves to skip the str() conversion
+    choices = allowable_features[name]
+    lookup = {v: idx for idx, v in enumerate(choices)}
+    if enum_type is not None:
+        lookup = {
+            v: lookup[str(v)] for v in enum_type.values.values()
+            if str(v) in lookup
+        }
+    return lookup, len(choices) - 1
+
+
+_ATOMIC_NUM = _feature_lookup('possible_atomic_num_list')
+_CHIRALITY = _feature_lookup(
+    'possible_chirality_list', Chem.rdchem.ChiralType
+)
+_DEGREE = _feature_lookup('possible_degree_list')
+_FORMAL_CHARGE = _feature_lookup('possible_formal_charge_list')
+_NUM_H = _feature_lookup('possible_numH_list')
+_RADICAL_E = _feature_lookup('possible_number_radical_e_list')
+_HYBRIDIZATION = _feature_lookup(
+    'possible_hybridization_list', Chem.rdchem.HybridizationType
+)
+_BOND_TYPE = _feature_lookup(
+    'possible_bond_type_list', Chem.rdchem.BondType
+)
+_BOND_STEREO = _feature_lookup(
+    'possible_bond_stereo_list', Chem.rdchem.BondStereo
+)
+
+
+def _atom_feature(atom):
+    return (
+        _ATOMIC_NUM[0].get(atom.GetAtomicNum(), _ATOMIC_NUM[1]),
+        _CHIRALITY[0].get(atom.GetChiralTag(), _CHIRALITY[1]),
+        _DEGREE[0].get(atom.GetTotalDegree(), _DEGREE[1]),
+        _FORMAL_CHARGE[0].get(atom.GetFormalCharge(), _FORMAL_CHARGE[1]),
+        _NUM_H[0].get(atom.GetTotalNumHs(), _NUM_H[1]),
+        _RADICAL_E[0].get(atom.GetNumRadicalElectrons(), _RADICAL_E[1]),
+        _HYBRIDIZATION[0].get(atom.GetHybridization(), _HYBRIDIZATION[1]),
+        int(atom.GetIsAromatic()), int(atom.IsInRing())
+    )
+
+
+def _bond_feature(bond):
+    return (
+        bond.GetBeginAtomIdx(), bond.GetEndAtomIdx(),
+        _BOND_TYPE[0].get(bond.GetBondType(), _BOND_TYPE[1]),
+        _BOND_STEREO[0][bond.GetStereo()],
+        int(bond.GetIsConjugated())
+    )
+
+
+def _atom_features(mol):
+    x = [
+        _atom_feature(mol.GetAtomWithIdx(idx))
+        for idx in range(mol.GetNumAtoms())
+    ]
+    return np.array(x, dtype=np.uint8).reshape(-1, 9)
+
+
+def _bond_features(mol):
+    bonds = [
+        _bond_feature(mol.GetBondWithIdx(idx))
+        for idx in range(mol.GetNumBonds())
+    ]
+    bonds = np.array(bonds, dtype=np.int32).reshape(-1, 5)
+
+    # every bond becomes (i, j) followed by (j, i), the same edge order
+    # as smiles2graph
+    ends = bonds[:, :2]
+    edge_index = np.stack([ends, ends[:, ::-1]], axis=1).reshape(-1, 2).T
+    edge_attr = np.repeat(bonds[:, 2:].astype(np.uint8), 2, axis=0)
+    return np.ascontiguousarray(edge_index), edge_attr
+
+
+def fast_smiles2graph(smiles_string, with_amap=False):
+    """
+    Drop-in replacement of smiles2graph producing the same values in
+    compact dtypes, uint8 for the categorical features and int32 for
+    edge_index, they are widened only at the embedding lookup
+    :input: SMILES string (str)
+    :return: graph object
+    """
+    mol = Chem.MolFromSmiles(smiles_string)
+    if with_amap:
+        amap_idx = dict()
+        if mol.GetNumAtoms() > 0:
+            max_amap = max(atom.GetAtomMapNum() for atom in mol.GetAtoms())
+            for atom in mol.GetAtoms():
+                if atom.GetAtomMapNum() == 0:
+                    max_amap = max_amap + 1
+                    atom.SetAtomMapNum(max_amap)
+                amap_idx[atom.GetAtomMapNum()] = atom.GetIdx()
+
+    x = _atom_features(mol)
+    edge_index, edge_attr = _bond_features(mol)
+
+    graph = {
+        'edge_index': edge_index, 'edge_feat': edge_attr,
+        'node_feat': x, 'num_nodes': len(x)
+    }
+    return (graph, amap_idx) if with_amap else graph
+
+
+class GraphFeaturizer(object):
+    """
+    Featurizer with a bounded LRU cache keyed by the input SMILES, the
+    cached arrays are shared between calls and must not be modified
+    inplace. Every dataloader worker owns its own cache.
+    """
+
+    def __init__(self, cache_size=200000):
+        super(GraphFeaturizer, self).__init__()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __call__(self, smiles_string, with_amap=False):
+        key = (smiles_string, with_amap)
+        result = self.cache.get(key, None)
+        if result is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = fast_smiles2graph(smiles_string, with_amap=with_amap)
+        if self.cache_size > 0:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        self.cache.clear()
+        self.hits, self.misses = 0, 0
+
+
+cached_smiles2graph = GraphFeaturizer()